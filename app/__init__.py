@@ -17,6 +17,11 @@ def create_app():
 		PERMANENT_SESSION_LIFETIME = datetime.timedelta(days = 93),
 		WTF_CSRF_TIME_LIMIT = None, # Expire with session
 		DATABASE = 'data.sqlite',
+		SNAPSHOT_PATH = None,
+		SNAPSHOT_KEEP = 3,
+		SNAPSHOT_READER = False,
+		SNAPSHOT_POLL = 5,
+		USER_DATABASE = 'users.sqlite',
 		VIDEO_EXTENSIONS = {
 			'.mp4': 'video/mp4',
 			'.webm': 'video/webm',
@@ -32,6 +37,7 @@ def create_app():
 			'.gif': 'image/gif'
 			},
 		METADATA_EXTENSION = '.info.json',
+		FILENAME_FORMATS = {},
 		SORT_COLUMNS = {
 			'playlist_index': 'Playlist',
 			'sort_title': 'Title',
@@ -62,10 +68,60 @@ def create_app():
 			'jpg':  { 'export_format': 'JPEG',
 					  'priority': 0 },
 			'webp': { 'export_format': 'WEBP',
-					  'priority': 1 }
+					  'priority': 1 },
+			'avif': { 'export_format': 'AVIF',
+					  'priority': 2,
+					  'lazy': True }
 			},
+		LAZY_THUMBNAILS = False,
 		THUMBNAIL_SIZE = (128, 72),
+		THUMBNAIL_SCALES = (1, 2),
 		THUMBNAIL_QUALITY = 70,
+		PROBE_VIDEOS = True,
+		SCAN_WORKERS = 4,
+		RESUME_SCANS = True,
+		TASK_HEARTBEAT = 10,
+		TASK_LEASE_TIMEOUT = 60,
+		REFRESH_SCHEDULER = True,
+		REFRESH_JITTER = 0.1,
+		REFRESH_QUIET_HOURS = None,
+		SCHEDULER_IO_WORKERS = 1,
+		SCHEDULER_POLL = 60,
+		MAINTENANCE_INTERVAL = 7 * 24 * 60 * 60,
+		MAINTENANCE_STEPS = 100,
+		MAINTENANCE_PAGES = 500,
+		WATCH_LIBRARY = False,
+		WATCH_DEBOUNCE = 5,
+		EVENTS_STREAM = True,
+		EVENTS_KEEPALIVE = 15,
+		EVENTS_POLL = 5,
+		EVENTS_TIMEOUT = 600,
+		POSTER_FRAMES = False,
+		FFMPEG_PATH = 'ffmpeg',
+		POSTER_OFFSET = 10,
+		POSTER_TIMEOUT = 20,
+		POSTER_WORKERS = 2,
+		SERVE_MEDIA = False,
+		MEDIA_SENDFILE = None,
+		MEDIA_ACCEL_PREFIX = '/protected-media/',
+		SPRITE_SHEETS = True,
+		SPRITE_GRID = (10, 5),
+		COMPRESS_RESPONSES = True,
+		COMPRESS_MIMETYPES = {
+			'text/html',
+			'text/css',
+			'application/javascript',
+			'text/javascript',
+			'application/json',
+			'application/vnd.ytdl-web.columns+json',
+			'image/svg+xml'
+			},
+		COMPRESS_MIN_SIZE = 1024,
+		COMPRESS_LEVEL = {
+			'br': 5,
+			'gzip': 6
+			},
+		COMPRESS_CACHE_SIZE = 32 * 1024 * 1024,
 		DATABASE_LOG_LEVEL = logging.WARNING
 	)
 	
@@ -97,6 +153,10 @@ def create_app():
 	# Register blueprints
 	# View functions must be imported in __init__.py as per https://flask.palletsprojects.com/en/1.1.x/patterns/packages/
 	
+	from . import events
+	# Push task progress to browsers
+	events.init_app(app)
+	
 	from . import db
 	# Register database functions
 	db.init_app(app)
@@ -120,5 +180,33 @@ def create_app():
 	app.register_blueprint(api.blueprint)
 	# Reset task on server restart
 	api.init_app(app)
+	
+	from . import media
+	app.register_blueprint(media.blueprint)
+	media.init_app(app)
+	
+	from . import maintenance
+	# Tidy up the database from the CLI
+	maintenance.init_app(app)
+	
+	from . import archive
+	# Copy the library between servers from the CLI
+	archive.init_app(app)
+	
+	from . import scheduler
+	# Refresh the database on the server on an interval
+	scheduler.init_app(app)
+	
+	from . import watcher
+	# Add new videos as they're downloaded
+	watcher.init_app(app)
+	
+	from . import assets
+	# Fingerprint static files for long-lived caching
+	assets.init_app(app)
+	
+	from . import compress
+	# Compress responses
+	compress.init_app(app)
 		
 	return app
\ No newline at end of file
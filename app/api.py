@@ -1,17 +1,25 @@
 import functools
 import json
+import os
+import socket
 import threading
+import time
+import uuid
 try:
 	from pysqlite3 import dbapi2 as sqlite3
 except ImportError:
 	import sqlite3
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 from datetime import datetime, timezone
 
 from pathlib import Path
-import urllib
+from fnmatch import fnmatchcase
+import shutil
+import subprocess
 import re
 from io import BytesIO
 import base64
@@ -21,27 +29,80 @@ from flask_wtf import csrf
 from wtforms.validators import ValidationError
 
 try:
-	from PIL import Image, features
+	from PIL import Image, ImageOps, features
 except ImportError:
 	Image = None
 	features = None
 
-from app.db import get_db, get_params, column_exists
+from app.db import (get_db, get_params, column_exists, bump_generation,
+					library_table, create_shadow_tables, resume_shadow_tables,
+					swap_shadow_tables, drop_shadow_tables, free_bytes,
+					publish_snapshot)
 from app.auth import login_required
-from app.helpers import format_duration, escape_fts_query
+from app.assets import IMMUTABLE_CACHE_CONTROL
+from app.media import media_urls, get_media_path
+from app.probe import probe
+from app.poster import extract_poster
+from app.events import publish_event, format_event
+from app.helpers import format_duration, format_size, escape_fts_query, sort_key
 
 blueprint = Blueprint('api', __name__, url_prefix='/api')
 
-# todo: deal with cancelling tasks on server stop
+# Playlists and thumbnails can be returned as arrays of columns
+# e.g. {'id': [1, 2], 't': ['a', 'b']} instead of a list of objects
+# if requested with Accept: application/vnd.ytdl-web.columns+json
+COLUMNS_MIMETYPE = 'application/vnd.ytdl-web.columns+json'
 
 def init_app(app):
-	"""Reset running task on server restart"""
+	"""
+	Watch a task left running on server restart: it may belong to another
+	worker process, or to a server that stopped, in which case it's resumed
+	or reset once its lease expires
+	"""
 	with app.app_context():
 		try:
-			set_task()
+			task = get_task()
 		except sqlite3.OperationalError as e:
 			# Task table could be missing if db not initialised
 			current_app.logger.warning(f'Could not reset tasks: {e}')
+			return
+	if task['status'] == 1:
+		threading.Thread(target = recover_task, args = (app, ),
+						 daemon = True).start()
+
+def recover_task(app):
+	"""
+	Wait until the running task finishes or its lease expires, then take
+	the lease and resume the scan if RESUME_SCANS is set or reset the task
+	"""
+	with app.app_context():
+		owner = new_task_owner()
+		while True:
+			try:
+				task = get_task()
+				if task['status'] != 1:
+					# Finished, or recovered by another process
+					return
+				expires = ((task['heartbeat'] or 0) +
+						   app.config['TASK_LEASE_TIMEOUT'])
+				if expires <= time.time() and acquire_task(
+											  owner, 'Recovering task'):
+					break
+			except sqlite3.OperationalError as e:
+				app.logger.warning(f'Could not recover task: {e}')
+				return
+			time.sleep(max(expires - time.time(), 1))
+		
+		g.task_owner = owner
+		try:
+			if task['scan'] is not None and app.config['RESUME_SCANS']:
+				app.logger.info(f'Resuming interrupted {task["scan"]}')
+				refresh_db(rescan = task['scan'] == 'rescan', resume = True)
+			else:
+				app.logger.info('Reset task left running by a stopped server')
+				set_task()
+		except sqlite3.OperationalError as e:
+			app.logger.error(f'Could not recover task: {e}')
 
 def csrf_protect(view):
 	@functools.wraps(view)
@@ -55,6 +116,22 @@ def csrf_protect(view):
 		return view(*args, **kwargs)
 	return wrapped_view
 
+def wants_columns():
+	"""Returns True if the request prefers column arrays to a list of objects"""
+	return request.accept_mimetypes.best_match(
+		   ['application/json', COLUMNS_MIMETYPE]) == COLUMNS_MIMETYPE
+
+def to_columns(rows, keys):
+	"""
+	Convert a list of rows to a dict of lists, one per key
+	keys = {response key: row key}
+	"""
+	columns = {key: [] for key in keys}
+	for row in rows:
+		for key, row_key in keys.items():
+			columns[key].append(row[row_key])
+	return columns
+
 def get_task():
 	"""
 	Returns the currently running task.
@@ -63,62 +140,480 @@ def get_task():
 	query = 'SELECT * FROM tasks ORDER BY rowid LIMIT 1'
 	return get_db().execute(query).fetchone()
 
+def task_status(task):
+	"""Returns the parts of a task shown to users as a dict"""
+	return {key: task[key] for key in ('status', 'folder', 'of_folders',
+									   'file', 'of_files', 'message')}
+
+def publish_task():
+	"""Send the current task to event streams"""
+	publish_event('task', task_status(get_task()))
+
+def publish_state():
+	"""
+	Send the current task and library generation to event streams, e.g. if
+	changed by another process
+	"""
+	publish_task()
+	publish_event('generation', get_params()['generation'])
+
 def set_task(status = 0, folder = None, of_folders = None, file = None, of_files = None, message = None):
 	"""
 	Set the currently running task.
 	Specify status = 0 (not running, default), 1 (running), -1 (error); everything else is blanked unless supplied
+	A running task can only be changed by its owner (g.task_owner)
 	"""
 	db = get_db()
 	query = ('UPDATE tasks SET '
 			 'status = ?, folder = ?, of_folders = ?, file = ?, '
-			 'of_files = ?, message = ? ')
-	db.execute(query, (status, folder, of_folders, file, of_files, message))
+			 'of_files = ?, message = ? '
+			 'WHERE status != 1 OR owner IS ?')
+	db.execute(query, (status, folder, of_folders, file, of_files, message,
+					   g.get('task_owner')))
 	db.commit()
+	publish_task()
+
+def new_task_owner():
+	"""Returns a unique name for a task's owner, identifying its process"""
+	return f'{socket.gethostname()}/{os.getpid()}/{uuid.uuid4().hex[:8]}'
 
-# Compile non-alphanumeric regex for sortable title
-non_alpha_re = re.compile('[\W_]+', re.UNICODE)
-def refresh_db(rescan = False):
+def acquire_task(owner, message = None):
 	"""
-	Scan for new videos in a separate thread and add them to the database.
-	Specify rescan = True to clear existing data and rescan all videos
+	Lease the task to owner if none is running or the running task's lease
+	has expired (its owner stopped renewing it for TASK_LEASE_TIMEOUT
+	seconds), in one statement so only one process can succeed
+	Returns False if another owner holds the lease
 	"""
+	now = time.time()
+	db = get_db()
+	query = ('UPDATE tasks SET '
+			 'status = 1, folder = NULL, of_folders = NULL, file = NULL, '
+			 'of_files = NULL, message = ?, cancel = 0, owner = ?, '
+			 'heartbeat = ? '
+			 'WHERE status != 1 OR heartbeat IS NULL OR heartbeat < ?')
+	cursor = db.execute(query, (message, owner, now,
+						now - current_app.config['TASK_LEASE_TIMEOUT']))
+	db.commit()
+	publish_task()
+	return cursor.rowcount > 0
+
+def renew_task(owner):
+	"""
+	Extend owner's lease on the running task
+	Returns False if the lease has been lost
+	"""
+	db = get_db()
+	query = ('UPDATE tasks SET heartbeat = ? '
+			 'WHERE status = 1 AND owner = ?')
+	cursor = db.execute(query, (time.time(), owner))
+	db.commit()
+	return cursor.rowcount > 0
+
+def renew_task_until(app, owner, stop):
+	"""
+	Renew owner's lease every TASK_HEARTBEAT seconds until stop (an Event)
+	is set or the lease is lost
+	"""
+	with app.app_context():
+		while not stop.wait(app.config['TASK_HEARTBEAT']):
+			try:
+				if not renew_task(owner):
+					app.logger.warning('Refresh: Lost task lease')
+					return
+			except sqlite3.OperationalError:
+				app.logger.warning('Refresh: Could not renew task lease')
+
+def owns_task():
+	"""Returns True if this context's owner (g.task_owner) holds the task"""
+	return get_task()['owner'] == g.get('task_owner')
+
+@contextmanager
+def leased_task(message):
+	"""Hold the task's lease while in this context, so no scan can start"""
+	if current_app.config['SNAPSHOT_READER']:
+		raise BlockingIOError('Snapshot readers cannot change the library')
+	owner = new_task_owner()
+	if not acquire_task(owner, message):
+		raise BlockingIOError('A task is already running, try again later')
+	g.task_owner = owner
+	stop = threading.Event()
+	threading.Thread(target = renew_task_until,
+					 args = (current_app._get_current_object(), owner, stop),
+					 daemon = True).start()
 	try:
-		# Check for running task
-		if get_task()['status'] == 1:
-			raise BlockingIOError('Refresh: A task is already running')
-	except sqlite3.OperationalError as e:
-		raise sqlite3.OperationalError('Refresh: Could not check for running tasks') from e
+		yield
+	except Exception:
+		set_task(message = f'{message} failed')
+		raise
+	else:
+		set_task(message = f'{message} complete')
+	finally:
+		stop.set()
+
+def start_scan(scan):
+	"""
+	Record the kind of scan running ('refresh' or 'rescan') so it can be
+	resumed if the server stops
+	"""
+	db = get_db()
+	db.execute('UPDATE tasks SET scan = ? WHERE owner IS ?',
+			   (scan, g.get('task_owner')))
+	db.commit()
+
+def finish_scan():
+	"""
+	Clear the running scan and the checkpoints of folders it finished
+	Folders it started but didn't finish are kept so the next scan can add
+	their missing thumbnails
+	"""
+	db = get_db()
+	db.execute('UPDATE tasks SET scan = NULL, cancel = 0 WHERE owner IS ?',
+			   (g.get('task_owner'), ))
+	db.execute('DELETE FROM scan_checkpoints WHERE done = 1')
+	db.commit()
+
+def clear_checkpoints():
+	"""Forget all folder checkpoints, e.g. when the tables they refer to go"""
+	db = get_db()
+	db.execute('DELETE FROM scan_checkpoints')
+	db.commit()
+
+def cancel_scan():
+	"""
+	Ask the running scan to stop at its next check
+	Returns False if no scan is running
+	"""
+	db = get_db()
+	cursor = db.execute('UPDATE tasks SET cancel = 1 WHERE status = 1')
+	db.commit()
+	return cursor.rowcount > 0
+
+def scan_cancelled():
+	"""
+	Returns True if the running scan has been asked to stop or has lost its
+	lease (or False if the task can't be read, so the scan carries on)
+	"""
+	try:
+		task = get_task()
+		return bool(task['cancel']) or task['owner'] != g.get('task_owner')
+	except sqlite3.OperationalError:
+		current_app.logger.warning('Refresh: Could not check for cancellation')
+		return False
+
+def get_checkpoints():
+	"""
+	Returns the relative paths of folders a scan finished, and of folders it
+	started but didn't finish, as (set of finished, set of started)
+	"""
+	finished = set()
+	started = set()
+	query = 'SELECT folder_path, done FROM scan_checkpoints'
+	for checkpoint in get_db().execute(query).fetchall():
+		if checkpoint['done']:
+			finished.add(checkpoint['folder_path'])
+		else:
+			started.add(checkpoint['folder_path'])
+	return finished, started
+
+def checkpoint_folder(folder_path, done = False):
+	"""Record that the running scan has started or finished a folder"""
+	db = get_db()
+	query = ('INSERT OR REPLACE INTO scan_checkpoints (folder_path, done) '
+			 'VALUES (?, ?)')
+	db.execute(query, (folder_path, int(done)))
+	db.commit()
+
+# .info.json fields the title, ID and upload date are derived from, stored
+# with each video so they can be derived again when settings change
+DERIVED_INFO_KEYS = ('title', 'id', 'upload_date')
+# Videos updated at once when re-deriving metadata
+REDERIVE_BATCH = 500
+
+# Variables in a filename format, optionally ending in ? to allow them to be
+# missing from filenames along with their delimiter
+format_variable_re = re.compile(r'\{(\w+)(\??)\}')
+# Values the recognised variables must have to match a filename on the first
+# try; any other text is allowed if none of the strict patterns match, and
+# is warned about when validated
+FORMAT_VARIABLE_PATTERNS = {
+	'position': r'\d+',
+	'date': r'\d{8}'
+}
+FORMAT_VARIABLES = ('title', 'position', 'id', 'date')
+
+# Filename format compiled by compile_filename_format: strict and loose are
+# regexes matching a whole filename without extension, and the delimiter and
+# variable names to split filenames that don't match
+FilenameParser = namedtuple('FilenameParser', ['filename_format', 'strict', 'loose',
+											   'delimiter', 'variables'])
+
+def filename_format_for(folder_relative, params):
+	"""
+	Returns the filename format for a folder (a path relative to disk_path):
+	its FILENAME_FORMATS override if it has one, otherwise the format in
+	settings
+	"""
+	overrides = current_app.config['FILENAME_FORMATS']
+	folder_path = str(folder_relative)
+	if folder_path in overrides:
+		return overrides[folder_path]
+	for pattern, filename_format in overrides.items():
+		if fnmatchcase(folder_path, pattern):
+			return filename_format
+	return params['filename_format']
+
+@functools.lru_cache(maxsize = 64)
+def compile_filename_format(filename_format, delimiter):
+	"""
+	Compile a filename format (e.g. "{position} - {title}") into a
+	FilenameParser, or None if the format has no variables or there's no
+	delimiter
+	Variables other than {title} can't contain the delimiter, so {title} is
+	what remains between those before and after it and may contain it
+	"""
+	if not filename_format or not delimiter:
+		return None
+	variables = format_variable_re.findall(filename_format)
+	if not variables:
+		return None
+	
+	separator = re.escape(delimiter)
+	# Any text not containing the delimiter, as runs of other characters so
+	# the delimiter is only looked for where it could start
+	first = re.escape(delimiter[0])
+	if len(delimiter) == 1:
+		field = f'[^{first}]*'
+	else:
+		field = f'[^{first}]*(?:{first}(?!{re.escape(delimiter[1:])})[^{first}]*)*'
+	# The title is the longest it can be, unless variables after it are
+	# optional and should be filled where they can be
+	names = [var for var, _ in variables]
+	after_title = variables[names.index('title') + 1:] if 'title' in names else []
+	title = '.*?' if any(optional for _, optional in after_title) else '.*'
+	
+	def build(strict):
+		named = set()
+		pattern = ''
+		# Whether the next variable is separated from the one before it
+		separated = False
+		for index, (var, optional) in enumerate(variables):
+			if var == 'title':
+				value = title
+			elif strict and var in FORMAT_VARIABLE_PATTERNS:
+				value = FORMAT_VARIABLE_PATTERNS[var]
+			else:
+				value = field
+			# Only the first of each recognised variable is kept, e.g. {skip}
+			# can appear several times
+			if var in FORMAT_VARIABLES and var not in named:
+				named.add(var)
+				value = f'(?P<{var}>{value})'
+			
+			if not optional:
+				pattern += (separator if separated else '') + value
+				separated = True
+			elif not separated and index < len(variables) - 1:
+				# Leading variables are missing along with the delimiter
+				# after them
+				pattern += f'(?:{value}{separator})?'
+			else:
+				pattern += f"(?:{separator if separated else ''}{value})?"
+				separated = True
+		return re.compile(pattern, re.DOTALL)
+	
+	return FilenameParser(filename_format, build(True), build(False),
+						  delimiter, tuple(names))
+
+def parse_filename(stem, parser):
+	"""
+	Match a filename without extension to a FilenameParser
+	Values that aren't the type expected only match if nothing else does,
+	e.g. {date?} is left out rather than matching a word
+	Returns ({variable: value}, warning), warning None if the filename matched
+	Missing optional variables have the value None
+	Filenames that don't match keep the variables that could be split from
+	them: those before {title} from the left, then those after it from the
+	right. The title is left as the whole filename
+	"""
+	match = parser.strict.fullmatch(stem) or parser.loose.fullmatch(stem)
+	if match is not None:
+		return match.groupdict(), None
+	
+	parts = stem.split(parser.delimiter)
+	variables = parser.variables
+	if 'title' in variables:
+		before = variables[:variables.index('title')]
+		after = variables[variables.index('title') + 1:]
+	else:
+		before = variables
+		after = ()
+	split = list(zip(before, parts))
+	# Don't reuse parts split from the left
+	split += reversed(list(zip(reversed(after), reversed(parts[len(split):]))))
+	filename_metadata = {}
+	for var, value in split:
+		# Only the first of each is kept, as when matched
+		if var in FORMAT_VARIABLES and var != 'title':
+			filename_metadata.setdefault(var, value)
+	return filename_metadata, 'Filename does not match filename format "' + parser.filename_format + '": "' + stem + '"'
+
+def derive_metadata(stem, info, params, parser):
+	"""
+	Derive a video's title, sort title, position, ID and upload date from its
+	filename without extension and the DERIVED_INFO_KEYS from its .info.json
+	(info, a dict), using the filename settings in params and the folder's
+	FilenameParser from compile_filename_format
+	Reads nothing from disk, so metadata can be derived again from what was
+	stored when scanned
+	Returns (dict of fields, list of warnings)
+	"""
+	warnings = []
+	video = {'title': stem, 'position': None, 'id': None, 'upload_date': None}
+	
+	if parser is not None:
+		filename_metadata, warning = parse_filename(stem, parser)
+		if warning:
+			warnings.append(warning)
+		
+		# Match and validate remainder of metadata
+		for key, value in filename_metadata.items():
+			if value is None:
+				continue
+			elif key == 'title':
+				video['title'] = str(value)
+			
+			elif key == 'position':
+				try:
+					video['position'] = int(value)
+				except ValueError:
+					warnings.append('Filename variable {position} is not an integer: "' + str(value) + '"')
+			
+			elif key == 'id':
+				video['id'] = str(value)
+			
+			elif key == 'date':
+				try:
+					video['upload_date'] = parse_upload_date(value)
+				except ValueError:
+					warnings.append('Filename variable {date} is not in YYYYMMDD format: "' + str(value) + '"')
+	
+	# Optionally replace " _ " with " - " (assuming unsafe character was used as separator) then remove remaining underscores
+	if params['replace_underscores']:
+		video['title'] = video['title'].replace(' _ ', ' - ').replace('_', '')
+	
+	# Replace fallbacks with json keys, if they exist
+	for key in ('id', 'title'):
+		video[key] = str(info.get(key)) if info.get(key) else video[key]
+	try:
+		video['upload_date'] = parse_upload_date(info.get('upload_date')) if info.get('upload_date') else video['upload_date']
+	except ValueError:
+		warnings.append('Metadata field "upload_date" is not in YYYYMMDD format: "' + str(info.get('upload_date')) + '"')
+	
+	video['sort_title'] = sort_key(video['title'])
+	return video, warnings
+
+def parse_upload_date(value):
+	"""
+	Converts a YYYYMMDD date to seconds since epoch at midnight UTC, so it's
+	the same day wherever it's shown
+	Raises ValueError if it isn't a date
+	"""
+	date = datetime.strptime(str(value), '%Y%m%d')
+	return int(date.replace(tzinfo = timezone.utc).timestamp())
+
+def derive_folder_name(folder_relative, params):
+	"""Returns the name shown for a folder from its path relative to disk_path"""
+	if not folder_relative.parts: # Path('.').parts == ()
+		return 'Root folder'
+	folder_name = folder_relative.name
+	if params['replace_underscores']:
+		folder_name = folder_name.replace(' _ ', ' - ').replace('_', ' ')
+	return folder_name
+
+def refresh_db(rescan = False, resume = False, workers = None, folders = None):
+	"""
+	Scan for new videos in a separate thread and add them to the database.
+	Specify rescan = True to rescan all videos into new tables and replace
+	existing data once complete
+	Specify folders as {folder path relative to disk_path: set of changed file
+	stems} to only scan those folders, re-reading videos already in the
+	library whose files changed (e.g. .info.json written after the video)
+	Specify resume = True to continue an interrupted scan from its
+	checkpoints, skipping the folders it finished (the caller must already
+	hold the task's lease as g.task_owner)
+	Specify workers to limit how many files are probed or have frames
+	extracted at once (defaults to SCAN_WORKERS and POSTER_WORKERS)
+	"""
+	if rescan and folders is not None:
+		raise ValueError('Refresh: Cannot rescan only some folders')
+	if current_app.config['SNAPSHOT_READER']:
+		raise BlockingIOError('Refresh: Snapshot readers cannot scan, refresh '
+							  'from the server that publishes them')
+	
+	if resume:
+		owner = g.task_owner
+	else:
+		owner = new_task_owner()
+		# Lease the task before starting the thread so no other request or
+		# worker process can start another
+		try:
+			if not acquire_task(owner, 'Initialising refresh'):
+				raise BlockingIOError('Refresh: A task is already running')
+		except sqlite3.OperationalError as e:
+			# Fail if can't set lock
+			raise sqlite3.OperationalError('Refresh: Could not lock task') from e
+	
+	app = current_app._get_current_object()
+	with app.app_context():
+		g.task_owner = owner
+		try:
+			start_scan('rescan' if rescan else 'refresh')
+		except sqlite3.OperationalError as e:
+			set_task(status = -1, message = 'Database error')
+			raise sqlite3.OperationalError('Refresh: Could not start scan') from e
 	
 	def run_refresh_db(rescan):
-		app = current_app._get_current_object()
 		with app.app_context():
+			g.task_owner = owner
 			db = get_db()
 			try:
 				params = get_params()
 			except sqlite3.OperationalError as e:
 				raise sqlite3.OperationalError('Refresh: Could not get settings') from e
 			
-			# Lock running task
 			try:
-				set_task(status = 1, message = 'Initialising refresh')
+				finished_folders, started_folders = get_checkpoints()
 			except sqlite3.OperationalError as e:
-				# Fail if can't set lock
-				raise sqlite3.OperationalError('Refresh: Could not lock task') from e
+				raise sqlite3.OperationalError('Refresh: Could not read scan checkpoints') from e
+			if not resume:
+				# Only an interrupted scan skips the folders it finished
+				finished_folders = set()
 			
 			if rescan:
-				app.logger.debug('Full rescan, clearing tables')
-				# Clear existing videos and folders
+				# Scan into empty copies of the library tables, leaving the
+				# existing library browsable until they replace it
 				try:
-					db.execute('DELETE FROM videos')
-					db.execute('DELETE FROM folders')
+					if resume and resume_shadow_tables():
+						app.logger.debug('Resuming rescan into shadow tables')
+					else:
+						app.logger.debug('Full rescan, building shadow tables')
+						create_shadow_tables()
+						clear_checkpoints()
+						finished_folders = set()
+						started_folders = set()
 				except sqlite3.OperationalError as e:
-					raise sqlite3.OperationalError('Refresh: Could not clear existing data') from e
-				else:
-					db.commit()
+					raise sqlite3.OperationalError('Refresh: Could not create shadow tables') from e
 			
 			with_warnings = False
 			new_folders = 0
 			new_videos = 0
+			updated_videos = 0
+			removed_folders = 0
+			removed_videos = 0
+			reclaimed_rows = 0
+			reclaimed_bytes = 0
+			# Folders in the library with no videos left on disk
+			empty_folders = []
 			
 			# Prepare thumbnail conversion
 			generate_thumbs = False
@@ -139,16 +634,12 @@ def refresh_db(rescan = False):
 					# THUMBNAIL_QUALITY is integer 1-95
 					# THUMBNAIL_FORMATS is a dict of formats
 					# Check for Pillow support for desired image formats
-					pillow_features = features.get_supported_codecs() + features.get_supported_modules()
-					# Supported if in pillow features and has matching MIME
-					# type in THUMBNAIL_EXTENSIONS
-					supported_formats = {key: value for key, value in tf.items() if (key in pillow_features and '.' + str(key) in te)}
+					# Lazy-only formats are only generated when requested
+					supported_formats = {key: value for key, value in supported_thumbnail_formats().items() if not value.get('lazy')}
 					
 					if len(supported_formats) > 0:
 						# At least one format supported
 						generate_thumbs = True
-						# All formats (inc unsupported) default to no data
-						thumbs_to_generate = []
 						app.logger.debug('Generating thumbnails: ' + str(', '.join(supported_formats.keys())))
 					else:
 						with_warnings = True
@@ -158,26 +649,14 @@ def refresh_db(rescan = False):
 					app.logger.warning('Thumbnail generation disabled: config.py THUMBNAIL_SIZE must be integer maxwidth, maxheight; THUMBNAIL_QUALITY must be integer 1-95; THUMBNAIL_EXTENSIONS and THUMBNAIL_QUALITY must be dicts')
 			
 			# Prepare filename parsing
-			filename_parsing = False
-			if params['filename_format'] and params['filename_delimiter']:
-				filename_format = re.findall(r'\{\w+\}', params['filename_format'])
-				if len(filename_format) > 0:
-					app.logger.debug('Filename format present, will try to parse for metadata')
-					filename_parsing = True
-					
-					title_position = None
-					# Is {title} present?
-					if '{title}' in filename_format:
-						app.logger.debug('{title} present in format, will split both sides')
-						# Yes, slice format on either side to later split from left and right
-						title_position = filename_format.index('{title}')
-						
-						before_title = filename_format[:title_position]
-						after_title = filename_format[title_position + 1:]
+			if params['filename_format'] or app.config['FILENAME_FORMATS']:
+				app.logger.debug('Filename format present, will try to parse for metadata')
 			
 			db_folders = None
-			if not rescan:
-				app.logger.debug('Refresh only')
+			if not rescan or resume:
+				# Folders already in the library, or in the shadow tables if
+				# resuming a rescan
+				app.logger.debug('Refresh only' if not rescan else 'Resuming rescan')
 				try:
 					db_folders = list_folders()
 				except sqlite3.OperationalError as e:
@@ -201,19 +680,84 @@ def refresh_db(rescan = False):
 				finally:
 					raise FileNotFoundError('Refresh: Disk path does not exist')
 			
-			# List folders and subfolders on disk, including root
-			disk_folders = [subfolder for subfolder in basepath.glob('**/')]
+			# Extract poster frames for videos without thumbnails with ffmpeg
+			poster_pool = None
+			if generate_thumbs and app.config['POSTER_FRAMES']:
+				ffmpeg = shutil.which(app.config['FFMPEG_PATH'])
+				if ffmpeg is not None:
+					# Each job waits on one ffmpeg process
+					poster_pool = ThreadPoolExecutor(max_workers = workers or app.config['POSTER_WORKERS'])
+				else:
+					with_warnings = True
+					app.logger.warning('Poster frames enabled but ffmpeg not found at "' + app.config['FFMPEG_PATH'] + '"')
+			
+			# Read missing metadata from video headers in the background
+			scan_pool = None
+			if app.config['PROBE_VIDEOS']:
+				scan_pool = ThreadPoolExecutor(max_workers = workers or app.config['SCAN_WORKERS'])
+			
+			if folders is None:
+				# List folders and subfolders on disk, including root
+				disk_folders = [subfolder for subfolder in basepath.glob('**/')]
+			else:
+				# Only the folders that changed, if they still exist
+				disk_folders = [basepath.joinpath(folder) for folder in sorted(folders) if basepath.joinpath(folder).is_dir()]
 			folder_count = len(disk_folders)
 			app.logger.debug('Found folders: ' + str(disk_folders))
 			
+			def queue_thumbnail(video_id, file, thumb_path, duration):
+				"""Queue a video's thumbnail, or a frame from it if it has none, to convert"""
+				if thumb_path is not None:
+					if not app.config['LAZY_THUMBNAILS']:
+						thumbs_to_generate.append(
+									{'id': video_id,
+									 'path': thumb_path,
+									 'data': {}})
+				elif poster_pool is not None:
+					# Start extracting a frame to convert later
+					offset = app.config['POSTER_OFFSET']
+					if duration:
+						# Stay within short videos
+						offset = min(offset, duration / 2)
+					# Frame at the largest thumbnail size
+					max_scale = max(app.config['THUMBNAIL_SCALES'])
+					frame_size = [side * max_scale for side in app.config['THUMBNAIL_SIZE']]
+					thumbs_to_generate.append(
+								{'id': video_id,
+								 'path': file,
+								 'poster': poster_pool.submit(extract_poster, file, offset, frame_size, ffmpeg, app.config['POSTER_TIMEOUT']),
+								 'data': {}})
+			
+			# Work queued for the folder being scanned
+			probes = {}
+			thumbs_to_generate = []
+			cancelled = False
+			
 			# Scan each folder for video files
 			for folder_index, folder in enumerate(disk_folders):
+				# DB stores folder paths relative to basepath
+				folder_relative = folder.relative_to(basepath)
+				if str(folder_relative) in finished_folders:
+					app.logger.debug('Skipping folder finished before the scan was interrupted: "' + str(folder) + '"')
+					continue
+				# Stop between folders if cancelled
+				if scan_cancelled():
+					cancelled = True
+					break
+				
 				app.logger.debug('Scanning folder #' + str(folder_index + 1) + ' of ' + str(folder_count) + ': "' + str(folder) + '"')
 				try:
 					set_task(status = 1, folder = folder_index + 1, of_folders = folder_count, message = 'Scanning folder')
+					checkpoint_folder(str(folder_relative))
 				except sqlite3.OperationalError:
 					app.logger.warning('Refresh: Could not update task status')
 				
+				# Videos changed in the folder, to rank them again
+				folder_changes = new_videos + updated_videos + removed_videos
+				
+				# Compiled once per format, then one match per file
+				filename_parser = compile_filename_format(filename_format_for(folder_relative, params), params['filename_delimiter'])
+				
 				files = []
 				thumbnails = []
 				metadatas = []
@@ -230,18 +774,22 @@ def refresh_db(rescan = False):
 						if file.name.endswith(app.config['METADATA_EXTENSION']):
 							metadatas.append(file)
 				
+				if not files and db_folders and str(folder_relative) in db_folders:
+					# Every video in the folder was removed
+					empty_folders.append(db_folders[str(folder_relative)])
+				
 				if len(files) > 0:
 					# Found video files
 					app.logger.debug('Found ' + str(len(files)) + ' files')
+					# Videos in the library to re-read, {filename: ID}
+					stale_videos = {}
 					# Check if the folder exists in the database, if the database has folders
-					# DB stores folder paths relative to basepath so use that to compare
-					folder_relative = folder.relative_to(basepath)
-					if not rescan and (db_folders and str(folder_relative) in db_folders):
+					if db_folders and str(folder_relative) in db_folders:
 						folder_id = db_folders[str(folder_relative)]
 						app.logger.debug('Found existing folder at ID ' + str(folder_id))
 						# Folder exists, get previously-scanned videos from database by folder ID
 						try:
-							db_files = list_videos(folder_id)
+							db_files = list_video_files(folder_id)
 						except sqlite3.OperationalError as e:
 							try:
 								set_task(status = -1, message = 'Database error')
@@ -250,12 +798,39 @@ def refresh_db(rescan = False):
 							finally:
 								raise sqlite3.OperationalError('Refresh: Could not list videos from database') from e
 												
+						on_disk = set(file.name for file in files)
+						# Re-read videos whose files changed since they were added
+						if folders:
+							changed = folders.get(str(folder_relative), set())
+							stale_videos = {file['filename']: file['id'] for file in db_files if file['filename'] in on_disk and Path(file['filename']).stem in changed}
+							if stale_videos:
+								app.logger.debug('Re-reading ' + str(len(stale_videos)) + ' changed videos')
+						
+						# Videos no longer on disk
+						missing = [file for file in db_files if file['filename'] not in on_disk]
 						# Extract a list of filenames
-						db_files = [file['filename'] for file in db_files]
+						db_files = [file['filename'] for file in db_files if file['filename'] in on_disk and file['filename'] not in stale_videos]
 						# Remove previously-scanned videos from file list
 						# DB stores filename alone so remove path to compare
 						files[:] = [file for file in files if file.name not in db_files]
 						
+						if missing:
+							# A new file with a missing video's modification time
+							# was renamed, so re-read it and keep its ID
+							renamed = match_renames(missing, files)
+							stale_videos.update(renamed)
+							missing = [file['id'] for file in missing if file['id'] not in renamed.values()]
+							app.logger.debug('Folder has ' + str(len(renamed)) + ' renamed and ' + str(len(missing)) + ' removed videos')
+							try:
+								rows, size = remove_videos(missing)
+							except sqlite3.OperationalError as e:
+								with_warnings = True
+								app.logger.warning('Refresh: Could not remove missing videos from "' + str(folder_relative) + '": ' + str(e))
+							else:
+								removed_videos += len(missing)
+								reclaimed_rows += rows
+								reclaimed_bytes += size
+						
 						new_video_count = len(files)
 						app.logger.debug('Folder previously seen, ' + str(new_video_count) + ' new files')
 						
@@ -270,12 +845,7 @@ def refresh_db(rescan = False):
 					else:
 						app.logger.debug('Adding new folder to database')
 						# Folder does not exist or starting from scratch, add to database
-						if not folder_relative.parts: # Path('.').parts == ()
-							folder_name = 'Root folder'
-						else:
-							folder_name = folder.name
-							if params['replace_underscores']:
-								folder_name = folder_name.replace(' _ ', ' - ').replace('_', ' ')
+						folder_name = derive_folder_name(folder_relative, params)
 						
 						# All videos are unseen
 						new_video_count = len(files)
@@ -291,9 +861,30 @@ def refresh_db(rescan = False):
 						else:
 							new_folders += 1
 					
+					if generate_thumbs and str(folder_relative) in started_folders:
+						# Scan stopped part way through this folder before its
+						# thumbnails were converted
+						try:
+							unconverted = list_videos_without_thumbs(folder_id)
+						except sqlite3.OperationalError:
+							with_warnings = True
+							app.logger.warning('Refresh: Could not list videos without thumbnails in "' + str(folder_relative) + '"')
+						else:
+							for video in unconverted:
+								queue_thumbnail(video['id'], folder.joinpath(video['filename']), folder.joinpath(video['thumbnail']) if video['thumbnail'] else None, video['duration'])
+					
+					# Start probing new videos while the rest of their metadata is read
+					probes = {}
+					if scan_pool is not None:
+						probes = {file: scan_pool.submit(probe, file) for file in files}
+					
 					# Iterate through the subfolder's files
 					for file_index, file in enumerate(files):
 						if file_index % 10 == 0:
+							# Stop between batches if cancelled
+							if file_index > 0 and scan_cancelled():
+								cancelled = True
+								break
 							# Update task every 10 files
 							try:
 								set_task(status = 1, folder = folder_index + 1, of_folders = folder_count, file = file_index + 1, of_files = new_video_count, message = 'Scanning for new videos')
@@ -307,11 +898,7 @@ def refresh_db(rescan = False):
 						
 						# Default to basic metadata
 						video['filename'] = file.name
-						# Title defaults to filename without extension
-						video['title'] = file.stem
-						# Optionally replace " _ " with " - " (assuming unsafe character was used as separator) then remove remaining underscores
-						if params['replace_underscores']:
-							video['title'] = video['title'].replace(' _ ', ' - ').replace('_', '')
+						video['sort_filename'] = sort_key(file.name)
 						# MIME type defaults to extension mapping from config
 						video['video_format'] = None
 						try:
@@ -320,7 +907,7 @@ def refresh_db(rescan = False):
 							with_warnings = True
 							app.logger.warning('Refresh: Did not recognise video extension "' + file.suffix + '", add with its MIME type to config.py')
 						# Modification time from file (local time)
-						video['modification_time'] = datetime.fromtimestamp(file.stat().st_mtime)
+						video['modification_time'] = int(file.stat().st_mtime)
 						
 						# Match thumbnail
 						video['thumbnail'] = None
@@ -354,88 +941,10 @@ def refresh_db(rescan = False):
 								metadata = meta
 						
 						# Rest of metadata defaults to None
-						video.update(dict.fromkeys(['position', 'playlist_index', 'id', 'webpage_url', 'description', 'upload_date', 'uploader', 'uploader_url', 'duration', 'view_count', 'like_count', 'dislike_count', 'average_rating', 'categories', 'tags', 'height', 'vcodec', 'fps'], None))
-						
-						# Parse filename format if format & delimiter params are present
-						if filename_parsing:
-							# dict replaces duplicates but this doesn't affect the param count e.g. if multiple {skip} are present
-							filename_metadata = {}
-							if title_position is not None: # (can be 0)
-								# {title} present: since it may contain the delimiter, we split out the rest of the variables and keep what remains as the title
-								# Split filename without extension from left, keep # of vars from before_title
-								left_split = file.stem.split(params['filename_delimiter'])[:len(before_title)]
-								# If format only contains {title}, skip the right split as [-0:] would return the entire list
-								right_split = []
-								if len(filename_format) > 1:
-									# Split from right, keep # of vars from after_title
-									right_split = file.stem.rsplit(params['filename_delimiter'])[-len(after_title):]
-								
-								if len(before_title) == len(left_split):
-									for index, var in enumerate(before_title):
-										filename_metadata[var] = left_split[index]
-									
-									# Only split right if successfully split left
-									if len(after_title) == len(right_split):
-										for index, var in enumerate(after_title):
-											filename_metadata[var] = right_split[index]
-										
-										# Finally split title
-										# Split off everything left of title and keep the remainder
-										title_split = file.stem.split(params['filename_delimiter'], len(before_title))[-1]
-										# Split off everything right of title and keep the remainder
-										title_split = title_split.rsplit(params['filename_delimiter'], len(after_title))[0]
-										filename_metadata['{title}'] = title_split
-										
-									else:
-										with_warnings = True
-										app.logger.warning('Refresh: Filename format does not match filename: right of {title} expected ' + str(len(after_title)) + ' variable(s), got ' + str(len(right_split)))
-								else:
-									with_warnings = True
-									app.logger.warning('Refresh: Filename format does not match filename: left of {title} expected ' + str(len(before_title)) + ' variable(s), got ' + str(len(left_split)))
-							
-							else:
-								# {title} not present: simple split
-								left_split = file.stem.split(params['filename_delimiter'])
-								
-								if len(left_split) == len(filename_format):
-									for index, var in enumerate(filename_format):
-										filename_metadata[var] = left_split[index]
-								
-								else:
-									with_warnings = True
-									app.logger.warning('Refresh: Filename format does not match filename: expected ' + str(len(filename_format)) + ' variable(s), got ' + str(len(left_split)))
-								
-							# Match and validate remainder of metadata
-							# Won't run on an empty list if parsing failed with/without title
-							for key, value in filename_metadata.items():
-								if key == '{title}':
-									video['title'] = str(value)
-									# Optionally replace " _ " with " - " (assuming unsafe character was used as separator) then remove remaining underscores
-									if params['replace_underscores']:
-										video['title'] = video['title'].replace(' _ ', ' - ').replace('_', '')
-								
-								elif key == '{position}':
-									try:
-										video['position'] = int(value)
-									except ValueError:
-										with_warnings = True
-										app.logger.warning('Refresh: Filename variable {position} is not an integer: "' + str(value) + '"')
-								
-								elif key == '{id}':
-									try:
-										video['id'] = str(value)
-									except ValueError:
-										with_warnings = True
-										app.logger.warning('Refresh: Filename variable {id} is not a string')
-								
-								elif key == '{date}':
-									try:
-										video['upload_date'] = datetime.strptime(str(value), '%Y%m%d')
-									except ValueError:
-										with_warnings = True
-										app.logger.warning('Refresh: Filename variable {date} is not in YYYYMMDD format: "' + str(value) + '"')
+						video.update(dict.fromkeys(['playlist_index', 'webpage_url', 'description', 'uploader', 'uploader_url', 'duration', 'view_count', 'like_count', 'dislike_count', 'average_rating', 'categories', 'tags', 'height', 'vcodec', 'fps'], None))
 						
 						# Try to parse .info.json
+						mj = {}
 						if metadata:
 							try:
 								with open(metadata) as f:
@@ -444,150 +953,463 @@ def refresh_db(rescan = False):
 								app.logger.warning('Refresh: Could not open metadata file "' + metadata.name + '"')
 							except json.JSONDecodeError as e:
 								app.logger.warning('Refresh: Could not parse metadata file "' + metadata.name + '"')
-							else:
-								# Replace fallbacks with json keys, if they exist
-								# Validate ints
-								for key in ('playlist_index', 'duration', 'view_count', 'like_count', 'dislike_count', 'height'):
-									try:
-										video[key] = int(mj.get(key)) if mj.get(key) else video[key]
-									except ValueError:
-										with_warnings = True
-										app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not an integer: "' + str(mj.get(key)) + '"')
-								
-								# Validate floats
-								for key in ('average_rating', 'fps'):
-									try:
-										video[key] = float(mj.get(key)) if mj.get(key) else video[key]
-									except ValueError:
-										with_warnings = True
-										app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not numeric: "' + str(mj.get(key)) + '"')
-								
-								# Validate strings
-								for key in ('id', 'webpage_url', 'title', 'description', 'uploader', 'uploader_url', 'vcodec'):
-									video[key] = str(mj.get(key)) if mj.get(key) else video[key]
-								
-								# Validate lists
-								for key in ('categories', 'tags'):
-									try:
-										video[key] = json.dumps(mj.get(key)) if mj.get(key) else video[key]
-									except TypeError:
-										with_warnings = True
-										app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not a list: "' + str(mj.get(key)) + '"')
-								
-								# Validate weirdos
+						
+						# Keep what the title, position, ID and date are derived
+						# from, to derive them again if the settings change
+						raw_info = {key: mj[key] for key in DERIVED_INFO_KEYS if mj.get(key)}
+						video['raw_info'] = json.dumps(raw_info, separators = (',', ':'))
+						derived, warnings = derive_metadata(file.stem, raw_info, params, filename_parser)
+						video.update(derived)
+						for warning in warnings:
+							with_warnings = True
+							app.logger.warning('Refresh: ' + warning)
+						
+						if mj:
+							# Replace fallbacks with json keys, if they exist
+							# Validate ints
+							for key in ('playlist_index', 'duration', 'view_count', 'like_count', 'dislike_count', 'height'):
 								try:
-									video['upload_date'] = datetime.strptime(str(mj.get('upload_date')), '%Y%m%d') if mj.get('upload_date') else video['upload_date']
+									video[key] = int(mj.get(key)) if mj.get(key) else video[key]
 								except ValueError:
 									with_warnings = True
-									app.logger.warning('Refresh: Metadata field "upload_date" is not in YYYYMMDD format: "' + str(mj.get('upload_date')) + '"')
-								
-								# Map extension to MIME type from config
-								if mj.get('ext'):
-									try:
-										video['video_format'] = app.config['VIDEO_EXTENSIONS']['.' + mj.get('ext')]
-									except KeyError:
-										with_warnings = True
-										app.logger.warning('Refresh: Metadata field "extension" unrecognised: ".' + str(mj.get('ext')) + '" (add with its MIME type to config.py)')
+									app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not an integer: "' + str(mj.get(key)) + '"')
+							
+							# Validate floats
+							for key in ('average_rating', 'fps'):
+								try:
+									video[key] = float(mj.get(key)) if mj.get(key) else video[key]
+								except ValueError:
+									with_warnings = True
+									app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not numeric: "' + str(mj.get(key)) + '"')
+							
+							# Validate strings
+							for key in ('webpage_url', 'description', 'uploader', 'uploader_url', 'vcodec'):
+								video[key] = str(mj.get(key)) if mj.get(key) else video[key]
+							
+							# Validate lists
+							for key in ('categories', 'tags'):
+								try:
+									video[key] = json.dumps(mj.get(key)) if mj.get(key) else video[key]
+								except TypeError:
+									with_warnings = True
+									app.logger.warning('Refresh: Metadata field "' + str(key) + '" is not a list: "' + str(mj.get(key)) + '"')
+							
+							# Map extension to MIME type from config
+							if mj.get('ext'):
+								try:
+									video['video_format'] = app.config['VIDEO_EXTENSIONS']['.' + mj.get('ext')]
+								except KeyError:
+									with_warnings = True
+									app.logger.warning('Refresh: Metadata field "extension" unrecognised: ".' + str(mj.get('ext')) + '" (add with its MIME type to config.py)')
 						
-						# Strip non-alphanumeric from title for sorting
-						video['sort_title'] = non_alpha_re.sub('', video['title'])
+						# Fill anything still missing from the video's headers
+						if file in probes:
+							try:
+								probed = probes.pop(file).result()
+							except OSError as e:
+								with_warnings = True
+								app.logger.warning('Refresh: Could not read video headers of "' + file.name + '": ' + str(e))
+							else:
+								for key, value in probed.items():
+									if video[key] is None:
+										video[key] = value
 						
 						# Add to database
 						app.logger.debug('Adding video #' + str(file_index + 1) + ': "' + str(video['title']) + '"')
 						try:
-							video_id = add_video(video)
+							if file.name in stale_videos:
+								video_id = replace_video(stale_videos[file.name], video)
+							else:
+								video_id = add_video(video)
 						except sqlite3.OperationalError as e:
 							with_warnings = True
 							app.logger.warning('Refresh: Could not add video "' + video['filename'] + '" to the database: ' + str(e))
 						else:
-							new_videos += 1
-							if (generate_thumbs and video['thumbnail'] is not None):
-								# Queue thumbnail for conversion
-								thumbs_to_generate.append(
-											{'id': video_id,
-											 'path': video['thumb_path'],
-											 'data': {}})
-			
-			# Generate small thumbnails
-			if generate_thumbs:
-				total_thumbs = len(thumbs_to_generate)
-				if total_thumbs > 0:
-					for thumb_index, thumb in enumerate(thumbs_to_generate):
-						if thumb_index % 5 == 0:
-							# Update task every 5 thumbnails
-							try:
-								set_task(status = 1, folder = 0, of_folders = 0, file = thumb_index + 1, of_files = total_thumbs, message = 'Generating thumbnails')
-							except sqlite3.OperationalError:
-								with_warnings = True
-								app.logger.warning('Refresh: Could not update task status')
-						
-						try:
-							# Read thumbnail file
-							with Image.open(basepath.joinpath(thumb['path'])) as img:
-								if img.mode != 'RGB':
-									# Just in case
-									img = img.convert('RGB')
-								# Shrink if over max, maintaining aspect ratio
-								img.thumbnail(app.config['THUMBNAIL_SIZE'])
-								# Export each supported format
-								for fmt in supported_formats:
-									# New empty stream
-									stream = BytesIO()
-									try:
-										# method is only used by webp: 0 (fast) - 6 (slow)
-										img.save(stream, format = supported_formats[fmt]['export_format'], quality = app.config['THUMBNAIL_QUALITY'], method = 2)
-									except OSError as e:
-										with_warnings = True
-										app.logger.warning('Could not save thumbnail: ' + str(e))
-									else:
-										# Encode format as base64 data: URL
-										ext = '.' + str(fmt)
-										mime = app.config['THUMBNAIL_EXTENSIONS'][ext]
-										thumb['data'][fmt] = (
-											'data:' + mime + ';base64,' + 
-											base64.encodebytes(
-												stream.getvalue()
-											).decode('ascii')
-										)
-										app.logger.debug('Created ' + str(fmt) + ' thumbnail for video ID ' + str(thumb['id']))
-						except OSError as e:
-							with_warnings = True
-							app.logger.warning('Could not open thumbnail: ' + str(e))
-						
-					# Add thumbs to database
+							if file.name in stale_videos:
+								updated_videos += 1
+							else:
+								new_videos += 1
+							if generate_thumbs:
+								queue_thumbnail(video_id, file, video.get('thumb_path'), video['duration'])
+				
+				# A scan stopped part way through this folder may have changed
+				# it without ranking it again
+				if (new_videos + updated_videos + removed_videos != folder_changes or
+					str(folder_relative) in started_folders):
 					try:
-						set_task(status = 1, message = 'Adding thumbnails to database')
-					except sqlite3.OperationalError:
+						rank_folders([folder_id])
+					except sqlite3.OperationalError as e:
 						with_warnings = True
-						app.logger.warning('Refresh: Could not update task status')
-					
-					for thumb in thumbs_to_generate:
-						for fmt, data in thumb['data'].items():
-							try:
-								add_thumbnail(thumb['id'], fmt, data)
-							except sqlite3.OperationalError:
-								with_warnings = True
-								app.logger.warning('Could not add ' + fmt + ' thumbnail for video ID ' + str(thumb['id']) + ' to database')
+						app.logger.warning('Refresh: Could not sort videos in "' + str(folder_relative) + '": ' + str(e))
 				
+				if cancelled:
+					break
+				
+				# Convert the folder's thumbnails before moving on, so it's
+				# finished if the scan is interrupted
+				if thumbs_to_generate:
+					thumb_warnings, cancelled = convert_thumbnails(thumbs_to_generate, supported_formats, basepath, folder_index + 1, folder_count)
+					with_warnings = with_warnings or thumb_warnings
+					if cancelled:
+						break
+					thumbs_to_generate = []
+				
+				try:
+					checkpoint_folder(str(folder_relative), done = True)
+				except sqlite3.OperationalError:
+					with_warnings = True
+					app.logger.warning('Refresh: Could not record scan checkpoint for "' + str(folder_relative) + '"')
+			
+			if not cancelled and db_folders:
+				if folders is None:
+					# Folders removed from disk, if all were listed
+					disk_paths = set(str(folder.relative_to(basepath)) for folder in disk_folders)
+					empty_folders += [id for path, id in db_folders.items() if path not in disk_paths]
+				if empty_folders:
+					try:
+						videos, rows, size = remove_folders(empty_folders)
+					except sqlite3.OperationalError as e:
+						with_warnings = True
+						app.logger.warning('Refresh: Could not remove empty folders: ' + str(e))
+					else:
+						removed_folders += len(empty_folders)
+						removed_videos += videos
+						reclaimed_rows += rows
+						reclaimed_bytes += size
+			
+			if cancelled:
+				# Drop work queued for the folder being scanned
+				for future in probes.values():
+					future.cancel()
+				for thumb in thumbs_to_generate:
+					if 'poster' in thumb:
+						thumb['poster'].cancel()
+			if scan_pool is not None:
+				scan_pool.shutdown()
+			if poster_pool is not None:
+				poster_pool.shutdown(wait = False)
+			
+			try:
+				lost_task = not owns_task()
+			except sqlite3.OperationalError:
+				lost_task = False
+			if lost_task:
+				# Another process took over after the lease expired, and may
+				# be resuming into the same tables
+				app.logger.warning('Refresh: Lost task lease to another process, stopping')
+				return
+			
+			if rescan and cancelled:
+				# Keep the existing library
+				try:
+					drop_shadow_tables()
+					clear_checkpoints()
+				except sqlite3.OperationalError:
+					app.logger.error('Refresh: Could not drop shadow tables')
+				new_folders = 0
+				new_videos = 0
+			elif rescan:
+				# Replace the library with the rescanned one
+				try:
+					swap_shadow_tables()
+				except sqlite3.OperationalError as e:
+					with_warnings = True
+					app.logger.error('Refresh: Could not replace library with rescanned one: ' + str(e))
+					try:
+						drop_shadow_tables()
+					except sqlite3.OperationalError:
+						app.logger.error('Refresh: Could not drop shadow tables')
+			
+			if not cancelled:
+				# Rank folders scanned before ranks were kept, or for sort
+				# columns added since
+				try:
+					rank_folders(unranked_folders())
+				except sqlite3.OperationalError as e:
+					with_warnings = True
+					app.logger.warning('Refresh: Could not sort videos: ' + str(e))
+			
+			# Library changed, so rebuild sprite sheets when next requested
+			if ((rescan and not cancelled) or new_folders > 0 or new_videos > 0 or
+				updated_videos > 0 or removed_folders > 0 or removed_videos > 0):
+				try:
+					bump_generation()
+				except sqlite3.OperationalError:
+					app.logger.error('Refresh: Could not update library generation')
+			
+			if not cancelled and folders is None:
+				# Clear out anything left behind by removed videos
+				try:
+					rows, size = purge_orphans()
+				except sqlite3.OperationalError as e:
+					with_warnings = True
+					app.logger.warning('Refresh: Could not purge orphaned thumbnails: ' + str(e))
 				else:
-					app.logger.info('No thumbnails to generate')
+					reclaimed_rows += rows
+					reclaimed_bytes += size
 			
-			# Update last_refreshed (milliseconds since epoch in UTC)
+			# Update last_refreshed (milliseconds since epoch in UTC) and
+			# have the scheduler plan the next refresh from now, unless only
+			# some folders were scanned
 			try:
-				db.execute('UPDATE params SET last_refreshed = ?', (datetime.now().replace(tzinfo=timezone.utc).timestamp(), ))
+				if not cancelled and folders is None:
+					db.execute('UPDATE params SET last_refreshed = ?, next_refresh = NULL', (datetime.now().replace(tzinfo=timezone.utc).timestamp(), ))
 			except sqlite3.OperationalError:
 				app.logger.error('Refresh: Could not set last updated time')
 			finally:
+				try:
+					finish_scan()
+				except sqlite3.OperationalError:
+					app.logger.error('Refresh: Could not clear scan checkpoints')
+				# Share the results with snapshot readers
+				try:
+					publish_snapshot()
+				except (sqlite3.OperationalError, OSError) as e:
+					with_warnings = True
+					app.logger.error('Refresh: Could not publish snapshot: ' + str(e))
 				# Task complete
-				message = 'Scan completed with warnings' if with_warnings else 'Scan complete'
+				if cancelled:
+					message = 'Scan cancelled'
+				else:
+					message = 'Scan completed with warnings' if with_warnings else 'Scan complete'
 				stats = str(new_folders) + ' new folders, ' + str(new_videos) + ' new videos'
+				if updated_videos > 0:
+					stats += ', ' + str(updated_videos) + ' updated videos'
+				if removed_folders > 0 or removed_videos > 0:
+					stats += ', ' + str(removed_folders) + ' removed folders, ' + str(removed_videos) + ' removed videos'
+				if reclaimed_rows > 0:
+					stats += '; reclaimed ' + str(reclaimed_rows) + ' rows, ' + format_size(reclaimed_bytes)
 				app.logger.info(message + ' ' + stats)
 				try:
 					set_task(status = 0, message = message + "\n" + stats)
 				except sqlite3.OperationalError:
 					app.logger.error('Refresh: Could not set task to completed')
+	
+	def run_in_background():
+		# Keep the lease while scanning
+		stop = threading.Event()
+		threading.Thread(target = renew_task_until, args = (app, owner, stop),
+						 daemon = True).start()
+		with app.app_context():
+			g.task_owner = owner
+			try:
+				run_refresh_db(rescan)
+			except Exception as e:
+				app.logger.error(str(e))
+				# Don't leave the task locked
+				try:
+					if get_task()['status'] == 1:
+						set_task(status = -1, message = 'Refresh failed')
+				except sqlite3.OperationalError:
+					app.logger.error('Refresh: Could not cancel task')
+			finally:
+				stop.set()
+	
+	threading.Thread(target = run_in_background).start()
+
+def rederive_db():
+	"""
+	Derive every video's title, sort title, position, ID and upload date
+	again from its stored filename and .info.json fields in a separate
+	thread, e.g. after the filename format changes, updating them in batches
+	without reading the disk
+	Videos scanned before their .info.json fields were stored are skipped
+	until they're rescanned
+	params['rederive_pending'] is cleared once it starts, and set again if
+	it doesn't finish, so it can be started later (see check_schedule)
+	"""
+	if current_app.config['SNAPSHOT_READER']:
+		raise BlockingIOError('Refresh: Snapshot readers cannot change the '
+							  'library, change settings on the server that '
+							  'publishes them')
+	
+	owner = new_task_owner()
+	try:
+		if not acquire_task(owner, 'Updating titles'):
+			raise BlockingIOError('Refresh: A task is already running')
+	except sqlite3.OperationalError as e:
+		raise sqlite3.OperationalError('Refresh: Could not lock task') from e
+	
+	app = current_app._get_current_object()
+	
+	def run_rederive_db():
+		db = get_db()
+		# Settings saved from now on need another run
+		db.execute('UPDATE params SET rederive_pending = 0')
+		db.commit()
+		params = get_params()
+		total = db.execute('SELECT COUNT(*) FROM videos '
+						   'WHERE raw_info IS NOT NULL').fetchone()[0]
+		skipped = db.execute('SELECT COUNT(*) FROM videos '
+							 'WHERE raw_info IS NULL').fetchone()[0]
+		# Only rows that change are written, so the search index is only
+		# updated for those
+		query = ('UPDATE videos SET title = ?, sort_title = ?, position = ?, '
+				 'video_id = ?, upload_date = ? WHERE id = ? AND ('
+				 'title IS NOT ? OR sort_title IS NOT ? OR position IS NOT ? OR '
+				 'video_id IS NOT ? OR upload_date IS NOT ?)')
+		updated = 0
+		done = 0
+		last_id = 0
+		cancelled = False
+		while True:
+			# Stop between batches if cancelled, or if the lease was lost to
+			# a scan that may be writing the same rows
+			if scan_cancelled():
+				if not owns_task():
+					app.logger.warning('Refresh: Lost task lease to another process, stopping')
+					db.execute('UPDATE params SET rederive_pending = 1')
+					db.commit()
+					return
+				cancelled = True
+				break
+			# Keyset pagination, so each batch is a short read
+			rows = db.execute('SELECT videos.id, filename, raw_info, folder_path '
+							  'FROM videos JOIN folders ON folder_id = folders.id '
+							  'WHERE raw_info IS NOT NULL AND videos.id > ? '
+							  'ORDER BY videos.id LIMIT ?',
+							  (last_id, REDERIVE_BATCH)).fetchall()
+			if not rows:
+				break
+			batch = []
+			for row in rows:
+				try:
+					info = json.loads(row['raw_info'])
+				except json.JSONDecodeError:
+					info = {}
+				parser = compile_filename_format(
+						 filename_format_for(row['folder_path'], params),
+						 params['filename_delimiter'])
+				video, _ = derive_metadata(Path(row['filename']).stem, info,
+										   params, parser)
+				fields = (video['title'], video['sort_title'],
+						  video['position'], video['id'], video['upload_date'])
+				batch.append(fields + (row['id'], ) + fields)
+			# Summed over the batch, not counting the search index trigger
+			updated += db.executemany(query, batch).rowcount
+			db.commit()
+			done += len(rows)
+			last_id = rows[-1]['id']
+			set_task(status = 1, file = done, of_files = total,
+					 message = 'Updating titles')
+		
+		for folder in db.execute('SELECT id, folder_path FROM folders').fetchall():
+			db.execute('UPDATE folders SET folder_name = ? WHERE id = ?',
+					   (derive_folder_name(Path(folder['folder_path']), params),
+						folder['id']))
+		db.commit()
+		
+		if updated > 0:
+			# Titles, positions and dates are sorted by
+			rank_folders()
+			bump_generation()
+		try:
+			publish_snapshot()
+		except (sqlite3.OperationalError, OSError) as e:
+			app.logger.error('Refresh: Could not publish snapshot: ' + str(e))
+		
+		message = 'Titles updated'
+		stats = str(updated) + ' of ' + str(done) + ' videos changed'
+		if cancelled:
+			message = 'Updating titles cancelled'
+		elif skipped > 0:
+			message = 'Titles updated with warnings'
+			stats += ', ' + str(skipped) + ' scanned by an older version need a rescan'
+		app.logger.info(message + ' ' + stats)
+		set_task(status = 0, message = message + "\n" + stats)
+	
+	def run_in_background():
+		# Keep the lease while updating
+		stop = threading.Event()
+		threading.Thread(target = renew_task_until, args = (app, owner, stop),
+						 daemon = True).start()
+		with app.app_context():
+			g.task_owner = owner
+			try:
+				run_rederive_db()
+			except Exception as e:
+				app.logger.error('Refresh: Could not update titles: ' + str(e))
+				try:
+					db = get_db()
+					db.rollback()
+					db.execute('UPDATE params SET rederive_pending = 1')
+					db.commit()
+					if get_task()['status'] == 1:
+						set_task(status = -1, message = 'Updating titles failed')
+				except sqlite3.OperationalError:
+					app.logger.error('Refresh: Could not cancel task')
+			finally:
+				stop.set()
+	
+	threading.Thread(target = run_in_background).start()
+
+def convert_thumbnails(thumbs, formats, basepath, folder, of_folders):
+	"""
+	Convert queued thumbnails and extracted poster frames to each format at
+	each scale in THUMBNAIL_SCALES and add them to the database
+	thumbs = list of {'id', 'path', 'data': {}} with 'poster' (a future) for
+	frames being extracted; paths are relative to basepath
+	Stops early if the scan is cancelled, keeping what was converted
+	Returns (with_warnings, cancelled)
+	"""
+	with_warnings = False
+	cancelled = False
+	total_thumbs = len(thumbs)
+	for thumb_index, thumb in enumerate(thumbs):
+		if thumb_index % 5 == 0:
+			# Stop between batches if cancelled
+			if thumb_index > 0 and scan_cancelled():
+				cancelled = True
+				break
+			# Update task every 5 thumbnails
+			try:
+				set_task(status = 1, folder = folder, of_folders = of_folders,
+						 file = thumb_index + 1, of_files = total_thumbs,
+						 message = 'Generating thumbnails')
+			except sqlite3.OperationalError:
+				with_warnings = True
+				current_app.logger.warning('Refresh: Could not update task status')
 		
-	threading.Thread(target = run_refresh_db(rescan)).start()
+		if 'poster' in thumb:
+			try:
+				source = BytesIO(thumb['poster'].result())
+			except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+				with_warnings = True
+				current_app.logger.warning('Could not extract poster frame from "' +
+										   thumb['path'].name + '": ' + str(e))
+				continue
+		else:
+			source = basepath.joinpath(thumb['path'])
+		
+		try:
+			# Read thumbnail file or extracted frame
+			with Image.open(source) as img:
+				# Decode once, shrinking to each size in turn
+				for scale, resized in thumbnail_scales(img):
+					# Export each supported format
+					for fmt in formats:
+						try:
+							thumb['data'][(fmt, scale)] = encode_thumbnail(resized, fmt)
+						except OSError as e:
+							with_warnings = True
+							current_app.logger.warning('Could not save thumbnail: ' + str(e))
+						else:
+							current_app.logger.debug('Created ' + str(fmt) + ' ' + str(scale) +
+													 'x thumbnail for video ID ' + str(thumb['id']))
+		except OSError as e:
+			with_warnings = True
+			current_app.logger.warning('Could not open thumbnail: ' + str(e))
+	
+	# Add thumbs to database
+	for thumb in thumbs:
+		for (fmt, scale), data in thumb['data'].items():
+			try:
+				add_thumbnail(thumb['id'], fmt, data, scale)
+			except sqlite3.OperationalError:
+				with_warnings = True
+				current_app.logger.warning('Could not add ' + fmt + ' thumbnail for video ID ' +
+										   str(thumb['id']) + ' to database')
+	return with_warnings, cancelled
 
 def add_folder(folder_name, folder_path, video_count):
 	"""
@@ -596,62 +1418,154 @@ def add_folder(folder_name, folder_path, video_count):
 	Returns the folder's unique ID
 	"""
 	db = get_db()
-	query = ('INSERT INTO folders (folder_name, folder_path, video_count) '
-			 'VALUES (?, ?, ?)')
-	db.execute(query, (folder_name, folder_path, video_count))
-	id = db.execute('SELECT last_insert_rowid() FROM folders').fetchone()[0]
+	query = (f'INSERT INTO {library_table("folders")} '
+			 '(folder_name, folder_path, video_count) VALUES (?, ?, ?)')
+	id = db.execute(query, (folder_name, folder_path, video_count)).lastrowid
 	db.commit()
 	return id
 
 def update_folder(id, video_count):
 	"""Update the number of videos in a folder by its ID"""
 	db = get_db()
-	query = 'UPDATE folders SET video_count = ? WHERE id = ?'
+	query = f'UPDATE {library_table("folders")} SET video_count = ? WHERE id = ?'
 	db.execute(query, (video_count, id))
 	db.commit()
 
-def add_video(video):
+def add_video(video, id = None):
 	"""
 	Add a video to the database.
 	Supply a dict of parameters, all but folder_id and filename can be None
+	Specify id to add it with that ID, otherwise the next is used
 	Returns the video's unique ID
 	"""
 	db = get_db()
-	query = ('INSERT INTO videos ('
-			 'folder_id, filename, thumbnail, thumbnail_format, position, '
+	query = (f'INSERT INTO {library_table("videos")} ('
+			 'id, folder_id, filename, sort_filename, thumbnail, '
+			 'thumbnail_format, position, '
 			 'playlist_index, video_id, video_url, title, sort_title, '
 			 'description, upload_date, modification_time, uploader, '
 			 'uploader_url, duration, view_count, like_count, dislike_count, '
 			 'average_rating, categories, tags, height, vcodec, video_format, '
-			 'fps) VALUES ('
-				 '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
-				 '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?'
+			 'fps, raw_info) VALUES ('
+				 '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+				 '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?'
 			 ')')
 	
-	db.execute(query, (video['folder_id'], video['filename'],
-					   video['thumbnail'], video['thumbnail_format'],
-					   video['position'], video['playlist_index'],
-					   video['id'], video['webpage_url'], video['title'],
-					   video['sort_title'], video['description'],
-					   video['upload_date'], video['modification_time'],
-					   video['uploader'], video['uploader_url'],
-					   video['duration'], video['view_count'],
-					   video['like_count'], video['dislike_count'],
-					   video['average_rating'], video['categories'],
-					   video['tags'], video['height'], video['vcodec'],
-					   video['video_format'], video['fps']))
-					   
-	id = db.execute('SELECT last_insert_rowid() FROM folders').fetchone()[0]
+	cursor = db.execute(query, (id, video['folder_id'], video['filename'],
+								video['sort_filename'],
+								video['thumbnail'], video['thumbnail_format'],
+								video['position'], video['playlist_index'],
+								video['id'], video['webpage_url'], video['title'],
+								video['sort_title'], video['description'],
+								video['upload_date'], video['modification_time'],
+								video['uploader'], video['uploader_url'],
+								video['duration'], video['view_count'],
+								video['like_count'], video['dislike_count'],
+								video['average_rating'], video['categories'],
+								video['tags'], video['height'], video['vcodec'],
+					   video['video_format'], video['fps'],
+								video['raw_info']))
+	id = cursor.lastrowid
 	db.commit()
 	return id
 
-def add_thumbnail(video_id, thumb_format, thumb_data):
+def replace_video(id, video):
+	"""
+	Replace a video's details by its ID, keeping the ID, and remove its
+	stored thumbnails so they're converted again
+	Returns the video's ID
+	"""
+	db = get_db()
+	db.execute(f'DELETE FROM {library_table("thumbs")} WHERE video_id = ?',
+			   (id, ))
+	# Deleting and re-adding (rather than updating) keeps the search index in
+	# step through the insert and delete triggers
+	db.execute(f'DELETE FROM {library_table("videos")} WHERE id = ?', (id, ))
+	return add_video(video, id)
+
+def match_renames(missing, files):
+	"""
+	Pair videos missing from disk with new files in the same folder that have
+	the same modification time, as renaming a file keeps it
+	missing = rows from list_video_files(), files = Paths
+	Returns {new filename: ID of the missing video}
+	"""
+	by_time = {}
+	for video in missing:
+		by_time.setdefault(video['modification_time'], []).append(video['id'])
+	renamed = {}
+	for file in files:
+		try:
+			modified = int(file.stat().st_mtime)
+		except OSError:
+			continue
+		if by_time.get(modified):
+			renamed[file.name] = by_time[modified].pop()
+	return renamed
+
+def remove_videos(ids):
+	"""
+	Remove videos and their thumbnails by ID, in batches that stay under
+	SQLite's limit on query parameters
+	Returns the number of rows removed and bytes of pages freed for reuse
+	"""
+	db = get_db()
+	free = free_bytes()
+	rows = 0
+	for start in range(0, len(ids), 500):
+		batch = ids[start:start + 500]
+		placeholders = ', '.join('?' * len(batch))
+		rows += db.execute(f'DELETE FROM {library_table("thumbs")} '
+						   f'WHERE video_id IN ({placeholders})', batch).rowcount
+		rows += db.execute(f'DELETE FROM {library_table("videos")} '
+						   f'WHERE id IN ({placeholders})', batch).rowcount
+		db.commit()
+	return rows, free_bytes() - free
+
+def remove_folders(ids):
+	"""
+	Remove folders and their videos by ID
+	Returns the number of videos removed, then as remove_videos()
+	"""
+	db = get_db()
+	videos = []
+	for id in ids:
+		videos += [video['id'] for video in list_video_files(id)]
+	free = free_bytes()
+	rows, _ = remove_videos(videos)
+	placeholders = ', '.join('?' * len(ids))
+	rows += db.execute(f'DELETE FROM {library_table("video_ranks")} '
+					   f'WHERE folder_id IN ({placeholders})', ids).rowcount
+	rows += db.execute(f'DELETE FROM {library_table("folders")} '
+					   f'WHERE id IN ({placeholders})', ids).rowcount
+	db.commit()
+	return len(videos), rows, free_bytes() - free
+
+def purge_orphans():
+	"""
+	Remove thumbnails of videos no longer in the library (no foreign key
+	cascades them) and sprite sheets from earlier library generations
+	Returns the number of rows removed and bytes of pages freed for reuse
+	"""
+	db = get_db()
+	free = free_bytes()
+	thumbs = library_table('thumbs')
+	rows = db.execute(f'DELETE FROM {thumbs} WHERE NOT EXISTS ('
+					  f'SELECT 1 FROM {library_table("videos")} '
+					  f'WHERE id = {thumbs}.video_id)').rowcount
+	rows += db.execute('DELETE FROM sprites WHERE generation != ('
+					   'SELECT generation FROM params)').rowcount
+	db.commit()
+	return rows, free_bytes() - free
+
+def add_thumbnail(video_id, thumb_format, thumb_data, scale = 1):
 	"""
 	Add a video's thumbnail to the database by its ID.
 	One video can have many thumbnail formats. Each thumb_format has an integer
 	priority from app.config['THUMBNAIL_FORMATS'][thumb_format]['priority'].
 	thumb_format = Pillow codec/module name (e.g. 'jpg', 'webp')
 	thumb_data = base64-encoded data: URL
+	scale = multiple of THUMBNAIL_SIZE, from THUMBNAIL_SCALES
 	"""
 	try:
 		format_priority = current_app.config['THUMBNAIL_FORMATS'][
@@ -661,10 +1575,11 @@ def add_thumbnail(video_id, thumb_format, thumb_data):
 					   str(thumb_format)) from e
 	
 	db = get_db()
-	query = ('INSERT INTO thumbs ('
-			 'video_id, thumb_format, thumb_data, format_priority) '
-			 'VALUES (?, ?, ?, ?)')
-	db.execute(query, (video_id, thumb_format, thumb_data, format_priority))
+	query = (f'INSERT INTO {library_table("thumbs")} ('
+			 'video_id, thumb_format, thumb_data, format_priority, scale) '
+			 'VALUES (?, ?, ?, ?, ?)')
+	db.execute(query, (video_id, thumb_format, thumb_data, format_priority,
+					   scale))
 	db.commit()
 
 def list_folders():
@@ -672,13 +1587,99 @@ def list_folders():
 	Returns a list of folders with their ID, name, path and video count
 	Sorts by folder path for tree then name order
 	"""
-	query = 'SELECT * FROM folders ORDER BY folder_path ASC'
+	query = f'SELECT * FROM {library_table("folders")} ORDER BY folder_path ASC'
 	return get_db().execute(query).fetchall()
 
+# Columns sorted by a key computed when scanned instead of their value
+SORT_KEYS = {
+	'filename': 'sort_filename'
+}
+
+def sort_order(sort_by, direction_string):
+	"""
+	Returns the ORDER BY clause for a sort column and direction ('ASC' or
+	'DESC'), with the columns it falls back to for equal values
+	"""
+	sort_string = f"{SORT_KEYS.get(sort_by, sort_by)} {direction_string} "
+	if sort_by not in ['playlist_index', 'position', 'title']:
+		# Secondary sorts for all but the above in case of dupe/missing values
+		sort_string += (f", playlist_index {direction_string} "
+						f", position {direction_string } ")
+	# All sorts finally fall back to ID 
+	sort_string += f", id {direction_string}"
+	return sort_string
+
+def rank_folders(folder_ids = None):
+	"""
+	Number the videos in folders (all folders if None) in ascending order of
+	each of SORT_COLUMNS, so playlists are read in order from the
+	video_ranks index rather than sorted on each request
+	Every fallback sort is in the same direction, so descending order is the
+	ranks reversed
+	"""
+	db = get_db()
+	ranks = library_table('video_ranks')
+	videos = library_table('videos')
+	sort_columns = [sort_by for sort_by in current_app.config['SORT_COLUMNS']
+					if column_exists('videos', sort_by)]
+	if folder_ids is None:
+		batches = [None]
+	else:
+		batches = [folder_ids[start:start + 500]
+				   for start in range(0, len(folder_ids), 500)]
+	for batch in batches:
+		if batch is None:
+			where = ''
+			batch = []
+		else:
+			where = f"WHERE folder_id IN ({', '.join('?' * len(batch))})"
+		db.execute(f'DELETE FROM {ranks} {where}', batch)
+		for sort_by in sort_columns:
+			db.execute(f'INSERT INTO {ranks} (folder_id, sort_by, sort_rank, '
+						'video_id) SELECT folder_id, ?, ROW_NUMBER() OVER ('
+					   f'PARTITION BY folder_id ORDER BY {sort_order(sort_by, "ASC")}'
+					   f') , id FROM {videos} {where}', [sort_by] + batch)
+		db.commit()
+
+def unranked_folders():
+	"""
+	Returns the IDs of folders with videos missing ranks for any of
+	SORT_COLUMNS, e.g. if the columns changed, or ranked by any of them with a
+	different number of videos than they have, e.g. if a scan was stopped
+	before ranking a folder it changed
+	"""
+	sort_columns = list(current_app.config['SORT_COLUMNS'])
+	placeholders = ', '.join('?' * len(sort_columns))
+	videos = library_table('videos')
+	ranks = library_table('video_ranks')
+	query = (f'SELECT id FROM {library_table("folders")} AS folders '
+			 f'WHERE (EXISTS (SELECT 1 FROM {videos} '
+			 'WHERE folder_id = folders.id) AND (SELECT COUNT(DISTINCT sort_by) '
+			 f'FROM {ranks} WHERE folder_id = folders.id '
+			 f'AND sort_by IN ({placeholders})) < ?) '
+			 f'OR EXISTS (SELECT 1 FROM {ranks} WHERE folder_id = folders.id '
+			 f'AND sort_by IN ({placeholders}) GROUP BY sort_by '
+			 f'HAVING COUNT(*) != (SELECT COUNT(*) FROM {videos} '
+			 'WHERE folder_id = folders.id))')
+	return [row['id'] for row in get_db().execute(
+			query, sort_columns + [len(sort_columns)] + sort_columns)]
+
+def ranked_count(folder_id, sort_by):
+	"""
+	Returns the number of videos ranked in a folder by a sort column, or None
+	if it hasn't been ranked
+	"""
+	query = (f'SELECT MAX(sort_rank) FROM {library_table("video_ranks")} '
+			 'WHERE folder_id = ? AND sort_by = ?')
+	return get_db().execute(query, (folder_id, sort_by)).fetchone()[0]
+
 def list_videos(folder_id, sort_by = 'playlist_index',
-				sort_direction = 'desc'):
+				sort_direction = 'desc', start = 0, count = None):
 	"""
 	Returns a sorted list of videos with their ID, title, duration and filename
+	Specify start and count to return only part of the list
+	Reads a range of the folder's ranks if it has been ranked, otherwise
+	sorts the folder
 	"""
 	try:
 		folder_id = int(folder_id)
@@ -695,17 +1696,75 @@ def list_videos(folder_id, sort_by = 'playlist_index',
 	else:
 		raise ValueError('Sort direction must be "asc" or "desc"')
 	
-	sort_string = f"{sort_by} {direction_string} "
-	if sort_by not in ['playlist_index', 'position', 'title']:
-		# Secondary sorts for all but the above in case of dupe/missing values
-		sort_string += (f", playlist_index {direction_string} "
-						f", position {direction_string } ")
-	# All sorts finally fall back to ID 
-	sort_string += f", id {direction_string}"
+	videos = library_table('videos')
+	columns = ('SELECT id, title, duration, filename, '
+			   '(thumbnail IS NOT NULL OR '
+			  f'EXISTS (SELECT 1 FROM {library_table("thumbs")} '
+			  f'WHERE video_id = {videos}.id)) AS has_thumb ')
+	total = ranked_count(folder_id, sort_by)
+	if total is not None:
+		# Ranks start at 1 in ascending order
+		end = total if count is None else start + count
+		if sort_direction == 'asc':
+			first, last = start + 1, end
+		else:
+			first, last = total - end + 1, total - start
+		ranks = library_table('video_ranks')
+		query = (columns + f'FROM {ranks} INNER JOIN {videos} ON '
+				f'{ranks}.video_id = {videos}.id '
+				f'WHERE {ranks}.folder_id = ? AND sort_by = ? '
+				 'AND sort_rank BETWEEN ? AND ? '
+				f'ORDER BY sort_rank {direction_string}')
+		return get_db().execute(query, (folder_id, sort_by, first,
+										last)).fetchall()
+	
+	query = (columns + f'FROM {videos} WHERE folder_id = ? '
+			f"ORDER BY {sort_order(sort_by, direction_string)} "
+			 'LIMIT ? OFFSET ?')
+	return get_db().execute(query, (folder_id, -1 if count is None else count,
+									start)).fetchall()
+
+def count_videos(folder_id):
+	"""Returns the number of videos in a folder"""
+	query = f'SELECT COUNT(*) FROM {library_table("videos")} WHERE folder_id = ?'
+	return get_db().execute(query, (folder_id, )).fetchone()[0]
+
+def video_position(folder_id, video_id, sort_by, sort_direction):
+	"""
+	Returns the index of a video in a folder's sorted playlist, or None if it
+	doesn't exist in that folder
+	"""
+	query = (f'SELECT sort_rank FROM {library_table("video_ranks")} '
+			 'WHERE folder_id = ? AND video_id = ? AND sort_by = ?')
+	rank = get_db().execute(query, (folder_id, video_id, sort_by)).fetchone()
+	if rank is not None:
+		if sort_direction == 'asc':
+			return rank['sort_rank'] - 1
+		return ranked_count(folder_id, sort_by) - rank['sort_rank']
 	
-	query = ('SELECT id, title, duration, filename '
-			 'FROM videos WHERE folder_id = ? '
-			f"ORDER BY {sort_string}")
+	# Not ranked yet
+	video = get_video(video_id)
+	if video is None or video['folder_id'] != folder_id:
+		return None
+	videos = list_videos(folder_id, sort_by, sort_direction)
+	return [row['id'] for row in videos].index(video['id'])
+
+def list_video_files(folder_id):
+	"""Returns the ID, filename and modification time of videos in a folder"""
+	query = ('SELECT id, filename, modification_time '
+			f'FROM {library_table("videos")} WHERE folder_id = ?')
+	return get_db().execute(query, (folder_id, )).fetchall()
+
+def list_videos_without_thumbs(folder_id):
+	"""
+	Returns the ID, filename, thumbnail and duration of videos in a folder
+	with no stored thumbnails
+	"""
+	videos = library_table('videos')
+	query = ('SELECT id, filename, thumbnail, duration '
+			f'FROM {videos} WHERE folder_id = ? AND NOT EXISTS ('
+				f'SELECT 1 FROM {library_table("thumbs")} '
+				f'WHERE video_id = {videos}.id)')
 	return get_db().execute(query, (folder_id, )).fetchall()
 
 def get_video(id):
@@ -718,9 +1777,7 @@ def get_video(id):
 	query = ('SELECT folder_id, videos.id, filename, '
 			 'thumbnail, thumbnail_format, video_id, '
 			 'video_url, title, description, '
-			 'strftime("%d/%m/%Y", upload_date) AS upload_date, '
-			 'strftime("%d/%m/%Y %H:%M", modification_time) '
-			 'AS modification_time, '
+			 'upload_date, modification_time, '
 			 'uploader, uploader_url, duration, '
 			 'view_count, like_count, dislike_count, '
 			 'average_rating, categories, tags, '
@@ -730,11 +1787,12 @@ def get_video(id):
 			 'WHERE videos.id = ?')
 	return get_db().execute(query, (id, )).fetchone()
 
-def get_thumbs(image_format, ids):
+def get_thumbs(image_format, ids, scales = None):
 	"""
 	Return small thumbnails as bytes in the requested image format
-	for a list of video IDs
-	Returns a row for each thumbnail with its video ID, image format and data
+	for a list of video IDs, at each of scales (default THUMBNAIL_SCALES)
+	Returns a row for each thumbnail with its video ID, image format, data
+	and scale. Larger scales are missing if the original image was too small
 	"""
 	# Sane maximum query size
 	max_ids = 100
@@ -757,13 +1815,206 @@ def get_thumbs(image_format, ids):
 	except ValueError as e:
 		raise TypeError('THUMBNAIL_FORMATS priority not an integer')
 	
-	query = ('SELECT video_id, thumb_format, thumb_data, '
+	if scales is None:
+		scales = current_app.config['THUMBNAIL_SCALES']
+	
+	query = ('SELECT video_id, thumb_format, thumb_data, scale, '
 			 'MAX(format_priority) as format_priority '
 			 'FROM thumbs WHERE format_priority <= ? '
+			f"AND scale in ({', '.join(['?']*len(scales))}) "
 			f"AND video_id in ({', '.join(['?']*len(ids))}) "
-			 'GROUP BY video_id')
+			 'GROUP BY video_id, scale')
 	
-	return get_db().execute(query, (max_priority, *ids)).fetchall()
+	thumbs = get_db().execute(query, (max_priority, *scales, *ids)).fetchall()
+	
+	# Snapshot readers can't store them
+	if (current_app.config['LAZY_THUMBNAILS'] and
+		not current_app.config['SNAPSHOT_READER'] and
+		image_format in supported_thumbnail_formats()):
+		# Generate the requested format from thumbnail images if not stored
+		stored = [thumb['video_id'] for thumb in thumbs
+				  if thumb['thumb_format'] == image_format]
+		generated = False
+		for video_id in ids:
+			if video_id in stored:
+				continue
+			try:
+				generated = generate_thumbnail(video_id, image_format) or generated
+			except (OSError, ValueError) as e:
+				current_app.logger.warning(f'Could not generate {image_format} '
+										   f'thumbnail for video ID {video_id}: {e}')
+		if generated:
+			thumbs = get_db().execute(query, (max_priority, *scales,
+											  *ids)).fetchall()
+	
+	return thumbs
+
+def supported_thumbnail_formats():
+	"""
+	Returns the THUMBNAIL_FORMATS that Pillow can save and that have a MIME
+	type in THUMBNAIL_EXTENSIONS
+	"""
+	if features is None:
+		return {}
+	pillow_features = (features.get_supported_codecs() +
+					   features.get_supported_modules())
+	return {key: value for key, value in
+			current_app.config['THUMBNAIL_FORMATS'].items()
+			if (key in pillow_features and
+				'.' + str(key) in current_app.config['THUMBNAIL_EXTENSIONS'])}
+
+def thumbnail_scales(img):
+	"""
+	Shrink an opened Pillow image to THUMBNAIL_SIZE times each of
+	THUMBNAIL_SCALES, largest first, maintaining aspect ratio
+	Yields (scale, image), where each size is shrunk from the one before so
+	the original is only decoded and resampled once. JPEGs are decoded at a
+	reduced size where that is still larger than the largest thumbnail
+	Skips larger scales if the original is no bigger than the smallest
+	"""
+	width, height = current_app.config['THUMBNAIL_SIZE']
+	scales = sorted(current_app.config['THUMBNAIL_SCALES'], reverse = True)
+	img.draft('RGB', (width * scales[0], height * scales[0]))
+	if img.mode != 'RGB':
+		img = img.convert('RGB')
+	for scale in scales:
+		img.thumbnail((width * scale, height * scale))
+		if (scale != scales[-1] and img.width <= width * scales[-1] and
+			img.height <= height * scales[-1]):
+			# Would be the same as the smallest
+			continue
+		yield scale, img
+
+def encode_thumbnail(img, image_format):
+	"""
+	Save a Pillow image (already shrunk to THUMBNAIL_SIZE) in a format from
+	THUMBNAIL_FORMATS
+	Returns a base64-encoded data: URL
+	"""
+	stream = BytesIO()
+	# method is only used by webp: 0 (fast) - 6 (slow)
+	img.save(stream, format = current_app.config['THUMBNAIL_FORMATS'][
+						 image_format]['export_format'],
+			 quality = current_app.config['THUMBNAIL_QUALITY'], method = 2)
+	mime = current_app.config['THUMBNAIL_EXTENSIONS']['.' + image_format]
+	return ('data:' + mime + ';base64,' +
+			base64.encodebytes(stream.getvalue()).decode('ascii'))
+
+# Thumbnails being generated on request: {(video ID, format): threading.Lock}
+generating_thumbs = {}
+generating_thumbs_lock = threading.Lock()
+
+def generate_thumbnail(video_id, image_format):
+	"""
+	Generate and store a video's thumbnail in a format from its thumbnail
+	image, unless it is already stored
+	Concurrent calls for the same thumbnail wait for the first to finish
+	instead of generating it again
+	Returns True if the thumbnail is stored, False if the video has no
+	thumbnail image
+	"""
+	key = (video_id, image_format)
+	with generating_thumbs_lock:
+		lock = generating_thumbs.setdefault(key, threading.Lock())
+	try:
+		with lock:
+			query = ('SELECT COUNT(*) FROM thumbs '
+					 'WHERE video_id = ? AND thumb_format = ?')
+			if get_db().execute(query, key).fetchone()[0] > 0:
+				# Stored while waiting
+				return True
+			path = get_media_path(video_id, 'thumbnail')
+			if path is None:
+				return False
+			
+			with Image.open(Path(get_params()['disk_path']).joinpath(path)) as img:
+				for scale, resized in thumbnail_scales(img):
+					add_thumbnail(video_id, image_format,
+								  encode_thumbnail(resized, image_format), scale)
+			current_app.logger.debug(f'Created {image_format} thumbnail for '
+									 f'video ID {video_id} on request')
+			return True
+	finally:
+		with generating_thumbs_lock:
+			# Later calls find the stored thumbnail
+			if generating_thumbs.get(key) is lock:
+				del generating_thumbs[key]
+
+def sprites_enabled(params):
+	"""Returns True if playlist thumbnails should be loaded as sprite sheets"""
+	return (current_app.config['SPRITE_SHEETS'] and Image is not None and
+			bool(params['generate_thumbs']))
+
+def get_sprite(folder_id, sort_by, sort_direction, sheet, image_format):
+	"""
+	Return a sprite sheet of thumbnails for a page of a sorted playlist as
+	bytes in the requested image format, building it if the library has
+	changed since it was last built
+	Videos without thumbnails are skipped, so the nth thumbnail in the
+	playlist is in cell n % cells of sheet n // cells, in rows of
+	SPRITE_GRID[0] columns
+	"""
+	if Image is None:
+		raise TypeError('Pillow is not installed')
+	if image_format not in supported_thumbnail_formats():
+		image_format = 'jpg'
+	
+	db = get_db()
+	generation = get_params()['generation']
+	key = (folder_id, sort_by, sort_direction, sheet, image_format)
+	query = ('SELECT sprite_data FROM sprites '
+			 'WHERE folder_id = ? AND sort_by = ? AND sort_direction = ? '
+			 'AND sheet = ? AND sprite_format = ? AND generation = ?')
+	sprite = db.execute(query, (*key, generation)).fetchone()
+	if sprite is not None:
+		return sprite['sprite_data'], image_format
+	
+	columns, rows = current_app.config['SPRITE_GRID']
+	# Cells at the largest scale, shown smaller on low density screens
+	scale = max(current_app.config['THUMBNAIL_SCALES'])
+	width, height = [side * scale for side in
+					 current_app.config['THUMBNAIL_SIZE']]
+	cells = columns * rows
+	video_ids = [video['id'] for video in
+				 list_videos(folder_id, sort_by, sort_direction)
+				 if video['has_thumb']][sheet * cells:(sheet + 1) * cells]
+	if len(video_ids) == 0:
+		raise ValueError('Sprite sheet does not exist')
+	
+	# Best stored format and largest size for each video, re-encoded to the
+	# requested format
+	thumbs = {}
+	scales = {}
+	for start in range(0, len(video_ids), 100):
+		for thumb in get_thumbs(image_format, video_ids[start:start + 100]):
+			if thumb['scale'] > scales.get(thumb['video_id'], 0):
+				thumbs[thumb['video_id']] = thumb['thumb_data']
+				scales[thumb['video_id']] = thumb['scale']
+	
+	with Image.new('RGB', (columns * width, rows * height)) as sprite:
+		for cell, video_id in enumerate(video_ids):
+			if video_id not in thumbs:
+				continue
+			# Strip data: URL prefix
+			data = base64.b64decode(thumbs[video_id].split(',', 1)[1])
+			with Image.open(BytesIO(data)) as img:
+				# Fill the cell as thumbnails are displayed at a fixed size
+				img = ImageOps.fit(img.convert('RGB'), (width, height))
+				sprite.paste(img, ((cell % columns) * width,
+								   (cell // columns) * height))
+		stream = BytesIO()
+		sprite.save(stream, quality = current_app.config['THUMBNAIL_QUALITY'],
+					format = current_app.config['THUMBNAIL_FORMATS'][
+							 image_format]['export_format'], method = 2)
+	
+	data = stream.getvalue()
+	# Sheets from earlier generations are never requested again
+	db.execute('DELETE FROM sprites WHERE generation != ?', (generation, ))
+	db.execute('INSERT OR REPLACE INTO sprites (folder_id, sort_by, '
+			   'sort_direction, sheet, sprite_format, generation, sprite_data) '
+			   'VALUES (?, ?, ?, ?, ?, ?, ?)', (*key, generation, data))
+	db.commit()
+	return data, image_format
 
 def search_videos(field, search_query):
 	"""
@@ -835,7 +2086,7 @@ def refresh():
 	"""Scan only new files for videos"""
 	try:
 		refresh_db()
-	except (BlockingIOError, sqlite3.OperationalError) as e: # todo: also add thread error
+	except (BlockingIOError, sqlite3.OperationalError) as e:
 		current_app.logger.error('Failed to start refresh: ' + str(e))
 		return jsonify({'result': 'error',
 						'message': str(e)}), 500 # Inherited from parent
@@ -846,16 +2097,37 @@ def refresh():
 @login_required('admin', api = True)
 @csrf_protect
 def rescan():
-	"""Clear existing data and rescan all files for videos (restricted to admin users)"""
+	"""Rescan all files for videos, replacing existing data (restricted to admin users)"""
 	try:
 		refresh_db(rescan = True)
-	except (BlockingIOError, sqlite3.OperationalError) as e: # todo: also add thread error
+	except (BlockingIOError, sqlite3.OperationalError) as e:
 		current_app.logger.error('Failed to start rescan: ' + str(e))
 		return jsonify({'result': 'error',
 						'message': str(e)}), 500 # Inherited from parent
 
 	return jsonify({'result': 'ok'})
 
+@blueprint.route('/cancel')
+@login_required('admin', api = True)
+@csrf_protect
+def cancel():
+	"""
+	Stop the running refresh or rescan at its next check, between folders or
+	batches of files (restricted to admin users)
+	"""
+	try:
+		cancelled = cancel_scan()
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to cancel task: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to cancel task: ' +
+						'Database error'}), 500
+	
+	if not cancelled:
+		return jsonify({'result': 'error',
+						'message': 'No task running'}), 400
+	return jsonify({'result': 'ok'})
+
 @blueprint.route('/status')
 @login_required('user', api = True)
 def status():
@@ -870,19 +2142,67 @@ def status():
 						'Database error'}), 500
 	
 	# Convert sqlite3.Row object to dict for json
-	task = {key: task[key] for key in task.keys()}
+	task = task_status(task)
 	
-	# Calculate next database refresh
+	# Calculate next database refresh, unless the server schedules them
 	refresh_due = False
 	time_now = datetime.now().replace(tzinfo=timezone.utc).timestamp()
 	next_refresh = params['last_refreshed'] + params['refresh_interval']
-	if next_refresh < time_now:
+	if next_refresh < time_now and not current_app.config['REFRESH_SCHEDULER']:
 		refresh_due = True
 	
 	return jsonify({'result': 'ok',
 					'refresh_due': refresh_due,
 					'data': task})
 
+@blueprint.route('/events')
+@login_required('user', api = True)
+def events():
+	"""
+	Stream the running task's progress and library generation changes as
+	Server-Sent Events, starting with their current state
+	Streams close after EVENTS_TIMEOUT seconds and the browser reconnects
+	"""
+	config = current_app.config
+	if not config['EVENTS_STREAM']:
+		return jsonify({'result': 'error',
+						'message': 'Event stream disabled'}), 404
+	
+	try:
+		publish_state()
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get status: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get status: ' +
+						'Database error'}), 500
+	
+	broadcaster = current_app.extensions['events']
+	# Pick up tasks run by other processes
+	broadcaster.watch(current_app._get_current_object(), publish_state,
+					  config['EVENTS_POLL'])
+	
+	def stream():
+		# Reconnect after 5 seconds if the connection drops
+		yield 'retry: 5000\n\n'
+		version = 0
+		closes = time.monotonic() + config['EVENTS_TIMEOUT']
+		with broadcaster.listening():
+			while time.monotonic() < closes:
+				version, events = broadcaster.wait(
+								  version, config['EVENTS_KEEPALIVE'])
+				if not events:
+					# Stop proxies closing an idle connection
+					yield ': keepalive\n\n'
+				for name, data in events:
+					yield format_event(name, data)
+	
+	response = current_app.response_class(stream(),
+										  mimetype = 'text/event-stream')
+	response.cache_control.no_cache = True
+	# Don't let nginx buffer the stream
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
+
 @blueprint.route('/dismiss')
 @login_required('user', api = True)
 def dismiss():
@@ -961,6 +2281,9 @@ def playlist(folder_id, sort_by, sort_direction):
 	"""
 	List videos in a playlist by its ID
 	Returns a dict of dicts indexed by the specified sort column and direction
+	Specify ?count=n to return a page of n videos from ?start=index, or from
+	the start of the page containing ?video=ID. Pages include the start and
+	total number of videos, and thumbnails aren't in sprite sheets
 	"""
 	try:
 		params = get_params()
@@ -970,8 +2293,24 @@ def playlist(folder_id, sort_by, sort_direction):
 						'message': 'Failed to get params: ' +
 						'Database error'}), 500
 	
+	start = request.args.get('start', 0, type = int)
+	count = request.args.get('count', type = int)
+	if start < 0 or (count is not None and count < 1):
+		return jsonify({'result': 'error',
+						'message': 'Failed to get playlist: ' +
+						'start and count must be positive'}), 400
+	
 	try:
-		videos = list_videos(folder_id, sort_by, sort_direction)
+		if count is not None and 'video' in request.args:
+			position = video_position(folder_id,
+									  request.args.get('video', type = int),
+									  sort_by, sort_direction)
+			if position is None:
+				return jsonify({'result': 'error',
+								'message': 'Video does not exist'}), 404
+			start = position - position % count
+		videos = list_videos(folder_id, sort_by, sort_direction, start, count)
+		total = count_videos(folder_id) if count is not None else len(videos)
 	except ValueError as e:
 		return jsonify({'result': 'error',
 						'message': 'Failed to get playlist: ' +
@@ -985,19 +2324,105 @@ def playlist(folder_id, sort_by, sort_direction):
 						'message': 'Failed to list videos: ' +
 						'Database error'}), 500
 	
-	if len(videos) == 0:
+	if total == 0:
 		return jsonify({'result': 'error',
 						'message': 'Playlist does not exist'}), 404
 	
-	# List of dicts by sort order
-	# Rename to reduce response size & format duration
-	videos = [{'id': video['id'],
-			   't': video['title'],
-			   'd': format_duration(video['duration'])
-			  } for video in videos]
+	if sprites_enabled(params) and count is None:
+		# Position of each thumbnail among those in the playlist, or None
+		sprite_cells = []
+		cell = 0
+		for video in videos:
+			if video['has_thumb']:
+				sprite_cells.append(cell)
+				cell += 1
+			else:
+				sprite_cells.append(None)
+		sprites = {'generation': params['generation'],
+				   'columns': current_app.config['SPRITE_GRID'][0],
+				   'rows': current_app.config['SPRITE_GRID'][1]}
+	else:
+		sprite_cells = [None] * len(videos)
+		sprites = None
 	
-	return jsonify({'result': 'ok',
-					'data': videos})
+	page = {} if count is None else {'start': start, 'total': total}
+	if wants_columns():
+		# Columns by sort order, durations left as seconds to format later
+		data = to_columns(videos, {'id': 'id',
+								   't': 'title',
+								   'd': 'duration'})
+		data['s'] = sprite_cells
+		response = jsonify({'result': 'ok',
+							'data': data,
+							'sprites': sprites,
+							**page})
+		response.mimetype = COLUMNS_MIMETYPE
+	else:
+		# List of dicts by sort order
+		# Rename to reduce response size & format duration
+		videos = [{'id': video['id'],
+				   't': video['title'],
+				   'd': format_duration(video['duration']),
+				   's': cell
+				  } for video, cell in zip(videos, sprite_cells)]
+		
+		response = jsonify({'result': 'ok',
+							'data': videos,
+							'sprites': sprites,
+							**page})
+	
+	response.vary.add('Accept')
+	return response
+
+@blueprint.route('/sprite/<int:folder_id>/<string:sort_by>/<string:sort_direction>/<int:sheet>/<string:image_format>')
+@login_required('guest', api = True)
+def sprite(folder_id, sort_by, sort_direction, sheet, image_format):
+	"""
+	Get a sprite sheet of playlist thumbnails, where the thumbnail of a video
+	with sprite cell s from /playlist is cell s % (columns * rows) of sheet
+	s // (columns * rows)
+	URLs include ?g=<generation> from /playlist so sheets can be cached
+	until the library next changes
+	"""
+	try:
+		params = get_params()
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get params: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get params: ' +
+						'Database error'}), 500
+	
+	if not sprites_enabled(params):
+		return jsonify({'result': 'error',
+						'message': 'Sprite sheets are disabled'}), 404
+	
+	try:
+		data, image_format = get_sprite(folder_id, sort_by, sort_direction,
+										sheet, image_format)
+	except ValueError as e:
+		return jsonify({'result': 'error',
+						'message': 'Failed to get sprite sheet: ' +
+						str(e)}), 404
+	except (TypeError, OSError) as e:
+		current_app.logger.error('Failed to get sprite sheet: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get sprite sheet: ' +
+						'Image error'}), 500
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get sprite sheet: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get sprite sheet: ' +
+						'Database error'}), 500
+	
+	response = current_app.response_class(data, mimetype =
+			   current_app.config['THUMBNAIL_EXTENSIONS']['.' + image_format])
+	if request.args.get('g') == str(params['generation']):
+		# Contents only change with the generation in the URL
+		response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+	else:
+		response.cache_control.no_cache = True
+	response.add_etag()
+	return response.make_conditional(request)
 
 @blueprint.route('/video/<int:video_id>')
 @login_required('guest', api = True)
@@ -1035,9 +2460,7 @@ def video(video_id):
 	video = {key: video[key] for key in video.keys()}
 	
 	# Generate URLs for video file and thumbnail
-	video['path'] = params['web_path'] + urllib.parse.quote(Path(video['folder_path']).joinpath(Path(video['filename'])).as_posix())
-	if video['thumbnail']:
-		video['thumbnail'] = params['web_path'] + urllib.parse.quote(Path(video['folder_path']).joinpath(Path(video['thumbnail'])).as_posix())
+	video['path'], video['thumbnail'] = media_urls(video, params)
 	# Remove unnecessary fields
 	del video['filename'], video['folder_path']
 	# Format duration
@@ -1063,7 +2486,10 @@ def thumbs(image_format):
 	"""
 	Get small thumbnails for a JSON array of video IDs in the requested format,
 	falling back to compatible formats if the requested is unavailable
-	Returns a dict of dicts indexed by video ID: {1: {'f': 'jpg', 'd': data}}
+	Returns a dict of dicts indexed by video ID:
+	{1: {'f': 'jpg', 'd': data, 'x': {2: data at 2x}}}
+	or columns with a row per scale: {'id': [1, 1], 'f': ['jpg', 'jpg'],
+									  'd': [data, data at 2x], 's': [1, 2]}
 	"""
 	video_ids = request.get_json(silent = True)
 	if (video_ids is None or not isinstance(video_ids, list)):
@@ -1087,13 +2513,97 @@ def thumbs(image_format):
 						'message': 'Failed to get thumbnails: ' +
 						'Database error'}), 500
 	
-	# Dict of dicts indexed by video ID
-	thumbnails = {thumb['video_id']: {'f': thumb['thumb_format'],
-									  'd': thumb['thumb_data']}
-									 for thumb in thumbnails}
+	if wants_columns():
+		# A row per video and scale
+		response = jsonify({'result': 'ok',
+							'data': to_columns(thumbnails,
+											   {'id': 'video_id',
+												'f': 'thumb_format',
+												'd': 'thumb_data',
+												's': 'scale'})})
+		response.mimetype = COLUMNS_MIMETYPE
+	else:
+		# Dict of dicts indexed by video ID, with the smallest scale as 'd'
+		# and larger scales in 'x'
+		smallest = min(current_app.config['THUMBNAIL_SCALES'])
+		by_video = {}
+		for thumb in thumbnails:
+			video = by_video.setdefault(thumb['video_id'], {'x': {}})
+			if thumb['scale'] == smallest:
+				video['f'] = thumb['thumb_format']
+				video['d'] = thumb['thumb_data']
+			else:
+				video['x'][thumb['scale']] = thumb['thumb_data']
+		
+		response = jsonify({'result': 'ok',
+							'data': by_video})
 	
-	return jsonify({'result': 'ok',
-					'data': thumbnails})
+	response.vary.add('Accept')
+	return response
+
+@blueprint.route('/thumb/<int:video_id>')
+@login_required('guest', api = True)
+def thumb(video_id):
+	"""
+	Get a video's small thumbnail as an image, in the best format listed in
+	the Accept header or jpg
+	Other formats must be listed by name, as browsers also send image/* and
+	*/* for formats they can't display
+	URLs include ?g=<generation> so thumbnails can be cached until the
+	library next changes, and optionally ?x=<scale> for a larger size from
+	THUMBNAIL_SCALES
+	"""
+	try:
+		params = get_params()
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get params: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get params: ' +
+						'Database error'}), 500
+	
+	formats = supported_thumbnail_formats()
+	accepted = [mimetype for mimetype, quality in request.accept_mimetypes
+				if quality > 0]
+	image_format = 'jpg'
+	for fmt in sorted(formats, key = lambda fmt: formats[fmt]['priority'],
+					  reverse = True):
+		if current_app.config['THUMBNAIL_EXTENSIONS']['.' + fmt] in accepted:
+			image_format = fmt
+			break
+	
+	try:
+		thumbnails = get_thumbs(image_format, [video_id])
+	except TypeError as e:
+		current_app.logger.error('Failed to get thumbnail: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get thumbnail: ' +
+						'Configuration error'}), 500
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get thumbnail: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get thumbnail: ' +
+						'Database error'}), 500
+	
+	if len(thumbnails) == 0:
+		return jsonify({'result': 'error',
+						'message': 'Thumbnail does not exist'}), 404
+	
+	# Largest stored up to the requested scale
+	scale = request.args.get('x', 1, type = int)
+	thumbnail = max(thumbnails, key = lambda thumb: (thumb['scale'] <= scale,
+													 thumb['scale']))
+	
+	# data:image/webp;base64,... to bytes
+	header, data = thumbnail['thumb_data'].split(',', 1)
+	response = current_app.response_class(base64.b64decode(data),
+			   mimetype = header[len('data:'):].split(';')[0])
+	response.vary.add('Accept')
+	if request.args.get('g') == str(params['generation']):
+		response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+	else:
+		response.cache_control.no_cache = True
+	response.add_etag()
+	return response.make_conditional(request)
 
 @blueprint.route('/search', methods = ['POST'], defaults = {
 				 'field': 'title'})
@@ -0,0 +1,250 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.db import (get_db, get_params, bump_generation, library_table,
+					create_shadow_tables, swap_shadow_tables,
+					drop_shadow_tables, publish_snapshot, fill_sort_keys,
+					convert_dates)
+from app.api import leased_task, owns_task, purge_orphans, rank_folders
+
+# First line of an archive, identifying it
+ARCHIVE_FORMAT = 'ytdl-web-viewer-library'
+ARCHIVE_VERSION = 1
+# Tables archived, in the order they're imported
+ARCHIVE_TABLES = ['folders', 'videos', 'thumbs']
+# Rows inserted at once when importing
+IMPORT_BATCH = 1000
+
+def init_app(app):
+	"""
+	Allow copying the library between servers from the CLI with
+	flask library-export and flask library-import
+	"""
+	app.cli.add_command(library_export_command)
+	app.cli.add_command(library_import_command)
+
+@click.command('library-export')
+@click.argument('path', type = click.Path(dir_okay = False))
+@with_appcontext
+def library_export_command(path):
+	"""
+	Write the library's folders, videos and thumbnails to a compressed file
+	with flask library-export PATH, to import on another server instead of
+	scanning
+	"""
+	try:
+		counts = export_library(path)
+	except BlockingIOError as e:
+		click.echo(str(e), err = True)
+	except sqlite3.OperationalError as e:
+		click.echo(f'Database error: {e}', err = True)
+	except OSError as e:
+		click.echo(f'Could not write {path}: {e}', err = True)
+	else:
+		click.echo('Exported ' + ', '.join(f'{count} {table}' for table, count
+										  in counts.items()) + '.')
+
+@click.command('library-import')
+@click.argument('path', type = click.Path(exists = True, dir_okay = False))
+@click.option('--disk-path', help = 'Folder the videos are in on this server, '
+			  'if not the disk path in settings.')
+@with_appcontext
+def library_import_command(path, disk_path):
+	"""
+	Replace the library with one written by flask library-export with
+	flask library-import PATH, keeping users and settings
+	"""
+	try:
+		counts = import_library(path, disk_path)
+	except BlockingIOError as e:
+		click.echo(str(e), err = True)
+	except ValueError as e:
+		click.echo(f'Could not import {path}: {e}', err = True)
+	except EOFError:
+		click.echo(f'Could not import {path}: Archive is incomplete', err = True)
+	except sqlite3.OperationalError as e:
+		click.echo(f'Database error: {e}', err = True)
+	except OSError as e:
+		click.echo(f'Could not read {path}: {e}', err = True)
+	else:
+		click.echo('Imported ' + ', '.join(f'{count} {table}' for table, count
+										  in counts.items()) + '.')
+
+def export_library(path):
+	"""
+	Write the library to path as gzipped JSON lines: a header, then for each
+	table a line of its column names followed by a line for each row's
+	values, then the number of rows in each table to check it's complete
+	Folder paths are relative to the disk path, so the archive can be
+	imported wherever the videos are
+	Returns the number of rows exported from each table
+	"""
+	db = get_db()
+	partial = path + '.partial'
+	# Scans can't change the library while it's leased
+	with leased_task('Exporting library'):
+		try:
+			with gzip.open(partial, 'wt', encoding = 'utf-8') as archive:
+				header = {'format': ARCHIVE_FORMAT,
+						  'version': ARCHIVE_VERSION,
+						  'schema': db.execute('PRAGMA user_version').fetchone()[0],
+						  'exported': time.time(),
+						  'disk_path': get_params()['disk_path']}
+				archive.write(json.dumps(header) + '\n')
+				counts = {}
+				for table in ARCHIVE_TABLES:
+					cursor = db.execute(f'SELECT * FROM {table} ORDER BY rowid')
+					columns = [column[0] for column in cursor.description]
+					archive.write(json.dumps({'table': table,
+											  'columns': columns}) + '\n')
+					counts[table] = 0
+					for row in cursor:
+						archive.write(json.dumps(tuple(row),
+												 separators = (',', ':')) + '\n')
+						counts[table] += 1
+				archive.write(json.dumps({'counts': counts}) + '\n')
+			if not owns_task():
+				raise BlockingIOError('Lost the task lease to another process, '
+									  'the library may have changed')
+		except BaseException:
+			# Don't leave an incomplete archive behind
+			try:
+				os.remove(partial)
+			except OSError:
+				pass
+			raise
+		os.replace(partial, path)
+	return counts
+
+def import_library(path, disk_path = None):
+	"""
+	Replace the library with one exported by export_library, building it in
+	shadow tables (so the current library stays browsable, and the search
+	index is built once before they're swapped in) with batched inserts
+	Columns missing from either version of the schema are left out
+	Sets the disk path to disk_path if given, as the archive's folder paths
+	are relative to it
+	Returns the number of rows imported to each table
+	"""
+	if disk_path is not None and not Path(disk_path).is_dir():
+		raise ValueError(f'Disk path does not exist: {disk_path}')
+	
+	db = get_db()
+	with leased_task('Importing library'), gzip.open(
+		 path, 'rt', encoding = 'utf-8') as archive:
+		try:
+			header = json.loads(archive.readline())
+		except (json.JSONDecodeError, UnicodeDecodeError) as e:
+			raise ValueError('Not a library archive') from e
+		except EOFError as e:
+			raise ValueError('Archive is incomplete') from e
+		if not isinstance(header, dict) or header.get('format') != ARCHIVE_FORMAT:
+			raise ValueError('Not a library archive')
+		if header.get('version') != ARCHIVE_VERSION:
+			raise ValueError(f'Unsupported archive version {header.get("version")}')
+		
+		create_shadow_tables()
+		try:
+			counts = read_archive(archive)
+		except BaseException:
+			drop_shadow_tables()
+			raise
+		swap_shadow_tables()
+		# Archives from older versions don't have every sort key, and have
+		# dates as text
+		fill_sort_keys(db, only_missing = True)
+		convert_dates(db)
+		
+		if disk_path is not None:
+			db.execute('UPDATE params SET disk_path = ?', (disk_path, ))
+		# The library is as up to date as the export, so the scheduler
+		# plans the next refresh from now
+		db.execute('UPDATE params SET last_refreshed = ?, next_refresh = NULL',
+				   (datetime.now().replace(tzinfo = timezone.utc).timestamp(), ))
+		db.commit()
+		rank_folders()
+		bump_generation()
+		purge_orphans()
+		publish_snapshot()
+	
+	basepath = Path(get_params()['disk_path'])
+	missing = [row['folder_path'] for row in
+			   db.execute('SELECT folder_path FROM folders')
+			   if not basepath.joinpath(row['folder_path']).is_dir()]
+	if missing:
+		current_app.logger.warning(f'Import: {len(missing)} folders not found '
+								   f'in "{basepath}", e.g. "{missing[0]}"')
+	return counts
+
+def read_archive(archive):
+	"""
+	Insert the rows in an open archive into the library tables being built
+	Returns the number of rows read for each table
+	"""
+	db = get_db()
+	counts = {table: 0 for table in ARCHIVE_TABLES}
+	expected = None
+	query = None
+	batch = []
+	lines = iter(archive)
+	while True:
+		# gzip raises EOFError if the file is cut short
+		try:
+			line = next(lines, None)
+		except EOFError as e:
+			raise ValueError('Archive is incomplete') from e
+		if line is None:
+			break
+		record = json.loads(line)
+		if isinstance(record, dict) and 'counts' in record:
+			expected = record['counts']
+			break
+		if isinstance(record, dict):
+			# Start of a table
+			if batch:
+				db.executemany(query, batch)
+			if record.get('table') not in ARCHIVE_TABLES:
+				raise ValueError(f'Unknown table {record.get("table")}')
+			table = record['table']
+			target = library_table(table)
+			existing = [column['name'] for column in
+						db.execute('SELECT name FROM pragma_table_info(?)',
+								   (target, ))]
+			# Positions of the columns both versions have
+			keep = [index for index, column in enumerate(record['columns'])
+					if column in existing]
+			columns = ', '.join(record['columns'][index] for index in keep)
+			query = (f'INSERT INTO {target} ({columns}) '
+					 f"VALUES ({', '.join(['?'] * len(keep))})")
+			batch = []
+			continue
+		
+		if query is None:
+			raise ValueError('Row before table')
+		batch.append([record[index] for index in keep])
+		counts[table] += 1
+		if len(batch) >= IMPORT_BATCH:
+			db.executemany(query, batch)
+			batch = []
+	if expected is None:
+		raise ValueError('Archive is incomplete: it ends early')
+	if expected != counts:
+		raise ValueError(f'Archive is incomplete: expected {expected} rows, '
+						 f'found {counts}')
+	if batch:
+		db.executemany(query, batch)
+	db.commit()
+	return counts
@@ -0,0 +1,119 @@
+import os
+import re
+import hashlib
+import mimetypes
+import posixpath
+
+from flask import current_app, request
+
+# Fingerprinted files never change, so browsers can cache them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# References to other files in stylesheets, e.g. url('horizontal-1.svg')
+css_url_re = re.compile(r'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+
+def init_app(app):
+	"""
+	Fingerprint static files by their contents so url_for('static', ...)
+	links to e.g. style.0123456789ab.css, which is served with immutable
+	caching headers. Plain URLs are still served as before.
+	Skipped in debug mode, as files can change while the server is running.
+	"""
+	if app.debug:
+		return
+	app.extensions['assets'] = build_manifest(app.static_folder)
+	app.url_defaults(fingerprint_url)
+	app.view_functions['static'] = send_static
+
+def fingerprint(filename, digest):
+	"""Insert a digest before a file's extension: a/b.css to a/b.{digest}.css"""
+	stem, extension = posixpath.splitext(filename)
+	return f'{stem}.{digest}{extension}'
+
+def build_manifest(static_folder):
+	"""
+	Hash each file in the static folder
+	Stylesheets are hashed after their url() references are rewritten to the
+	fingerprinted names of the files they reference, and the rewritten copy
+	is kept to serve in place of the original
+	Returns a dict of {'urls': {filename: fingerprinted},
+					   'files': {fingerprinted: filename},
+					   'rewritten': {filename: bytes}}
+	"""
+	filenames = []
+	for folder, _, files in os.walk(static_folder):
+		for file in files:
+			path = os.path.relpath(os.path.join(folder, file), static_folder)
+			filenames.append(path.replace(os.sep, '/'))
+	
+	urls = {}
+	digests = {}
+	rewritten = {}
+	# Stylesheets last so the files they reference are already hashed
+	for filename in sorted(filenames, key = lambda f: f.endswith('.css')):
+		with open(os.path.join(static_folder, filename), 'rb') as file:
+			data = file.read()
+		
+		if filename.endswith('.css'):
+			folder = posixpath.dirname(filename)
+			
+			def replace_url(match):
+				quote, reference = match.groups()
+				target = posixpath.normpath(posixpath.join(folder, reference))
+				if ':' in reference or reference.startswith(('/', '#')):
+					# Absolute, data: or fragment URL
+					return match.group(0)
+				if target not in urls:
+					return match.group(0)
+				# Keep the reference relative
+				return (f'url({quote}' +
+						fingerprint(reference, digests[target]) + f'{quote})')
+			
+			data = css_url_re.sub(replace_url,
+								  data.decode('utf-8')).encode('utf-8')
+			rewritten[filename] = data
+		
+		digests[filename] = hashlib.sha1(data).hexdigest()[:12]
+		urls[filename] = fingerprint(filename, digests[filename])
+	
+	return {'urls': urls,
+			'files': {url: filename for filename, url in urls.items()},
+			'rewritten': rewritten}
+
+def source_filename(filename):
+	"""Returns the original name of a fingerprinted static filename"""
+	assets = current_app.extensions.get('assets')
+	if assets is None:
+		return filename
+	return assets['files'].get(filename, filename)
+
+def fingerprint_url(endpoint, values):
+	"""Link static files by their fingerprinted names"""
+	if endpoint != 'static' or 'filename' not in values:
+		return
+	url = current_app.extensions['assets']['urls'].get(values['filename'])
+	if url is not None:
+		values['filename'] = url
+
+def send_static(filename):
+	"""
+	Serve a static file, with immutable caching if requested by its
+	fingerprinted name
+	"""
+	assets = current_app.extensions['assets']
+	source = assets['files'].get(filename)
+	if source is None:
+		# Unversioned URL, default caching
+		return current_app.send_static_file(filename)
+	
+	if source in assets['rewritten']:
+		response = current_app.response_class(
+				   assets['rewritten'][source],
+				   mimetype = mimetypes.guess_type(source)[0])
+		response.set_etag(filename)
+		response.make_conditional(request)
+	else:
+		response = current_app.send_static_file(source)
+	
+	response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+	response.headers.pop('Expires', None)
+	return response
@@ -0,0 +1,147 @@
+import os
+import zlib
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from flask import current_app, request, safe_join
+
+from app.assets import source_filename
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Static files are only compressed once, so use the smallest output
+STATIC_LEVEL = {'br': 11, 'gzip': 9}
+
+def init_app(app):
+	"""
+	Compress responses after each request if enabled, and warn if Brotli
+	support is missing
+	"""
+	if not app.config['COMPRESS_RESPONSES']:
+		return
+	app.extensions['compress_cache'] = CompressCache(
+									   app.config['COMPRESS_CACHE_SIZE'])
+	app.after_request(compress_response)
+	with app.app_context():
+		if brotli is None:
+			current_app.logger.info('Brotli compression unavailable: '
+									'brotli is not installed')
+
+class CompressCache():
+	"""
+	Thread-safe cache of compressed response bodies, discarding the least
+	recently used once over max_size bytes
+	"""
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.size = 0
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+	
+	def get(self, key):
+		with self.lock:
+			data = self.entries.get(key)
+			if data is not None:
+				self.entries.move_to_end(key)
+			return data
+	
+	def set(self, key, data):
+		if len(data) > self.max_size:
+			return
+		with self.lock:
+			if key in self.entries:
+				return
+			self.entries[key] = data
+			self.size += len(data)
+			while self.size > self.max_size:
+				_, old = self.entries.popitem(last = False)
+				self.size -= len(old)
+
+def compress(data, encoding, level):
+	"""Compress bytes with 'br' or 'gzip' at the given level"""
+	if encoding == 'br':
+		return brotli.compress(data, quality = level)
+	# wbits = 31 writes a gzip header (with no timestamp, so output is stable)
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+	return compressor.compress(data) + compressor.flush()
+
+def negotiate_encoding():
+	"""Returns the preferred supported encoding, or None"""
+	encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+	return request.accept_encodings.best_match(encodings)
+
+def compress_response(response):
+	"""
+	Compress text responses over COMPRESS_MIN_SIZE bytes with Brotli or gzip
+	Static files and API responses are cached once compressed: static files
+	by path and modification time, API responses (and rewritten stylesheets)
+	by a digest of their body, which only changes when the library does
+	"""
+	config = current_app.config
+	if (response.status_code != 200 or
+		'Content-Encoding' in response.headers or
+		'no-transform' in response.cache_control or
+		response.mimetype not in config['COMPRESS_MIMETYPES']):
+		return response
+	
+	# Any response may vary, even if this client doesn't accept compression
+	response.vary.add('Accept-Encoding')
+	encoding = negotiate_encoding()
+	if encoding is None:
+		return response
+	cache = current_app.extensions['compress_cache']
+	
+	if response.direct_passthrough:
+		# File sent from disk: only compress static files we can read again
+		if request.endpoint != 'static':
+			return response
+		path = safe_join(current_app.static_folder,
+						 source_filename(request.view_args['filename']))
+		try:
+			stat = os.stat(path)
+		except (OSError, TypeError):
+			return response
+		if stat.st_size < config['COMPRESS_MIN_SIZE']:
+			return response
+		
+		key = ('static', path, stat.st_mtime_ns, stat.st_size, encoding)
+		data = cache.get(key)
+		if data is None:
+			with open(path, 'rb') as file:
+				data = compress(file.read(), encoding, STATIC_LEVEL[encoding])
+			cache.set(key, data)
+		# Close the file that would have been sent
+		response.close()
+		response.direct_passthrough = False
+	
+	else:
+		if response.is_streamed:
+			return response
+		body = response.get_data()
+		if len(body) < config['COMPRESS_MIN_SIZE']:
+			return response
+		
+		if request.blueprint == 'api' or request.endpoint == 'static':
+			key = ('body', hashlib.sha1(body).digest(), encoding)
+			data = cache.get(key)
+			if data is None:
+				data = compress(body, encoding,
+								config['COMPRESS_LEVEL'][encoding])
+				cache.set(key, data)
+		else:
+			# Pages include per-session tokens so aren't worth caching
+			data = compress(body, encoding, config['COMPRESS_LEVEL'][encoding])
+	
+	response.set_data(data)
+	response.headers['Content-Encoding'] = encoding
+	# Compressed bytes differ from the original's, but still match it for
+	# conditional requests (which use weak comparison)
+	etag, weak = response.get_etag()
+	if etag is not None and not weak:
+		response.set_etag(etag, weak = True)
+	return response
@@ -1,11 +1,18 @@
+/* Only applies to a new database file, flask db-maintain --vacuum converts */
+PRAGMA auto_vacuum = INCREMENTAL;
+
 DROP TABLE IF EXISTS folders;
 DROP TABLE IF EXISTS videos;
 DROP TABLE IF EXISTS videos_fts;
 DROP TABLE IF EXISTS thumbs;
+DROP TABLE IF EXISTS video_ranks;
+DROP TABLE IF EXISTS sprites;
 DROP TABLE IF EXISTS params;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS tasks;
+DROP TABLE IF EXISTS scan_checkpoints;
 DROP TABLE IF EXISTS error_log;
+DROP TABLE IF EXISTS maintenance_runs;
 
 CREATE TABLE folders (
 	id INTEGER PRIMARY KEY,
@@ -18,6 +25,7 @@ CREATE TABLE videos (
 	id INTEGER PRIMARY KEY,
 	folder_id INTEGER NOT NULL,
 	filename TEXT NOT NULL,
+	sort_filename TEXT,
 	thumbnail TEXT,
 	thumbnail_format TEXT,
 	position INTEGER,
@@ -27,8 +35,8 @@ CREATE TABLE videos (
 	title TEXT,
 	sort_title TEXT,
 	description TEXT,
-	upload_date TEXT,
-	modification_time TEXT,
+	upload_date INTEGER, /* seconds since epoch, midnight UTC on the day */
+	modification_time INTEGER, /* seconds since epoch */
 	uploader TEXT,
 	uploader_url TEXT,
 	duration INTEGER,
@@ -42,6 +50,7 @@ CREATE TABLE videos (
 	vcodec TEXT,
 	video_format TEXT,
 	fps NUMERIC,
+	raw_info TEXT,
 	FOREIGN KEY (folder_id) REFERENCES folders (id)
 );
 
@@ -56,6 +65,16 @@ CREATE VIRTUAL TABLE videos_fts USING fts5 (
 	tokenize = 'trigram'
 );
 
+/* In playlist order, falling back to playlist_index, position then id */
+CREATE INDEX videos_sort_title ON videos
+	(folder_id, sort_title, playlist_index, position);
+CREATE INDEX videos_sort_filename ON videos
+	(folder_id, sort_filename, playlist_index, position);
+CREATE INDEX videos_upload_date ON videos
+	(folder_id, upload_date, playlist_index, position);
+CREATE INDEX videos_modification_time ON videos
+	(folder_id, modification_time, playlist_index, position);
+
 CREATE TRIGGER videos_ai AFTER INSERT ON videos
 	BEGIN
 		INSERT INTO videos_fts (
@@ -96,15 +115,78 @@ CREATE TRIGGER videos_ad AFTER DELETE ON videos
 		);
 	END;
 
+CREATE TRIGGER videos_au AFTER UPDATE OF title, description, uploader, categories, tags ON videos
+	BEGIN
+		INSERT INTO videos_fts (
+			videos_fts,
+			rowid,
+			title,
+			description,
+			uploader,
+			categories,
+			tags
+		) VALUES (
+			'delete',
+			old.id,
+			old.title,
+			old.description,
+			old.uploader,
+			old.categories,
+			old.tags
+		);
+		INSERT INTO videos_fts (
+			rowid,
+			title,
+			description,
+			uploader,
+			categories,
+			tags
+		) VALUES (
+			new.id,
+			new.title,
+			new.description,
+			new.uploader,
+			new.categories,
+			new.tags
+		);
+	END;
+
 CREATE TABLE thumbs (
 	id INTEGER PRIMARY KEY,
 	video_id INTEGER NOT NULL,
 	thumb_format TEXT,
 	thumb_data TEXT,
 	format_priority INTEGER,
+	scale INTEGER NOT NULL DEFAULT 1,
 	FOREIGN KEY (video_id) REFERENCES videos (id)
 );
 
+CREATE INDEX thumbs_video_id ON thumbs (video_id);
+
+/* Position of each video in its folder in ascending order of each of
+   SORT_COLUMNS, kept up to date by scans */
+CREATE TABLE video_ranks (
+	folder_id INTEGER NOT NULL,
+	sort_by TEXT NOT NULL,
+	sort_rank INTEGER NOT NULL,
+	video_id INTEGER NOT NULL,
+	PRIMARY KEY (folder_id, sort_by, sort_rank)
+) WITHOUT ROWID;
+
+CREATE INDEX video_ranks_video_id ON video_ranks (video_id, sort_by);
+
+/* Thumbnails of a page of a playlist in one image, built on request */
+CREATE TABLE sprites (
+	folder_id INTEGER NOT NULL,
+	sort_by TEXT NOT NULL,
+	sort_direction TEXT NOT NULL,
+	sheet INTEGER NOT NULL,
+	sprite_format TEXT NOT NULL,
+	generation INTEGER NOT NULL,
+	sprite_data BLOB NOT NULL,
+	PRIMARY KEY (folder_id, sort_by, sort_direction, sheet, sprite_format)
+);
+
 CREATE TABLE params (
 	setup_complete INTEGER NOT NULL,
 	last_refreshed NUMERIC NOT NULL,
@@ -116,7 +198,11 @@ CREATE TABLE params (
 	filename_delimiter TEXT,
 	generate_thumbs INTEGER NOT NULL,
 	replace_underscores INTEGER NOT NULL,
-	guests_can_view INTEGER NOT NULL
+	guests_can_view INTEGER NOT NULL,
+	generation INTEGER NOT NULL DEFAULT 0,
+	next_refresh NUMERIC,
+	/* 1 if titles need deriving again with changed filename settings */
+	rederive_pending INTEGER NOT NULL DEFAULT 0
 );
 
 INSERT INTO params (
@@ -159,13 +245,34 @@ CREATE TABLE tasks (
 	of_folders INTEGER,
 	file INTEGER,
 	of_files INTEGER,
-	message TEXT
+	message TEXT,
+	scan TEXT,
+	cancel INTEGER NOT NULL DEFAULT 0,
+	owner TEXT,
+	heartbeat REAL
 	);
 
 INSERT INTO tasks (status) VALUES (0);
 
+CREATE TABLE scan_checkpoints (
+	folder_path TEXT PRIMARY KEY,
+	done INTEGER NOT NULL DEFAULT 0
+);
+
 CREATE TABLE error_log (
 	timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
 	level TEXT NOT NULL,
 	message TEXT NOT NULL
-);
\ No newline at end of file
+);
+
+/* started = seconds since epoch, duration in seconds, sizes in bytes */
+CREATE TABLE maintenance_runs (
+	started NUMERIC NOT NULL,
+	duration REAL,
+	size_before INTEGER,
+	size_after INTEGER,
+	integrity TEXT
+);
+
+/* Number of migrations in db.py this schema includes */
+PRAGMA user_version = 11;
\ No newline at end of file
@@ -1,4 +1,7 @@
 import os
+import re
+import time
+from pathlib import Path
 try:
 	from pysqlite3 import dbapi2 as sqlite3
 except ImportError:
@@ -19,7 +22,8 @@ from flask import (Blueprint, flash, redirect, render_template, request,
 from flask_wtf import FlaskForm
 from wtforms import SubmitField
 
-from app.helpers import check_conf
+from app.helpers import check_conf, sort_key
+from app.events import publish_event
 
 blueprint = Blueprint('db', __name__)
 
@@ -53,25 +57,164 @@ class InitForm(FlaskForm):
 def init_app(app):
 	"""
 	Close the database connection after returning the response,
-	and allow creating the database from the CLI
+	allow creating the database from the CLI and update the schema
+	of an existing database
 	"""
 	app.teardown_appcontext(close_db)
 	app.cli.add_command(create_db_command)
+	with app.app_context():
+		try:
+			migrate_db()
+		except sqlite3.OperationalError as e:
+			current_app.logger.error(f'Could not update database: {e}')
 
 def get_db():
 	"""
 	Connect to the database (if not in the current request context)
 	Creates the database file if it doesn't exist
+	With SNAPSHOT_READER, connects to the newest published snapshot instead
 	"""
 	if 'db' not in g:
-		# Get types from columns
-		g.db = sqlite3.connect(os.path.join(current_app.instance_path, 
-											current_app.config['DATABASE']),
-							   detect_types = sqlite3.PARSE_DECLTYPES)
+		if current_app.config['SNAPSHOT_READER']:
+			g.db = connect_snapshot()
+		else:
+			# Get types from columns
+			g.db = sqlite3.connect(os.path.join(current_app.instance_path, 
+												current_app.config['DATABASE']),
+								   detect_types = sqlite3.PARSE_DECLTYPES)
 		# Return rows as dicts
 		g.db.row_factory = sqlite3.Row
 	return g.db
 
+# Snapshots are named library-<version>.sqlite, newest has the highest version
+snapshot_name_re = re.compile(r'^library-(\d+)\.sqlite$')
+# Tables snapshot readers write to, kept in their own database
+USER_TABLES = ['users', 'error_log', 'tasks', 'sprites']
+# Newest snapshot seen by this process and when it was looked for
+latest_snapshot_cache = {'path': None, 'checked': 0}
+
+def list_snapshots(path):
+	"""Returns [(version, filename)] of the snapshots in path, oldest first"""
+	snapshots = []
+	for name in os.listdir(path):
+		match = snapshot_name_re.match(name)
+		if match:
+			snapshots.append((int(match.group(1)), name))
+	return sorted(snapshots)
+
+def latest_snapshot():
+	"""
+	Returns the path of the newest snapshot in SNAPSHOT_PATH, looking for a
+	newer one at most every SNAPSHOT_POLL seconds
+	"""
+	cache = latest_snapshot_cache
+	if time.monotonic() - cache['checked'] >= current_app.config['SNAPSHOT_POLL']:
+		path = current_app.config['SNAPSHOT_PATH']
+		snapshots = list_snapshots(path)
+		if snapshots:
+			cache['path'] = os.path.join(path, snapshots[-1][1])
+		cache['checked'] = time.monotonic()
+	return cache['path']
+
+def connect_snapshot():
+	"""
+	Connect to the writable USER_DATABASE with the newest snapshot attached
+	read-only
+	Snapshots are never changed once published, so are opened immutable
+	(without locking or checking for changes). Unqualified table names find
+	USER_TABLES in the user database first and the library in the snapshot
+	The user database follows the snapshot's schema version, so its tables
+	are updated when a snapshot from a newer version is published
+	"""
+	try:
+		snapshot = latest_snapshot()
+	except OSError as e:
+		raise sqlite3.OperationalError(f'Could not list snapshots: {e}') from e
+	if snapshot is None:
+		raise sqlite3.OperationalError('No snapshot published to SNAPSHOT_PATH yet')
+	
+	db = sqlite3.connect(os.path.join(current_app.instance_path,
+									  current_app.config['USER_DATABASE']),
+						 detect_types = sqlite3.PARSE_DECLTYPES, uri = True)
+	db.execute('ATTACH DATABASE ? AS library',
+			   (Path(snapshot).resolve().as_uri() + '?mode=ro&immutable=1', ))
+	if (db.execute('PRAGMA main.user_version').fetchone()[0] !=
+		db.execute('PRAGMA library.user_version').fetchone()[0]):
+		create_user_db(db)
+	return db
+
+def create_user_db(db):
+	"""
+	Create USER_TABLES in a snapshot reader's user database with the
+	snapshot's schema, starting with its users, or recreate them if the
+	snapshot's schema version has changed, keeping their rows' values in
+	the columns both versions have
+	"""
+	# Other workers may be connecting to a new snapshot too
+	db.execute('BEGIN IMMEDIATE')
+	try:
+		version = db.execute('PRAGMA library.user_version').fetchone()[0]
+		if db.execute('PRAGMA main.user_version').fetchone()[0] == version:
+			db.rollback()
+			return
+		for table in USER_TABLES:
+			old_columns = [row[0] for row in db.execute(
+				"SELECT name FROM pragma_table_info( ?, 'main' )", (table, ))]
+			if old_columns:
+				db.execute(f'ALTER TABLE main.{table} RENAME TO {table}_old')
+			db.execute(db.execute("SELECT sql FROM library.sqlite_master "
+								  "WHERE type = 'table' AND name = ?",
+								  (table, )).fetchone()[0])
+			if old_columns:
+				columns = ', '.join(row[0] for row in db.execute(
+					"SELECT name FROM pragma_table_info( ?, 'main' )", (table, ))
+					if row[0] in old_columns)
+				db.execute(f'INSERT INTO main.{table} ({columns}) '
+						   f'SELECT {columns} FROM main.{table}_old')
+				db.execute(f'DROP TABLE main.{table}_old')
+			elif table == 'users':
+				db.execute('INSERT INTO main.users SELECT * FROM library.users')
+		if db.execute('SELECT COUNT(*) FROM main.tasks').fetchone()[0] == 0:
+			db.execute('INSERT INTO main.tasks (status) VALUES (0)')
+		db.execute(f'PRAGMA main.user_version = {version:d}')
+	except BaseException:
+		db.rollback()
+		raise
+	db.commit()
+
+def publish_snapshot():
+	"""
+	Write a consistent, compacted copy of the database to SNAPSHOT_PATH for
+	snapshot readers, if set, keeping the newest SNAPSHOT_KEEP
+	Returns the snapshot's path, or None if not publishing
+	"""
+	path = current_app.config['SNAPSHOT_PATH']
+	if not path or current_app.config['SNAPSHOT_READER']:
+		return None
+	os.makedirs(path, exist_ok = True)
+	snapshots = list_snapshots(path)
+	version = snapshots[-1][0] + 1 if snapshots else 1
+	snapshot = os.path.join(path, f'library-{version:08d}.sqlite')
+	# Readers only see it once complete
+	partial = snapshot + '.partial'
+	if os.path.exists(partial):
+		os.remove(partial)
+	
+	db = get_db()
+	# Can't run within a transaction
+	db.commit()
+	db.execute('VACUUM INTO ?', (partial, ))
+	os.replace(partial, snapshot)
+	
+	# Older snapshots are only open until readers' current requests finish
+	keep = max(current_app.config['SNAPSHOT_KEEP'] - 1, 0)
+	for _, name in snapshots[:len(snapshots) - keep]:
+		try:
+			os.remove(os.path.join(path, name))
+		except OSError as e:
+			current_app.logger.warning(f'Could not remove old snapshot {name}: {e}')
+	return snapshot
+
 def close_db(e = None):
 	"""Close the database connections if they exist"""
 	db = g.pop('db', None)
@@ -84,6 +227,362 @@ def create_db():
 		get_db().executescript(file.read().decode('utf8'))
 	get_db().commit()
 
+def add_sort_keys(db):
+	"""
+	Migration 9: natural, case and accent insensitive sort keys for titles
+	and filenames, computed for existing videos. Playlists are sorted on
+	request until the next refresh ranks them again
+	"""
+	db.execute('BEGIN')
+	db.execute('ALTER TABLE videos ADD COLUMN sort_filename TEXT')
+	# In playlist order, falling back to playlist_index, position then id
+	db.execute('CREATE INDEX videos_sort_title ON videos '
+			   '(folder_id, sort_title, playlist_index, position)')
+	db.execute('CREATE INDEX videos_sort_filename ON videos '
+			   '(folder_id, sort_filename, playlist_index, position)')
+	# Only updates to searched columns update the search index
+	trigger = db.execute("SELECT sql FROM sqlite_master "
+						 "WHERE name = 'videos_au'").fetchone()[0]
+	db.execute('DROP TRIGGER videos_au')
+	db.execute(trigger.replace('AFTER UPDATE ON', 'AFTER UPDATE OF title, '
+							   'description, uploader, categories, tags ON', 1))
+	fill_sort_keys(db)
+	db.execute('DELETE FROM video_ranks')
+
+def fill_sort_keys(db, only_missing = False):
+	"""
+	Compute the sort keys of videos from their titles and filenames, or only
+	those without, e.g. imported from an older version
+	"""
+	where = 'WHERE sort_filename IS NULL' if only_missing else ''
+	videos = db.execute(f'SELECT id, title, filename FROM videos {where}').fetchall()
+	db.executemany('UPDATE videos SET sort_title = ?, sort_filename = ? '
+				   'WHERE id = ?', ((sort_key(video['title']),
+									 sort_key(video['filename']),
+									 video['id']) for video in videos))
+
+def convert_dates(db):
+	"""
+	Convert upload dates and modification times stored as text (from
+	datetimes) to seconds since epoch. Upload dates are days, kept at
+	midnight UTC, and modification times were local time
+	"""
+	db.execute("UPDATE videos SET upload_date = "
+			   "CAST(strftime('%s', upload_date) AS INTEGER) "
+			   "WHERE typeof(upload_date) = 'text'")
+	db.execute("UPDATE videos SET modification_time = "
+			   "CAST(strftime('%s', modification_time, 'utc') AS INTEGER) "
+			   "WHERE typeof(modification_time) = 'text'")
+
+def epoch_dates(db):
+	"""
+	Migration 10: store dates as integers, rebuilding the videos table as
+	SQLite can't change the type of a column. Row IDs are kept, so the
+	search index still matches. An interrupted rescan's shadow tables are
+	dropped, so the next rescan starts again
+	"""
+	db.execute('BEGIN')
+	for table in LIBRARY_TABLES:
+		db.execute(f'DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX}')
+	db.execute('DELETE FROM scan_checkpoints')
+	
+	schema = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' "
+						"AND name = 'videos'").fetchone()[0]
+	# Indexes and triggers are dropped with the table
+	extras = [row[0] for row in db.execute(
+			  "SELECT sql FROM sqlite_master WHERE tbl_name = 'videos' "
+			  "AND type IN ('index', 'trigger') AND sql IS NOT NULL")]
+	schema = re.sub(r'\b(upload_date|modification_time) TEXT\b', r'\1 INTEGER',
+					schema)
+	db.execute(schema.replace('CREATE TABLE videos', 'CREATE TABLE videos_epoch', 1))
+	db.execute('INSERT INTO videos_epoch SELECT * FROM videos')
+	db.execute('DROP TABLE videos')
+	db.execute('ALTER TABLE videos_epoch RENAME TO videos')
+	for sql in extras:
+		db.execute(sql)
+	convert_dates(db)
+	# In playlist order, falling back to playlist_index, position then id
+	db.execute('CREATE INDEX videos_upload_date ON videos '
+			   '(folder_id, upload_date, playlist_index, position)')
+	db.execute('CREATE INDEX videos_modification_time ON videos '
+			   '(folder_id, modification_time, playlist_index, position)')
+
+# Schema changes since the first version, applied in order to existing
+# databases by migrate_db. create_db.sql always creates the latest schema, so
+# add any changes there too and set its user_version to len(MIGRATIONS)
+MIGRATIONS = [
+	# 1: Library generation, sprite sheet cache, thumbnail lookup by video
+	"""
+	ALTER TABLE params ADD COLUMN generation INTEGER NOT NULL DEFAULT 0;
+	CREATE TABLE sprites (
+		folder_id INTEGER NOT NULL,
+		sort_by TEXT NOT NULL,
+		sort_direction TEXT NOT NULL,
+		sheet INTEGER NOT NULL,
+		sprite_format TEXT NOT NULL,
+		generation INTEGER NOT NULL,
+		sprite_data BLOB NOT NULL,
+		PRIMARY KEY (folder_id, sort_by, sort_direction, sheet, sprite_format)
+	);
+	CREATE INDEX thumbs_video_id ON thumbs (video_id);
+	""",
+	# 2: Thumbnails at several sizes
+	"""
+	ALTER TABLE thumbs ADD COLUMN scale INTEGER NOT NULL DEFAULT 1;
+	""",
+	# 3: Resumable, cancellable scans
+	"""
+	ALTER TABLE tasks ADD COLUMN scan TEXT;
+	ALTER TABLE tasks ADD COLUMN cancel INTEGER NOT NULL DEFAULT 0;
+	CREATE TABLE scan_checkpoints (
+		folder_path TEXT PRIMARY KEY,
+		done INTEGER NOT NULL DEFAULT 0
+	);
+	""",
+	# 4: Task lease across processes
+	"""
+	ALTER TABLE tasks ADD COLUMN owner TEXT;
+	ALTER TABLE tasks ADD COLUMN heartbeat REAL;
+	""",
+	# 5: Server-side refresh schedule
+	"""
+	ALTER TABLE params ADD COLUMN next_refresh NUMERIC;
+	""",
+	# 6: Database maintenance history
+	"""
+	CREATE TABLE maintenance_runs (
+		started NUMERIC NOT NULL,
+		duration REAL,
+		size_before INTEGER,
+		size_after INTEGER,
+		integrity TEXT
+	);
+	""",
+	# 7: Filename and .info.json fields kept to re-derive titles, and search
+	# index kept in step with updated videos
+	"""
+	ALTER TABLE videos ADD COLUMN raw_info TEXT;
+	CREATE TRIGGER videos_au AFTER UPDATE ON videos
+		BEGIN
+			INSERT INTO videos_fts (
+				videos_fts,
+				rowid,
+				title,
+				description,
+				uploader,
+				categories,
+				tags
+			) VALUES (
+				'delete',
+				old.id,
+				old.title,
+				old.description,
+				old.uploader,
+				old.categories,
+				old.tags
+			);
+			INSERT INTO videos_fts (
+				rowid,
+				title,
+				description,
+				uploader,
+				categories,
+				tags
+			) VALUES (
+				new.id,
+				new.title,
+				new.description,
+				new.uploader,
+				new.categories,
+				new.tags
+			);
+		END;
+	""",
+	# 8: Precomputed playlist order, filled in by the next refresh
+	"""
+	CREATE TABLE video_ranks (
+		folder_id INTEGER NOT NULL,
+		sort_by TEXT NOT NULL,
+		sort_rank INTEGER NOT NULL,
+		video_id INTEGER NOT NULL,
+		PRIMARY KEY (folder_id, sort_by, sort_rank)
+	) WITHOUT ROWID;
+	
+	CREATE INDEX video_ranks_video_id ON video_ranks (video_id, sort_by);
+	""",
+	# 9: Natural sort keys
+	add_sort_keys,
+	# 10: Dates as seconds since epoch
+	epoch_dates,
+	# 11: Titles waiting to be derived again with new filename settings
+	"""
+	ALTER TABLE params ADD COLUMN rederive_pending INTEGER NOT NULL DEFAULT 0;
+	"""
+]
+
+def migrate_db():
+	"""
+	Apply any migrations newer than the database's user_version
+	Databases that haven't been created yet are left alone
+	"""
+	db = get_db()
+	if db.execute("SELECT COUNT(*) FROM sqlite_master "
+				  "WHERE type = 'table' AND name = 'params'").fetchone()[0] == 0:
+		return
+	version = db.execute('PRAGMA user_version').fetchone()[0]
+	for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+		current_app.logger.info(f'Updating database to version {number}')
+		if callable(migration):
+			migration(db)
+			db.execute(f'PRAGMA user_version = {number}')
+			db.commit()
+		else:
+			# Schema and version change together or not at all
+			db.executescript(f'BEGIN; {migration} '
+							 f'PRAGMA user_version = {number}; COMMIT;')
+
+def bump_generation():
+	"""
+	Mark the library as changed, invalidating anything cached from it
+	Returns the new generation
+	"""
+	db = get_db()
+	db.execute('UPDATE params SET generation = generation + 1')
+	db.commit()
+	generation = get_params()['generation']
+	publish_event('generation', generation)
+	return generation
+
+def free_bytes():
+	"""
+	Returns the size of unused pages in the database file, reused by later
+	writes or returned to the filesystem by VACUUM
+	"""
+	db = get_db()
+	return (db.execute('PRAGMA freelist_count').fetchone()[0] *
+			db.execute('PRAGMA page_size').fetchone()[0])
+
+# Tables a full rescan rebuilds, in dependency order
+LIBRARY_TABLES = ['folders', 'videos', 'videos_fts', 'thumbs', 'video_ranks']
+SHADOW_SUFFIX = '_shadow'
+
+def library_table(name):
+	"""
+	Returns the name of a library table to write to: its shadow copy while
+	a full rescan is being built in this app context
+	"""
+	if g.get('building_shadow'):
+		return name + SHADOW_SUFFIX
+	return name
+
+def shadow_name(name):
+	"""
+	Index names must be unique, so the copies of those on the live tables
+	alternate between having SHADOW_SUFFIX and not
+	"""
+	if name.endswith(SHADOW_SUFFIX):
+		return name[:-len(SHADOW_SUFFIX)]
+	return name + SHADOW_SUFFIX
+
+def create_shadow_tables():
+	"""
+	Create empty copies of the library tables and their indexes from the
+	live schema. Any left by an earlier failed rescan are replaced. Writes in
+	this app context go to the copies until swapped
+	Triggers are left off, so the copies fill faster and the search index is
+	built once before they're swapped
+	"""
+	db = get_db()
+	drop_shadow_tables()
+	tables = '|'.join(LIBRARY_TABLES)
+	query = ('SELECT type, name, sql FROM sqlite_master '
+			f"WHERE tbl_name IN ({', '.join(['?'] * len(LIBRARY_TABLES))}) "
+			 "AND type IN ('table', 'index') AND sql IS NOT NULL "
+			 # Tables before the indexes on them
+			 "ORDER BY type != 'table'")
+	for item in db.execute(query, LIBRARY_TABLES).fetchall():
+		# Point references to library tables at their shadows
+		sql = re.sub(rf'\b({tables})\b', rf'\1{SHADOW_SUFFIX}', item['sql'])
+		# except the search index's content table, which is the live name
+		# once swapped
+		sql = re.sub(rf"(content\s*=\s*')(\w+){SHADOW_SUFFIX}'", r"\1\2'", sql)
+		if item['type'] == 'index':
+			sql = sql.replace(item['name'], shadow_name(item['name']), 1)
+		db.execute(sql)
+	db.commit()
+	g.building_shadow = True
+
+def resume_shadow_tables():
+	"""
+	Continue writing to the shadow copies left by an interrupted rescan
+	Returns False if they don't all exist
+	"""
+	names = [table + SHADOW_SUFFIX for table in LIBRARY_TABLES]
+	query = ("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+			f"AND name IN ({', '.join(['?'] * len(names))})")
+	if get_db().execute(query, names).fetchone()[0] < len(names):
+		return False
+	g.building_shadow = True
+	return True
+
+def index_shadow_tables():
+	"""
+	Fill the shadow copy of the search index from the shadow videos, so the
+	swap only renames tables. Its content table is the live name, so it's
+	filled by inserting each row rather than rebuilt, after clearing any
+	rows from an interrupted swap
+	"""
+	db = get_db()
+	fts = 'videos_fts' + SHADOW_SUFFIX
+	columns = ', '.join(row['name'] for row in db.execute(
+		'SELECT name FROM pragma_table_info( ? )', (fts, )))
+	with db:
+		db.execute(f"INSERT INTO {fts} ({fts}) VALUES ('delete-all')")
+		db.execute(f'INSERT INTO {fts} (rowid, {columns}) '
+				   f'SELECT id, {columns} FROM videos{SHADOW_SUFFIX}')
+
+def swap_shadow_tables():
+	"""
+	Index the shadow copies, then replace the library tables with them in
+	one transaction, so readers see either the old library or the new one,
+	and recreate the live tables' triggers
+	"""
+	index_shadow_tables()
+	db = get_db()
+	g.building_shadow = False
+	query = ("SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+			f"AND tbl_name IN ({', '.join(['?'] * len(LIBRARY_TABLES))})")
+	# The sqlite3 module doesn't begin a transaction before DROP or ALTER
+	db.commit()
+	db.execute('BEGIN IMMEDIATE')
+	try:
+		triggers = [row['sql'] for row in db.execute(query, LIBRARY_TABLES)]
+		# Dropping a table drops its indexes and triggers
+		for table in reversed(LIBRARY_TABLES):
+			db.execute(f'DROP TABLE IF EXISTS {table}')
+		for table in LIBRARY_TABLES:
+			db.execute(f'ALTER TABLE {table}{SHADOW_SUFFIX} RENAME TO {table}')
+		for trigger in triggers:
+			db.execute(trigger)
+	except BaseException:
+		db.rollback()
+		raise
+	db.commit()
+
+def drop_shadow_tables():
+	"""Drop shadow copies of the library tables, if any"""
+	db = get_db()
+	g.building_shadow = False
+	db.commit()
+	db.execute('BEGIN IMMEDIATE')
+	try:
+		for table in reversed(LIBRARY_TABLES):
+			db.execute(f'DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX}')
+	except BaseException:
+		db.rollback()
+		raise
+	db.commit()
+
 def column_exists(table, column):
 	"""Returns True if both the provided table and column exist"""
 	query = 'SELECT COUNT(*) FROM pragma_table_info( ? ) WHERE name = ?'
@@ -0,0 +1,93 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+import json
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+def init_app(app):
+	"""Share task and library changes with event streams in this process"""
+	app.extensions['events'] = Broadcaster()
+
+class Broadcaster():
+	"""
+	Thread-safe store of the latest value of each named event, waking the
+	streams waiting on it when one changes
+	Streams only get the latest value, so a slow client skips intermediate
+	progress rather than queueing it
+	"""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.version = 0
+		self.events = {}
+		self.listeners = 0
+		self.watcher = None
+	
+	def publish(self, name, data):
+		with self.condition:
+			if name in self.events and self.events[name][1] == data:
+				return
+			self.version += 1
+			self.events[name] = (self.version, data)
+			self.condition.notify_all()
+	
+	def wait(self, since, timeout):
+		"""
+		Wait up to timeout seconds for events newer than version since
+		Returns (latest version, [(name, data), ...])
+		"""
+		with self.condition:
+			self.condition.wait_for(lambda: self.version > since, timeout)
+			return self.version, [(name, data) for name, (version, data)
+								  in self.events.items() if version > since]
+	
+	@contextmanager
+	def listening(self):
+		"""Count a stream as listening while in this context"""
+		with self.condition:
+			self.listeners += 1
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.listeners -= 1
+	
+	def watch(self, app, refresh, interval):
+		"""
+		Call refresh() in an app context every interval seconds while
+		streams are listening, to publish changes made by other processes
+		"""
+		with self.condition:
+			if self.watcher is not None and self.watcher.is_alive():
+				return
+			self.watcher = threading.Thread(target = self.run_watcher,
+											args = (app, refresh, interval),
+											daemon = True)
+			self.watcher.start()
+	
+	def run_watcher(self, app, refresh, interval):
+		stop = threading.Event()
+		while not stop.wait(interval):
+			with self.condition:
+				if self.listeners == 0:
+					self.watcher = None
+					return
+			with app.app_context():
+				try:
+					refresh()
+				except sqlite3.OperationalError as e:
+					app.logger.warning(f'Could not check for changes: {e}')
+
+def publish_event(name, data):
+	"""Send an event to this process's streams"""
+	broadcaster = current_app.extensions.get('events')
+	if broadcaster is not None:
+		broadcaster.publish(name, data)
+
+def format_event(name, data):
+	"""Returns an event in text/event-stream format, with data as JSON"""
+	return f'event: {name}\ndata: {json.dumps(data)}\n\n'
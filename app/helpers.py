@@ -1,4 +1,5 @@
 import re
+import unicodedata
 
 from flask import current_app, g, flash
 
@@ -20,7 +21,10 @@ def check_conf():
 		flash('Development keys are in use. Your cookies are not secure! Copy config.py-dist to instance/config.py and set SECRET_KEY to dismiss this message.', 'warn')
 
 def format_duration(seconds):
-	"""Converts int seconds to a DD:HH:MM:SS / HH:MM:SS / MM:SS / 0:SS-style duration, without leading zeroes"""
+	"""
+	Converts int seconds to a DD:HH:MM:SS / HH:MM:SS / MM:SS / 0:SS-style duration, without leading zeroes
+	Keep in step with formatDuration in static/video.js, which formats durations returned as columns
+	"""
 	try:
 		int(seconds)
 	except (TypeError, ValueError):
@@ -37,6 +41,36 @@ def format_duration(seconds):
 	else:
 		return f'0:{seconds:02d}'
 
+def format_size(size):
+	"""Converts int bytes to a 1.5 MB-style size"""
+	for unit in ('bytes', 'KB', 'MB', 'GB'):
+		if size < 1024 or unit == 'GB':
+			break
+		size /= 1024
+	return f'{size:.0f} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+
+sort_separator_re = re.compile(r'[\W_]+')
+sort_number_re = re.compile(r'[0-9]+')
+def sort_key(text):
+	"""
+	Converts text to a key that sorts naturally as plain text: case and
+	accents are ignored, punctuation and spaces count as one space, and
+	numbers sort by value (2 before 10)
+	"""
+	if text is None:
+		return None
+	# Split accents from letters, then drop them
+	text = ''.join(char for char in unicodedata.normalize('NFKD', text)
+				   if not unicodedata.combining(char)).casefold()
+	text = sort_separator_re.sub(' ', text).strip()
+	# Prefix numbers with their length, so longer numbers sort after shorter
+	return sort_number_re.sub(lambda match: sort_number(match.group()), text)
+
+def sort_number(digits):
+	"""Returns a number's digits prefixed by how many there are, e.g. 02 10"""
+	digits = digits.lstrip('0') or '0'
+	return f'{len(digits):02d}{digits}'
+
 escape_fts_re = re.compile(r'\s+|(".*?")')
 def escape_fts_query(query):
 	"""Escape a search query string to fit FTS query syntax"""
@@ -65,7 +65,9 @@ def index(item_type, item_id):
 						   api_available = api_available,
 						   display_prefs = display_prefs,
 						   web_path = params['web_path'],
-						   get_thumbs = get_thumbs)
+						   get_thumbs = get_thumbs,
+						   thumb_urls = current_app.config['LAZY_THUMBNAILS'],
+						   generation = params['generation'])
 
 @blueprint.route('/log', methods = ('GET', 'POST'), defaults = {'page': 1})
 @blueprint.route('/log/<int:page>', methods = ('GET', 'POST'))
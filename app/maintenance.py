@@ -0,0 +1,167 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.db import get_db, free_bytes
+from app.api import leased_task
+from app.helpers import format_size
+
+# PRAGMA auto_vacuum value that frees pages with PRAGMA incremental_vacuum
+INCREMENTAL = 2
+
+def init_app(app):
+	"""Allow maintaining the database from the CLI with flask db-maintain"""
+	app.cli.add_command(maintain_db_command)
+
+@click.command('db-maintain')
+@click.option('--full', is_flag = True,
+			  help = 'Full integrity check and FTS optimize (slower).')
+@click.option('--vacuum', is_flag = True,
+			  help = 'Switch the database to incremental vacuum, rewriting '
+					 'it once if needed (blocks writes while it runs).')
+@with_appcontext
+def maintain_db_command(full, vacuum):
+	"""
+	Tidy up the database with flask db-maintain, as scheduled refreshes do
+	every MAINTENANCE_INTERVAL
+	"""
+	try:
+		run = maintain_db(full = full, vacuum = vacuum)
+	except BlockingIOError as e:
+		click.echo(str(e), err = True)
+	except sqlite3.OperationalError as e:
+		click.echo(f'Database error: {e}', err = True)
+	else:
+		click.echo(f'Integrity: {run["integrity"]}')
+		click.echo(f'Size: {format_size(run["size_before"])} before, '
+				   f'{format_size(run["size_after"])} after '
+				   f'({run["duration"]:.1f} seconds)')
+		if run['note']:
+			click.echo(run['note'])
+
+def database_size():
+	"""Returns the size of the database file in bytes, from its page count"""
+	db = get_db()
+	return (db.execute('PRAGMA page_count').fetchone()[0] *
+			db.execute('PRAGMA page_size').fetchone()[0])
+
+def claim_maintenance(now, interval):
+	"""
+	Record a run starting at now if none started in the last interval
+	seconds, in one statement so only one process runs it
+	Returns the run's ID, or None if another run is due or running
+	"""
+	db = get_db()
+	cursor = db.execute('INSERT INTO maintenance_runs (started) SELECT ? '
+						'WHERE NOT EXISTS (SELECT 1 FROM maintenance_runs '
+						'WHERE started > ?)', (now, now - interval))
+	db.commit()
+	return cursor.lastrowid if cursor.rowcount > 0 else None
+
+def maintain_db(full = False, vacuum = False, run_id = None):
+	"""
+	Check and tidy up the database in short transactions, so it can run while
+	the app is serving, holding the task's lease so no scan can start:
+	- Check integrity (quick_check unless full) of the database and search
+	  index
+	- Merge the search index's segments (all at once if full)
+	- Update statistics for the query planner with ANALYZE / PRAGMA optimize
+	- Return free pages to the filesystem with bounded incremental_vacuum
+	  steps, if the database was created or switched (vacuum) to allow it
+	Records the run in maintenance_runs (updating run_id if claimed by
+	claim_maintenance) and returns it as a dict
+	"""
+	with leased_task('Maintaining database'):
+		return run_maintenance(full, vacuum, run_id)
+
+def run_maintenance(full, vacuum, run_id):
+	"""Maintain the database for maintain_db, which holds the task's lease"""
+	db = get_db()
+	config = current_app.config
+	started = time.time()
+	size_before = database_size()
+	note = None
+	if run_id is None:
+		run_id = db.execute('INSERT INTO maintenance_runs (started) VALUES (?)',
+							(started, )).lastrowid
+		db.commit()
+	
+	# Integrity, reporting the first few problems
+	check = 'integrity_check' if full else 'quick_check'
+	problems = [row[0] for row in db.execute(f'PRAGMA {check}(10)')]
+	integrity = '; '.join(problems)
+	try:
+		db.execute("INSERT INTO videos_fts (videos_fts) VALUES ('integrity-check')")
+		db.commit()
+	except sqlite3.OperationalError:
+		raise
+	except sqlite3.DatabaseError as e:
+		db.rollback()
+		integrity += f'; search index: {e}'
+	if integrity != 'ok':
+		current_app.logger.error(f'Maintenance: Integrity check failed: {integrity}')
+	
+	# Search index segments, merged a few pages at a time
+	if full:
+		db.execute("INSERT INTO videos_fts (videos_fts) VALUES ('optimize')")
+		db.commit()
+	else:
+		for _ in range(config['MAINTENANCE_STEPS']):
+			changes = db.total_changes
+			db.execute("INSERT INTO videos_fts (videos_fts, rank) "
+					   "VALUES ('merge', ?)", (config['MAINTENANCE_PAGES'], ))
+			db.commit()
+			# Nothing left to merge
+			if db.total_changes - changes < 2:
+				break
+	
+	# Planner statistics, limited to a sample of each index
+	db.execute('PRAGMA analysis_limit = 1000')
+	if db.execute("SELECT COUNT(*) FROM sqlite_master "
+				  "WHERE name = 'sqlite_stat1'").fetchone()[0] == 0:
+		db.execute('ANALYZE')
+	else:
+		db.execute('PRAGMA optimize')
+	db.commit()
+	
+	# Free pages, a few at a time so writers aren't held up
+	if db.execute('PRAGMA auto_vacuum').fetchone()[0] != INCREMENTAL:
+		if vacuum:
+			db.execute(f'PRAGMA auto_vacuum = {INCREMENTAL}')
+			db.commit()
+			# Takes effect once the whole file is rewritten
+			db.execute('VACUUM')
+		else:
+			note = ('Free space is reused but not returned to the filesystem. '
+					'Run flask db-maintain --vacuum once to allow it.')
+	else:
+		for _ in range(config['MAINTENANCE_STEPS']):
+			if free_bytes() == 0:
+				break
+			# Each page is freed as the statement steps
+			db.execute('PRAGMA incremental_vacuum({:d})'.format(
+					   config['MAINTENANCE_PAGES'])).fetchall()
+			db.commit()
+	
+	run = {'started': started,
+		   'duration': time.time() - started,
+		   'size_before': size_before,
+		   'size_after': database_size(),
+		   'integrity': integrity,
+		   'note': note}
+	db.execute('UPDATE maintenance_runs SET duration = ?, size_before = ?, '
+			   'size_after = ?, integrity = ? WHERE rowid = ?',
+			   (run['duration'], run['size_before'], run['size_after'],
+				run['integrity'], run_id))
+	db.commit()
+	current_app.logger.info(f'Maintenance: Finished in {run["duration"]:.1f} '
+							f'seconds, {format_size(run["size_before"])} '
+							f'before, {format_size(run["size_after"])} after')
+	return run
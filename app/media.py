@@ -0,0 +1,130 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+from pathlib import Path
+import urllib
+
+from flask import Blueprint, current_app, jsonify, send_file, url_for
+
+from app.db import get_db, get_params
+from app.auth import login_required
+
+blueprint = Blueprint('media', __name__, url_prefix='/media')
+
+def init_app(app):
+	"""Check the media hand-off mode is one we know"""
+	if app.config['MEDIA_SENDFILE'] not in (None, 'x-accel-redirect',
+											'x-sendfile'):
+		with app.app_context():
+			current_app.logger.warning(
+				'MEDIA_SENDFILE must be None, "x-accel-redirect" or '
+				'"x-sendfile": serving media directly')
+		app.config['MEDIA_SENDFILE'] = None
+
+def media_urls(video, params):
+	"""
+	Returns the URLs of a video file and its thumbnail (or None), served
+	from /media if SERVE_MEDIA is set or from the web path otherwise
+	video is a row with id, folder_path, filename and thumbnail
+	"""
+	if current_app.config['SERVE_MEDIA']:
+		return (url_for('media.video', video_id = video['id']),
+				url_for('media.thumbnail', video_id = video['id'])
+				if video['thumbnail'] else None)
+	
+	web_path = params['web_path']
+	folder = Path(video['folder_path'])
+	return (web_path + urllib.parse.quote(
+				folder.joinpath(video['filename']).as_posix()),
+			web_path + urllib.parse.quote(
+				folder.joinpath(video['thumbnail']).as_posix())
+			if video['thumbnail'] else None)
+
+def get_media_path(video_id, column):
+	"""
+	Returns the path of a video's file or thumbnail (column = 'filename' or
+	'thumbnail') relative to the disk path, or None if it has none
+	Raises ValueError if the path is outside the disk path
+	"""
+	query = ('SELECT folder_path, filename, thumbnail '
+			 'FROM videos INNER JOIN folders ON folder_id = folders.id '
+			 'WHERE videos.id = ?')
+	video = get_db().execute(query, (video_id, )).fetchone()
+	if video is None or not video[column]:
+		return None
+	
+	disk_path = Path(get_params()['disk_path']).resolve()
+	path = disk_path.joinpath(video['folder_path'], video[column]).resolve()
+	try:
+		# Never follow the library out of the disk path
+		return path.relative_to(disk_path)
+	except ValueError as e:
+		raise ValueError('Path is outside the disk path') from e
+
+def send_media(video_id, column, extensions):
+	"""
+	Send a video's file or thumbnail with range requests and conditional
+	headers, or hand it off to the front-end server if MEDIA_SENDFILE is set
+	"""
+	try:
+		path = get_media_path(video_id, column)
+	except ValueError as e:
+		current_app.logger.warning(f'Refused to send video ID {video_id}: {e}')
+		return jsonify({'result': 'error',
+						'message': 'File not found'}), 404
+	except sqlite3.OperationalError as e:
+		current_app.logger.error('Failed to get video: ' + str(e))
+		return jsonify({'result': 'error',
+						'message': 'Failed to get video: ' +
+						'Database error'}), 500
+	
+	if path is None:
+		return jsonify({'result': 'error',
+						'message': 'File not found'}), 404
+	
+	disk_path = Path(get_params()['disk_path']).resolve()
+	mimetype = extensions.get(path.suffix.lower(), 'application/octet-stream')
+	sendfile = current_app.config['MEDIA_SENDFILE']
+	
+	if sendfile == 'x-accel-redirect':
+		# nginx serves the file from an internal location mapped to disk_path
+		response = current_app.response_class(mimetype = mimetype)
+		response.headers['X-Accel-Redirect'] = (
+			current_app.config['MEDIA_ACCEL_PREFIX'] +
+			urllib.parse.quote(path.as_posix()))
+	elif sendfile == 'x-sendfile':
+		# Apache (mod_xsendfile) or lighttpd serves the file by absolute path
+		response = current_app.response_class(mimetype = mimetype)
+		response.headers['X-Sendfile'] = str(disk_path.joinpath(path))
+	else:
+		try:
+			# Handles Range, If-Range, ETag and Last-Modified, and lets the
+			# WSGI server use sendfile where it supports it
+			response = send_file(str(disk_path.joinpath(path)),
+								 mimetype = mimetype, conditional = True)
+		except OSError as e:
+			current_app.logger.warning(f'Could not send video ID {video_id}: {e}')
+			return jsonify({'result': 'error',
+							'message': 'File not found'}), 404
+		response.headers['Accept-Ranges'] = 'bytes'
+	
+	# Library may require a login, so only cache in the browser
+	response.cache_control.public = False
+	response.cache_control.private = True
+	return response
+
+@blueprint.route('/<int:video_id>')
+@login_required('guest', api = True)
+def video(video_id):
+	"""Stream a video file"""
+	return send_media(video_id, 'filename',
+					  current_app.config['VIDEO_EXTENSIONS'])
+
+@blueprint.route('/<int:video_id>/thumbnail')
+@login_required('guest', api = True)
+def thumbnail(video_id):
+	"""Get a video's full size thumbnail"""
+	return send_media(video_id, 'thumbnail',
+					  current_app.config['THUMBNAIL_EXTENSIONS'])
@@ -0,0 +1,27 @@
+import subprocess
+
+def extract_poster(path, offset, size, ffmpeg = 'ffmpeg', timeout = 20):
+	"""
+	Returns a keyframe from near offset seconds into a video as BMP bytes,
+	scaled by ffmpeg to fit within size (maxwidth, maxheight)
+	Seeks the input to the keyframe before offset and decodes only that
+	frame, so long or high resolution videos take no longer than short ones
+	Raises OSError if ffmpeg can't be run, subprocess.TimeoutExpired if it
+	takes over timeout seconds, or ValueError if no frame was returned
+	"""
+	command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error',
+			   # Input options: decode keyframes only, seek before opening
+			   '-skip_frame', 'nokey', '-ss', str(offset), '-i', str(path),
+			   '-map', '0:v:0', '-frames:v', '1', '-an', '-sn',
+			   # Downscale before piping so 4K frames don't cross the pipe
+			   '-vf', (f'scale={size[0]}:{size[1]}'
+					   ':force_original_aspect_ratio=decrease'),
+			   '-f', 'image2pipe', '-c:v', 'bmp', '-']
+	# run() kills ffmpeg if it times out
+	result = subprocess.run(command, stdout = subprocess.PIPE,
+							stderr = subprocess.PIPE, timeout = timeout)
+	if result.returncode != 0 or not result.stdout:
+		message = result.stderr.decode('utf-8', 'replace').strip()
+		raise ValueError('ffmpeg returned no frame' +
+						 (': ' + message.splitlines()[-1] if message else ''))
+	return result.stdout
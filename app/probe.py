@@ -0,0 +1,313 @@
+"""
+Read duration, height, frame rate and video codec from the headers of MP4
+and Matroska/WebM files without reading the rest of the file
+"""
+import struct
+
+# Codec names as youtube-dl reports them, where they differ from the
+# container's codec identifier
+MP4_CODECS = {
+	'vp09': 'vp9',
+	'vp08': 'vp8',
+	'hvc1': 'hevc',
+	'hev1': 'hevc'
+}
+MATROSKA_CODECS = {
+	'V_VP9': 'vp9',
+	'V_VP8': 'vp8',
+	'V_AV1': 'av01',
+	'V_MPEG4/ISO/AVC': 'avc1',
+	'V_MPEGH/ISO/HEVC': 'hevc'
+}
+
+# Most bytes to read from a single header box or element
+MAX_READ = 1024 * 1024
+
+def probe(path):
+	"""
+	Returns a dict of duration (seconds), height, fps and vcodec read from a
+	video file's headers, with None for anything not found
+	Raises OSError if the file can't be read
+	"""
+	result = dict.fromkeys(['duration', 'height', 'fps', 'vcodec'])
+	with open(path, 'rb') as file:
+		file.seek(0, 2)
+		size = file.tell()
+		file.seek(0)
+		magic = file.read(12)
+		try:
+			if magic[4:8] == b'ftyp':
+				probe_mp4(file, size, result)
+			elif magic[:4] == b'\x1a\x45\xdf\xa3':
+				probe_matroska(file, size, result)
+		except (struct.error, ValueError, IndexError, UnicodeDecodeError):
+			# Truncated or malformed, keep whatever was found first
+			pass
+	
+	if result['duration'] is not None:
+		result['duration'] = int(round(result['duration']))
+	if result['fps'] is not None:
+		result['fps'] = round(result['fps'], 3)
+	return result
+
+def read_at(file, offset, length):
+	"""Read length bytes from offset, raising ValueError if cut short"""
+	if length > MAX_READ:
+		raise ValueError('Header too large')
+	file.seek(offset)
+	data = file.read(length)
+	if len(data) < length:
+		raise ValueError('Unexpected end of file')
+	return data
+
+# MP4
+
+def mp4_boxes(file, start, end):
+	"""Yields (type, data start, data end) for each box between offsets"""
+	offset = start
+	while offset + 8 <= end:
+		size, box_type = struct.unpack('>I4s', read_at(file, offset, 8))
+		header = 8
+		if size == 1:
+			# 64-bit size follows the type
+			size = struct.unpack('>Q', read_at(file, offset + 8, 8))[0]
+			header = 16
+		elif size == 0:
+			# Box extends to the end
+			size = end - offset
+		if size < header:
+			raise ValueError('Invalid box size')
+		yield box_type.decode('latin-1'), offset + header, offset + size
+		offset += size
+
+def mp4_child(file, start, end, *path):
+	"""Returns (data start, data end) of the first box at a path of types"""
+	for box_type, data_start, data_end in mp4_boxes(file, start, end):
+		if box_type == path[0]:
+			if len(path) == 1:
+				return data_start, data_end
+			return mp4_child(file, data_start, data_end, *path[1:])
+	return None
+
+def probe_mp4(file, size, result):
+	"""Read the movie header and the first video track's headers"""
+	moov = mp4_child(file, 0, size, 'moov')
+	if moov is None:
+		return
+	
+	mvhd = mp4_child(file, *moov, 'mvhd')
+	if mvhd is not None:
+		version = read_at(file, mvhd[0], 1)[0]
+		if version == 1:
+			timescale, duration = struct.unpack(
+								  '>IQ', read_at(file, mvhd[0] + 20, 12))
+		else:
+			timescale, duration = struct.unpack(
+								  '>II', read_at(file, mvhd[0] + 12, 8))
+		if timescale and duration:
+			result['duration'] = duration / timescale
+	
+	for box_type, trak_start, trak_end in mp4_boxes(file, *moov):
+		if box_type != 'trak':
+			continue
+		hdlr = mp4_child(file, trak_start, trak_end, 'mdia', 'hdlr')
+		if hdlr is None or read_at(file, hdlr[0] + 8, 4) != b'vide':
+			continue
+		
+		# Display height is 16.16 fixed point at the end of the track header
+		tkhd = mp4_child(file, trak_start, trak_end, 'tkhd')
+		if tkhd is not None:
+			height = struct.unpack('>I', read_at(file, tkhd[1] - 4, 4))[0] >> 16
+			result['height'] = height or None
+		
+		stbl = mp4_child(file, trak_start, trak_end, 'mdia', 'minf', 'stbl')
+		if stbl is None:
+			return
+		stsd = mp4_child(file, *stbl, 'stsd')
+		if stsd is not None:
+			# First sample entry follows version, flags and entry count
+			entry_size, codec = struct.unpack(
+								'>I4s', read_at(file, stsd[0] + 8, 8))
+			codec = codec.decode('latin-1')
+			if result['height'] is None:
+				height = struct.unpack('>H', read_at(file, stsd[0] + 8 + 34, 2))[0]
+				result['height'] = height or None
+			result['vcodec'] = MP4_CODECS.get(codec, codec)
+			if codec == 'avc1':
+				# Profile and level from the decoder configuration
+				avcc = mp4_child(file, stsd[0] + 8 + 86,
+								 stsd[0] + 8 + entry_size, 'avcC')
+				if avcc is not None:
+					result['vcodec'] = 'avc1.' + read_at(
+									   file, avcc[0] + 1, 3).hex()
+		
+		# Frame rate from the number of samples over the track's duration
+		mdhd = mp4_child(file, trak_start, trak_end, 'mdia', 'mdhd')
+		stsz = mp4_child(file, *stbl, 'stsz')
+		if mdhd is not None and stsz is not None:
+			version = read_at(file, mdhd[0], 1)[0]
+			if version == 1:
+				timescale, duration = struct.unpack(
+									  '>IQ', read_at(file, mdhd[0] + 20, 12))
+			else:
+				timescale, duration = struct.unpack(
+									  '>II', read_at(file, mdhd[0] + 12, 8))
+			samples = struct.unpack('>I', read_at(file, stsz[0] + 8, 4))[0]
+			if timescale and duration and samples:
+				result['fps'] = samples * timescale / duration
+		return
+
+# Matroska/WebM
+
+EBML_SEGMENT = 0x18538067
+EBML_SEEK_HEAD = 0x114D9B74
+EBML_SEEK = 0x4DBB
+EBML_SEEK_ID = 0x53AB
+EBML_SEEK_POSITION = 0x53AC
+EBML_INFO = 0x1549A966
+EBML_TIMESTAMP_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACK_ENTRY = 0xAE
+EBML_TRACK_TYPE = 0x83
+EBML_CODEC_ID = 0x86
+EBML_DEFAULT_DURATION = 0x23E383
+EBML_VIDEO = 0xE0
+EBML_PIXEL_HEIGHT = 0xBA
+EBML_CLUSTER = 0x1F43B675
+
+def read_vint(data, offset, keep_marker):
+	"""
+	Returns (value, length) of a variable length integer in data at offset
+	Element IDs keep their length marker bit, sizes don't
+	"""
+	first = data[offset]
+	length = 1
+	while length <= 8 and not first & (0x80 >> (length - 1)):
+		length += 1
+	if length > 8:
+		raise ValueError('Invalid variable length integer')
+	value = first if keep_marker else first & (0xFF >> length)
+	for byte in data[offset + 1:offset + length]:
+		value = (value << 8) | byte
+	if len(data) < offset + length:
+		raise ValueError('Unexpected end of data')
+	if not keep_marker and value == (1 << (7 * length)) - 1:
+		# All ones: unknown size
+		value = None
+	return value, length
+
+def ebml_elements(file, start, end):
+	"""Yields (ID, data start, data end) for each element between offsets"""
+	offset = start
+	while offset < end:
+		# IDs are at most 4 bytes and sizes at most 8
+		header = read_at(file, offset, min(12, end - offset))
+		element_id, id_length = read_vint(header, 0, True)
+		size, size_length = read_vint(header, id_length, False)
+		data_start = offset + id_length + size_length
+		data_end = end if size is None else data_start + size
+		yield element_id, data_start, data_end
+		offset = data_end
+
+def ebml_uint(data):
+	return int.from_bytes(data, 'big')
+
+def ebml_float(data):
+	if len(data) == 4:
+		return struct.unpack('>f', data)[0]
+	if len(data) == 8:
+		return struct.unpack('>d', data)[0]
+	return None
+
+def probe_matroska(file, size, result):
+	"""Read the segment's Info and the first video track's TrackEntry"""
+	segment = None
+	for element_id, data_start, data_end in ebml_elements(file, 0, size):
+		if element_id == EBML_SEGMENT:
+			segment = (data_start, min(data_end, size))
+			break
+	if segment is None:
+		return
+	
+	# Info and Tracks usually precede the clusters, but the seek head says
+	# where to find them if not
+	found = {}
+	seek = {}
+	for element_id, data_start, data_end in ebml_elements(file, *segment):
+		if element_id in (EBML_INFO, EBML_TRACKS):
+			found[element_id] = (data_start, data_end)
+		elif element_id == EBML_SEEK_HEAD:
+			for seek_id, seek_start, seek_end in ebml_elements(
+												file, data_start, data_end):
+				if seek_id != EBML_SEEK:
+					continue
+				entry = {}
+				for child_id, child_start, child_end in ebml_elements(
+													file, seek_start, seek_end):
+					entry[child_id] = read_at(file, child_start,
+											  child_end - child_start)
+				if EBML_SEEK_ID in entry and EBML_SEEK_POSITION in entry:
+					seek[ebml_uint(entry[EBML_SEEK_ID])] = (
+						segment[0] + ebml_uint(entry[EBML_SEEK_POSITION]))
+		elif element_id == EBML_CLUSTER:
+			break
+		if len(found) == 2:
+			break
+	
+	for element_id in (EBML_INFO, EBML_TRACKS):
+		if element_id not in found and element_id in seek:
+			for found_id, data_start, data_end in ebml_elements(
+												  file, seek[element_id], size):
+				if found_id == element_id:
+					found[element_id] = (data_start, data_end)
+				break
+	
+	if EBML_INFO in found:
+		timestamp_scale = 1000000
+		duration = None
+		for element_id, data_start, data_end in ebml_elements(
+												file, *found[EBML_INFO]):
+			if element_id == EBML_TIMESTAMP_SCALE:
+				timestamp_scale = ebml_uint(read_at(file, data_start,
+													data_end - data_start))
+			elif element_id == EBML_DURATION:
+				duration = ebml_float(read_at(file, data_start,
+											  data_end - data_start))
+		if duration:
+			# Duration is in timestamp scale units (nanoseconds by default)
+			result['duration'] = duration * timestamp_scale / 1e9
+	
+	if EBML_TRACKS in found:
+		for element_id, entry_start, entry_end in ebml_elements(
+												  file, *found[EBML_TRACKS]):
+			if element_id != EBML_TRACK_ENTRY:
+				continue
+			track = {}
+			for child_id, child_start, child_end in ebml_elements(
+													file, entry_start, entry_end):
+				if child_id in (EBML_TRACK_TYPE, EBML_CODEC_ID,
+								EBML_DEFAULT_DURATION):
+					track[child_id] = read_at(file, child_start,
+											  child_end - child_start)
+				elif child_id == EBML_VIDEO:
+					for video_id, video_start, video_end in ebml_elements(
+															file, child_start, child_end):
+						if video_id == EBML_PIXEL_HEIGHT:
+							track[video_id] = read_at(file, video_start,
+													  video_end - video_start)
+			# Track type 1 is video
+			if ebml_uint(track.get(EBML_TRACK_TYPE, b'')) != 1:
+				continue
+			
+			if EBML_CODEC_ID in track:
+				codec = track[EBML_CODEC_ID].rstrip(b'\x00').decode('ascii')
+				result['vcodec'] = MATROSKA_CODECS.get(codec, codec)
+			if EBML_PIXEL_HEIGHT in track:
+				result['height'] = ebml_uint(track[EBML_PIXEL_HEIGHT]) or None
+			if EBML_DEFAULT_DURATION in track:
+				# Nanoseconds per frame
+				frame_duration = ebml_uint(track[EBML_DEFAULT_DURATION])
+				if frame_duration:
+					result['fps'] = 1e9 / frame_duration
+			break
@@ -0,0 +1,204 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.db import get_db, get_params
+from app.api import refresh_db, rederive_db
+from app.maintenance import claim_maintenance, maintain_db
+
+def init_app(app):
+	"""
+	Run scheduled refreshes in a background thread once the server handles
+	its first request (so CLI commands don't start one) if REFRESH_SCHEDULER
+	is set, and allow running them from the CLI with flask scheduler
+	"""
+	app.cli.add_command(scheduler_command)
+	if not app.config['REFRESH_SCHEDULER'] or app.config['SNAPSHOT_READER']:
+		return
+	
+	started = threading.Event()
+	
+	@app.before_first_request
+	def start_scheduler():
+		if not started.is_set():
+			started.set()
+			threading.Thread(target = run_scheduler, args = (app, ),
+							 daemon = True).start()
+
+@click.command('scheduler')
+@with_appcontext
+def scheduler_command():
+	"""
+	Run scheduled refreshes in the foreground with flask scheduler, e.g. as
+	a service alongside web servers with REFRESH_SCHEDULER = False
+	"""
+	click.echo('Scheduler running, press Ctrl+C to stop.')
+	run_scheduler(current_app._get_current_object())
+
+def timestamp():
+	"""Returns the current time on the same clock as params['last_refreshed']"""
+	return datetime.now().replace(tzinfo = timezone.utc).timestamp()
+
+def jitter(interval):
+	"""Returns a random offset of up to REFRESH_JITTER of interval either way"""
+	spread = interval * current_app.config['REFRESH_JITTER']
+	return random.uniform(-spread, spread)
+
+def quiet_until(now):
+	"""
+	Returns the time (on the same clock as timestamp()) that the quiet hours
+	containing now end, or None if now is outside REFRESH_QUIET_HOURS
+	Hours are whole numbers from 0 to 24, 24 being midnight at the end of
+	the day
+	"""
+	quiet_hours = current_app.config['REFRESH_QUIET_HOURS']
+	if not quiet_hours:
+		return None
+	if (len(quiet_hours) != 2 or
+		not all(isinstance(hour, int) and 0 <= hour <= 24 for hour in quiet_hours)):
+		raise ValueError('REFRESH_QUIET_HOURS must be (start, end) hours from 0 to 24')
+	start, end = quiet_hours
+	local = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo = None)
+	hour = local.hour + local.minute / 60
+	if start <= end:
+		quiet = start <= hour < end
+	else:
+		# Over midnight
+		quiet = hour >= start or hour < end
+	if not quiet:
+		return None
+	
+	ends = local.replace(hour = end % 24, minute = 0, second = 0, microsecond = 0)
+	if ends <= local:
+		ends += timedelta(days = 1)
+	return ends.replace(tzinfo = timezone.utc).timestamp()
+
+def set_next_refresh(next_refresh, previous):
+	"""
+	Record when the next scheduled refresh is due, if it's still previous,
+	in one statement so only one process claims each scheduled refresh
+	Returns False if another process changed it first
+	"""
+	db = get_db()
+	cursor = db.execute('UPDATE params SET next_refresh = ? '
+						'WHERE next_refresh IS ?', (next_refresh, previous))
+	db.commit()
+	return cursor.rowcount > 0
+
+def check_schedule():
+	"""
+	Start a refresh if one is due, or schedule the next after a refresh or
+	settings change cleared it
+	Titles waiting for new filename settings are updated first, once no
+	task is running
+	Returns the number of seconds until the next check
+	"""
+	poll = current_app.config['SCHEDULER_POLL']
+	params = get_params()
+	if params['rederive_pending'] and params['last_refreshed'] != 0:
+		try:
+			rederive_db()
+		except BlockingIOError:
+			pass
+		else:
+			current_app.logger.info('Updating titles with new filename settings')
+		return poll
+	interval = params['refresh_interval']
+	# Disabled, or not yet set up and refreshed once from settings
+	if interval <= 0 or params['last_refreshed'] == 0:
+		return poll
+	
+	now = timestamp()
+	next_refresh = params['next_refresh']
+	if next_refresh is None:
+		# Spread refreshes out so several libraries (or processes that start
+		# together) don't all scan at once
+		set_next_refresh(params['last_refreshed'] + interval + jitter(interval),
+						 None)
+		return 0
+	
+	if now < next_refresh:
+		return min(next_refresh - now, poll)
+	
+	quiet_end = quiet_until(now)
+	if quiet_end is not None:
+		# Wait for the quiet hours to end, in case it's not busy then either
+		set_next_refresh(quiet_end + abs(jitter(interval)), next_refresh)
+		return 0
+	
+	# Claim this refresh and schedule the next in case it doesn't finish
+	# (once finished it schedules from then instead)
+	if not set_next_refresh(now + interval + jitter(interval), next_refresh):
+		return 0
+	current_app.logger.info('Starting scheduled refresh')
+	try:
+		refresh_db(workers = current_app.config['SCHEDULER_IO_WORKERS'])
+	except BlockingIOError:
+		current_app.logger.info('Scheduled refresh skipped: '
+								'a task is already running')
+	return 0
+
+def check_maintenance():
+	"""
+	Maintain the database every MAINTENANCE_INTERVAL seconds, outside quiet
+	hours and refreshes
+	Returns the number of seconds until the next check
+	"""
+	poll = current_app.config['SCHEDULER_POLL']
+	interval = current_app.config['MAINTENANCE_INTERVAL']
+	if not interval or quiet_until(timestamp()) is not None:
+		return poll
+	
+	run_id = claim_maintenance(time.time(), interval)
+	if run_id is None:
+		return poll
+	current_app.logger.info('Starting scheduled maintenance')
+	try:
+		maintain_db(run_id = run_id)
+	except BlockingIOError:
+		# Try again after the refresh
+		db = get_db()
+		db.execute('DELETE FROM maintenance_runs WHERE rowid = ?', (run_id, ))
+		db.commit()
+	return poll
+
+def run_scheduler(app, stop = None):
+	"""
+	Check the schedule until stop (an Event) is set, at least every
+	SCHEDULER_POLL seconds so changes to the refresh interval are seen
+	"""
+	stop = stop or threading.Event()
+	last_error = None
+	while True:
+		with app.app_context():
+			try:
+				wait = check_schedule()
+				if wait:
+					# Not while a refresh is starting
+					wait = min(wait, check_maintenance())
+				last_error = None
+			except sqlite3.OperationalError as e:
+				# Database may not be set up yet, so only warn once
+				if str(e) != last_error:
+					app.logger.warning(f'Scheduler: Could not check schedule: {e}')
+					last_error = str(e)
+				wait = app.config['SCHEDULER_POLL']
+			except Exception as e:
+				# e.g. a config error or a damaged database, logged once
+				# rather than stopping the scheduler
+				if str(e) != last_error:
+					app.logger.error(f'Scheduler: Could not check schedule: {e}', exc_info = True)
+					last_error = str(e)
+				wait = app.config['SCHEDULER_POLL']
+		if stop.wait(max(wait, 1) if wait else 0):
+			return
@@ -19,7 +19,8 @@ from wtforms.validators import ValidationError
 from app.auth import (login_required, add_user, update_user, login_user,
 					  LoginUser, AddUser, UpdateUser, AdminUpdateUser,
 					  AdminUpdateUsers)
-from app.db import get_db, get_params
+from app.db import get_db, get_params, publish_snapshot
+from app.api import rederive_db
 from app.helpers import check_conf
 
 try:
@@ -145,7 +146,9 @@ def general():
 		
 		db = get_db()
 		try:
-			db.execute('UPDATE params SET refresh_interval = ?, disk_path = ?, web_path = ?, metadata_source = ?, generate_thumbs = ?, filename_format = ?, filename_delimiter = ?, replace_underscores = ?, guests_can_view = ?', (
+			old_params = get_params()
+			# Clear next_refresh so the scheduler uses the new interval
+			db.execute('UPDATE params SET refresh_interval = ?, next_refresh = NULL, disk_path = ?, web_path = ?, metadata_source = ?, generate_thumbs = ?, filename_format = ?, filename_delimiter = ?, replace_underscores = ?, guests_can_view = ?', (
 				refresh_interval,
 				disk_path,
 				web_path,
@@ -156,11 +159,21 @@ def general():
 				replace_underscores,
 				guests_can_view
 				))
+			# Titles, dates etc. come from these, so update them from what
+			# was stored when scanned, now or once a running task finishes
+			if (filename_format != old_params['filename_format'] or
+				filename_delimiter != old_params['filename_delimiter'] or
+				replace_underscores != old_params['replace_underscores']):
+				db.execute('UPDATE params SET rederive_pending = 1')
 		except sqlite3.OperationalError as e:
 			flash('Failed to update settings: ' + str(e), 'error')
 		else:
 			db.commit()
 			flash('Settings updated.', 'info')
+			try:
+				publish_snapshot()
+			except (sqlite3.OperationalError, OSError) as e:
+				flash('Failed to publish settings to snapshot readers: ' + str(e), 'warn')
 			try:
 				params = get_params()
 			except sqlite3.OperationalError as e:
@@ -169,6 +182,15 @@ def general():
 				# Check if this is the first time saving settings
 				if params['last_refreshed'] == 0:
 					flash('Setup complete! Click "Refresh database" below to scan for videos for the first time.', 'info')
+				elif params['rederive_pending']:
+					try:
+						rederive_db()
+					except BlockingIOError:
+						flash('Titles will be updated with the new filename settings once the running task finishes (or save settings again then)', 'warn')
+					except sqlite3.OperationalError as e:
+						flash('Failed to update titles: ' + str(e), 'error')
+					else:
+						flash('Updating titles with the new filename settings.', 'info')
 			# Redirect so a refresh doesn't resubmit the form
 			return redirect(url_for('settings.general'))
 	
@@ -186,7 +208,11 @@ def general():
 			# Get database last and next refresh
 			if params['last_refreshed'] != 0:
 				last_refreshed = datetime.strftime(datetime.fromtimestamp(params['last_refreshed']), '%d/%m/%Y %H:%M') + ' UTC'
-				next_refresh = datetime.strftime(datetime.fromtimestamp(params['last_refreshed'] + params['refresh_interval']), '%d/%m/%Y %H:%M') + ' UTC'
+				if params['next_refresh'] is not None:
+					next_refresh = params['next_refresh']
+				else:
+					next_refresh = params['last_refreshed'] + params['refresh_interval']
+				next_refresh = datetime.strftime(datetime.fromtimestamp(next_refresh), '%d/%m/%Y %H:%M') + ' UTC'
 		
 		# Display available thumbnail formats
 		if features is not None:
@@ -38,9 +38,9 @@ current.playlist.id = undefined; // Current playlist ID
 
 
 document.addEventListener("DOMContentLoaded", (event) => {
-	// Occasionally check tasks if logged in and database ready
+	// Show running tasks if logged in and database ready
 	if (apiAvailable) {
-		lazyUpdateStatus();
+		watchStatus();
 	}
 	
 	// Calculate padding on lists for scrolling
@@ -308,6 +308,8 @@ document.addEventListener("DOMContentLoaded", (event) => {
 	// Window resized
 	let resizeTimer;
 	window.addEventListener("resize", () => {
+		// Fill any space uncovered in the playlist
+		renderRows();
 		// If not already expanded
 		if (!infoContainer.classList.contains("full-height")) {
 			clearTimeout(resizeTimer); // Reset delay if resize ongoing
@@ -378,8 +380,16 @@ async function loadPlaylist(playlistID, addHistory = true) {
 	const playlist = await loadJSON("playlist", playlistID,
 									displayPrefs.sort_by,
 									displayPrefs.sort_direction);
-	current.playlist = playlist.data;
+	current.playlist = fromColumns(playlist);
 	current.playlist.id = playlistID;
+	current.playlist.sprites = null;
+	if (playlist.sprites) {
+		// Thumbnails are cells of sprite sheets for this sort order
+		current.playlist.sprites = playlist.sprites;
+		current.playlist.sprites.url = baseUrl + "api/sprite/" + [
+			playlistID, displayPrefs.sort_by, displayPrefs.sort_direction
+		].join("/") + "/";
+	}
 	if (current.video === undefined) {
 		// Only update page URL if no video loaded
 		window.history[addHistory ? "pushState" : "replaceState"](
@@ -400,39 +410,20 @@ function displayPlaylist(playlist) {
 	current.index = {};
 	current.shuffledPlaylist = undefined;
 	current.shuffledIndex = undefined;
-	const template = document.getElementById("template-video");
-	// Create empty playlist from container
-	const newVideoList = videoList.cloneNode(false);
-	// Add each video to list
+	// Create inverse video.id: index mapping to look up play order by ID
 	playlist.forEach((video, index) => {
-		// Create inverse video.id: index mapping to look up play order by ID
 		current.index[video.id] = index;
-		
-		const videoElement = template.content.firstElementChild.cloneNode(true);
-		// Populate template
-		videoElement.setAttribute("data-video", video.id);
-		videoElement.querySelector(".position").textContent = index + 1;
-		videoElement.querySelector(".duration").textContent = video.d;
-		videoElement.querySelector(".number").textContent = index + 1;
-		videoElement.querySelector(".name").textContent = video.t;
-		
-		videoElement.addEventListener("click", function() {
-			// Video clicked
-			// Select self without scrolling to
-			const id = selectItem("video", null, this, false);
-			if (displayPrefs.shuffle) {
-				// Reshuffle playlist, starting from clicked video
-				[current.shuffledPlaylist,
-				current.shuffledIndex] = shufflePlaylist(id);
-			}
-			// Load video
-			loadVideo(id);
-		});
-		
-		// Add video to list
-		newVideoList.appendChild(videoElement);
 	});
 	
+	// Create empty playlist from container
+	const newVideoList = videoList.cloneNode(false);
+	// Spacers stand in for the rows above and below those rendered
+	const topSpacer = document.createElement("div");
+	topSpacer.className = "spacer";
+	const bottomSpacer = topSpacer.cloneNode(false);
+	newVideoList.appendChild(topSpacer);
+	newVideoList.appendChild(bottomSpacer);
+	
 	// Replace existing playlist, clearing listeners
 	videoList.parentNode.replaceChild(newVideoList, videoList);
 	videoList = newVideoList;
@@ -444,11 +435,32 @@ function displayPlaylist(playlist) {
 			observer.disconnect();
 		}
 		observer = createObserver();
-		videoList.querySelectorAll(".thumb").forEach((thumb) => {
-			observer.observe(thumb);
-		});
+		// Drop thumbs queued from the previous playlist
+		pendingThumbs.length = 0;
 	}
 	
+	// Only render rows near the visible part of the list
+	rows = {
+		playlist: playlist,
+		sprites: playlist.sprites,
+		height: 0,
+		rendered: new Map(),
+		topSpacer: topSpacer,
+		bottomSpacer: bottomSpacer
+	};
+	renderRows();
+	
+	// Update rendered rows once per frame while scrolling
+	let scrollFrame = null;
+	videoList.addEventListener("scroll", () => {
+		if (scrollFrame === null) {
+			scrollFrame = window.requestAnimationFrame(() => {
+				scrollFrame = null;
+				renderRows();
+			});
+		}
+	}, {passive: true});
+	
 	if (displayPrefs.shuffle) {
 		// Shuffle enabled, generate shuffled playlist
 		[current.shuffledPlaylist, current.shuffledIndex] = shufflePlaylist();
@@ -461,6 +473,147 @@ function displayPlaylist(playlist) {
 	}
 }
 
+/**
+Render the playlist rows within the visible part of the list
+  Rows are only kept in the DOM for the visible area plus overscanRows above
+  and below. Rows leaving that range are removed and new rows are added
+  either side of those kept, so scrolling only touches the rows that change
+  rows.height: distance between the tops of consecutive rows, measured from
+               the first rows rendered
+*/
+const overscanRows = 10;
+let selectedVideo = null; // ID of the selected video, rendered or not
+let rows = {
+	playlist: [], // Playlist being rendered
+	sprites: null, // Sprite sheet layout, if thumbnails are loaded as sheets
+	height: 0, // Row height (px) including gap
+	rendered: new Map(), // Map of index: element for rows in the DOM
+	topSpacer: null,
+	bottomSpacer: null
+};
+function renderRows() {
+	const total = rows.playlist.length;
+	if (total === 0 || rows.topSpacer === null ||
+		!rows.topSpacer.isConnected) {
+		// Nothing to render or playlist replaced
+		return;
+	}
+	
+	if (rows.height === 0) {
+		// Render the first rows to measure them
+		const measure = Math.min(total, 2);
+		for (let index = rows.rendered.size; index < measure; index++) {
+			const element = createVideoElement(rows.playlist[index], index);
+			videoList.insertBefore(element, rows.bottomSpacer);
+			rows.rendered.set(index, element);
+		}
+		if (measure > 1) {
+			rows.height = rows.rendered.get(1).offsetTop -
+						  rows.rendered.get(0).offsetTop;
+		} else {
+			const element = rows.rendered.get(0);
+			rows.height = element.offsetHeight + (window.getComputedStyle(
+				element, null).getPropertyValue("margin-top")
+				.replace("px", "") << 0);
+		}
+		if (rows.height <= 0) {
+			// List not displayed yet, try again on next scroll
+			rows.height = 0;
+			return;
+		}
+	}
+	
+	// Range of rows to render: [start, end)
+	const viewTop = videoList.scrollTop;
+	const viewBottom = viewTop + videoList.clientHeight;
+	const start = Math.max(0, Math.floor(viewTop / rows.height) -
+							  overscanRows);
+	const end = Math.min(total, Math.ceil(viewBottom / rows.height) +
+								overscanRows);
+	
+	// Remove rows outside the range
+	let firstKept = null;
+	for (const [index, element] of rows.rendered) {
+		if (index < start || index >= end) {
+			if (getThumbs && typeof(observer.unobserve) === "function") {
+				observer.unobserve(element.querySelector(".thumb"));
+			}
+			element.remove();
+			rows.rendered.delete(index);
+		} else if (firstKept === null || index < firstKept) {
+			firstKept = index;
+		}
+	}
+	
+	// Kept rows are contiguous, so new rows go either before or after them
+	const before = document.createDocumentFragment();
+	const after = document.createDocumentFragment();
+	const firstKeptElement = (firstKept !== null
+						   ? rows.rendered.get(firstKept) : rows.bottomSpacer);
+	for (let index = start; index < end; index++) {
+		if (!rows.rendered.has(index)) {
+			const element = createVideoElement(rows.playlist[index], index);
+			(firstKept !== null && index < firstKept ? before : after)
+				.appendChild(element);
+			rows.rendered.set(index, element);
+		}
+	}
+	videoList.insertBefore(before, firstKeptElement);
+	videoList.insertBefore(after, rows.bottomSpacer);
+	
+	// Spacers keep the scroll height of the full playlist
+	rows.topSpacer.style.height = (start * rows.height) + "px";
+	rows.bottomSpacer.style.height = ((total - end) * rows.height) + "px";
+}
+
+// Create a playlist row for a video at an index in the current play order
+function createVideoElement(video, index) {
+	const template = document.getElementById("template-video");
+	const videoElement = template.content.firstElementChild.cloneNode(true);
+	// Populate template
+	videoElement.setAttribute("data-video", video.id);
+	videoElement.querySelector(".position").textContent = index + 1;
+	videoElement.querySelector(".duration").textContent = formatDuration(video.d);
+	videoElement.querySelector(".number").textContent = index + 1;
+	videoElement.querySelector(".name").textContent = video.t;
+	if (video.id === selectedVideo) {
+		videoElement.classList.add("selected");
+	}
+	
+	videoElement.addEventListener("click", function() {
+		// Video clicked
+		// Select self without scrolling to
+		const id = selectItem("video", null, this, false);
+		if (displayPrefs.shuffle) {
+			// Reshuffle playlist, starting from clicked video
+			[current.shuffledPlaylist,
+			current.shuffledIndex] = shufflePlaylist(id);
+		}
+		// Load video
+		loadVideo(id);
+	});
+	
+	if (getThumbs) {
+		const thumb = videoElement.querySelector(".thumb");
+		if (rows.sprites) {
+			if (video.s !== null) {
+				// Shares a sheet with nearby rows
+				showSprite(thumb, video.s);
+			}
+		} else if (loadedThumbs.has(video.id)) {
+			// Loaded while previously rendered
+			const loaded = loadedThumbs.get(video.id);
+			thumb.src = loaded.src;
+			thumb.srcset = loaded.srcset;
+		} else if (typeof(observer.observe) === "function") {
+			// Load once visible
+			observer.observe(thumb);
+		}
+	}
+	
+	return videoElement;
+}
+
 
 // Load, display and play a video by its ID
 // If addHistory = false, replaces current entry instead of adding
@@ -512,9 +665,6 @@ function displayVideo(video) {
 			display: ".title" },
 		uploader: {
 			display: ".uploader" },
-		upload_date: {
-			display: ".date",
-			contents: ".date-value" },
 		vcodec: {
 			display: ".codec" }
 	};
@@ -629,15 +779,22 @@ function displayVideo(video) {
 	// Date (if uploaded missing, get downloaded from modtime)
 	if (video.upload_date === null && video.modification_time !== null) {
 		info.querySelector(".date-value")
-			.textContent = video.modification_time;
+			.textContent = formatDateTime(video.modification_time);
 		info.querySelector(".date-type").textContent = "Downloaded";
+		info.querySelector(".date").title = "";
 		info.querySelector(".date").classList.remove("hidden");
-	} else {
+	} else if (video.upload_date !== null) {
+		info.querySelector(".date-value")
+			.textContent = formatDate(video.upload_date);
 		// Default label
 		info.querySelector(".date-type").textContent = "Uploaded";
 		// Date downloaded as tooltip
-		info.querySelector(".date").title = "Downloaded " +
-											video.modification_time;
+		info.querySelector(".date").title = (video.modification_time !== null
+			? "Downloaded " + formatDateTime(video.modification_time) : "");
+		info.querySelector(".date").classList.remove("hidden");
+	} else {
+		info.querySelector(".date-value").textContent = "";
+		info.querySelector(".date").classList.add("hidden");
 	}
 	
 	// Resolution and/or fps (add suffixes and concat)
@@ -687,11 +844,53 @@ async function loadVideoPrePlaylist(videoID, addHistory = false) {
 }
 
 
+// Display a cell of the current playlist's sprite sheets as a thumbnail
+function showSprite(thumb, cell) {
+	const columns = rows.sprites.columns;
+	const gridRows = rows.sprites.rows;
+	const sheet = Math.floor(cell / (columns * gridRows));
+	const column = cell % columns;
+	const row = Math.floor(cell / columns) % gridRows;
+	thumb.style.backgroundImage = "url(\"" + rows.sprites.url + sheet + "/" +
+		thumbFormat + "?g=" + rows.sprites.generation + "\")";
+	// Scale the sheet so one cell fills the thumbnail, then align that cell
+	thumb.style.backgroundSize = (columns * 100) + "% " + (gridRows * 100) + "%";
+	thumb.style.backgroundPosition =
+		(columns > 1 ? column / (columns - 1) * 100 : 0) + "% " +
+		(gridRows > 1 ? row / (gridRows - 1) * 100 : 0) + "%";
+}
+
 // Load and display thumbnails from a Map of videoID: element
 const thumbsPerRq = 10;
 async function loadThumbs(thumbQueue) {
 	const haveObserver = (typeof(observer.unobserve) === "function"
 					   ? true : false);
+	if (thumbUrls) {
+		// Load each thumbnail as an image in the best format the browser
+		// accepts, generated by the server on first request
+		for (const [videoID, element] of thumbQueue) {
+			const placeholder = element.src;
+			element.onerror = () => {
+				// No thumbnail
+				element.onerror = null;
+				element.srcset = "";
+				element.src = placeholder;
+				loadedThumbs.delete(videoID);
+			};
+			const src = baseUrl + "api/thumb/" + videoID + "?g=" + generation;
+			// Larger sizes for high density screens
+			element.srcset = thumbScales.filter((scale) => scale > 1)
+				.map((scale) => src + "&x=" + scale + " " + scale + "x")
+				.join(", ");
+			element.src = src;
+			cacheThumb(videoID, element.src, element.srcset);
+			if (haveObserver) {
+				observer.unobserve(element);
+			}
+		}
+		return;
+	}
+	
 	let videoIDs = Array.from(thumbQueue.keys());
 	// Split into chunks for smaller API responses
 	videoIDs = [...Array(Math.ceil(videoIDs.length / thumbsPerRq))]
@@ -704,13 +903,28 @@ async function loadThumbs(thumbQueue) {
 	
 	// Request each chunk in turn
 	await Promise.all(videoIDs.map(async (chunk) => {
-		const thumbs = await loadJSON("POST", chunk, "thumbs", thumbFormat);
+		const response = await loadJSON("POST", chunk, "thumbs", thumbFormat);
+		// Map of video ID: [thumb at each scale], smallest first
+		const thumbs = new Map();
+		const rows = (response.columns ? fromColumns(response)
+					  : thumbRows(response.data));
+		for (const thumb of rows) {
+			if (!thumbs.has(thumb.id)) {
+				thumbs.set(thumb.id, []);
+			}
+			thumbs.get(thumb.id).push(thumb);
+		}
 		// Loop through requested IDs
 		for (videoID of chunk) {
 			let element = thumbQueue.get(videoID);
 			// Add image data if returned
-			if (videoID in thumbs.data) {
-				element.src = thumbs.data[videoID].d;
+			if (thumbs.has(videoID)) {
+				const scales = thumbs.get(videoID).sort((a, b) => a.s - b.s);
+				// Whitespace from base64 line breaks would split srcset
+				element.srcset = scales.slice(1).map((thumb) =>
+					thumb.d.replace(/\s/g, "") + " " + thumb.s + "x").join(", ");
+				element.src = scales[0].d;
+				cacheThumb(videoID, element.src, element.srcset);
 			}
 			// Stop observing this element
 			// (also prevents retry if no thumb returned)
@@ -721,6 +935,80 @@ async function loadThumbs(thumbQueue) {
 	}));
 };
 
+// Rows like those of the columns response from thumbnails returned as
+// {videoID: {"f": format, "d": smallest, "x": {scale: larger}}}
+function thumbRows(data) {
+	const rows = [];
+	for (const [videoID, thumb] of Object.entries(data)) {
+		const id = Number(videoID);
+		if (thumb.d != null) {
+			rows.push({id: id, f: thumb.f, d: thumb.d,
+					   s: Math.min(...thumbScales)});
+		}
+		for (const [scale, data] of Object.entries(thumb.x)) {
+			rows.push({id: id, f: thumb.f, d: data, s: Number(scale)});
+		}
+	}
+	return rows;
+}
+
+// Keep loaded thumbs for rows that are removed and rendered again
+const maxLoadedThumbs = 2000;
+let loadedThumbs = new Map();
+function cacheThumb(videoID, src, srcset) {
+	loadedThumbs.delete(videoID);
+	loadedThumbs.set(videoID, {src: src, srcset: srcset});
+	if (loadedThumbs.size > maxLoadedThumbs) {
+		// Forget the oldest
+		loadedThumbs.delete(loadedThumbs.keys().next().value);
+	}
+}
+
+/**
+Convert int seconds to a DD:HH:MM:SS / HH:MM:SS / MM:SS / 0:SS-style duration,
+without leading zeroes
+  Matches format_duration in app/helpers.py, which formats durations for
+  responses that aren't returned as columns. Anything else (already formatted
+  or null) is returned unchanged
+*/
+function formatDuration(seconds) {
+	if (!Number.isInteger(seconds)) {
+		return seconds;
+	}
+	const pad = (number) => String(number).padStart(2, "0");
+	let minutes = Math.floor(seconds / 60);
+	let hours = Math.floor(minutes / 60);
+	const days = Math.floor(hours / 24);
+	seconds %= 60;
+	minutes %= 60;
+	hours %= 24;
+	if (days > 0) {
+		return days + ":" + pad(hours) + ":" + pad(minutes) + ":" + pad(seconds);
+	} else if (hours > 0) {
+		return hours + ":" + pad(minutes) + ":" + pad(seconds);
+	} else if (minutes > 0) {
+		return minutes + ":" + pad(seconds);
+	} else {
+		return "0:" + pad(seconds);
+	}
+}
+
+/**
+Format seconds since epoch in the browser's locale
+  Upload dates are days, stored as midnight UTC, so are shown in UTC to stay
+  on the same day everywhere
+*/
+function formatDate(seconds) {
+	return new Date(seconds * 1000).toLocaleDateString(undefined,
+													   {timeZone: "UTC"});
+}
+
+function formatDateTime(seconds) {
+	const date = new Date(seconds * 1000);
+	return date.toLocaleDateString() + " " + date.toLocaleTimeString(
+		   undefined, {hour: "2-digit", minute: "2-digit"});
+}
+
 // Watch for changes in visible playlist items and trigger thumbnail loads
 let observer = {};
 function createObserver(rootElement) {
@@ -747,8 +1035,10 @@ function intersectionChanged(entries, observer) {
 	});
 	
 	function thumbsFromPending() {
-		// Get most recent thumbs from queue
-		const recentThumbs = new Map([...pendingThumbs.slice(-numRecentThumbs)]);
+		// Get most recent thumbs still rendered from queue
+		const recentThumbs = new Map([...pendingThumbs.filter(
+			([videoID, element]) => element.isConnected
+		).slice(-numRecentThumbs)]);
 		// Clear queue and load thumbs
 		pendingThumbs.length = 0;
 		loadThumbs(recentThumbs);
@@ -1102,7 +1392,7 @@ function shufflePlaylist(videoID = null) {
 Mark or unmark a list item (video or playlist) as selected
   Previously-selected item of type = ["playlist", "video"] will be unmarked
   itemID or element supplied: item will be marked selected
-  itemID supplied: returns list item's element
+  itemID supplied: returns list item's element (if rendered)
 */
 function selectItem(type = "playlist", itemID = null,
 					element = null, scrollTo = true) {
@@ -1113,6 +1403,18 @@ function selectItem(type = "playlist", itemID = null,
 		// Unmark currently selected item
 		currentlySelected.classList.remove("selected");
 	}
+	if (type === "video") {
+		// Playlist rows are only rendered near the visible part of the list,
+		// so remember the selected video to mark its row when rendered
+		selectedVideo = (element !== null
+					  ? element.getAttribute(attribute) << 0 : itemID);
+		if (itemID !== null && scrollTo && current.index !== undefined &&
+			itemID in current.index && rows.height > 0) {
+			// Scroll to the row's position and render it
+			list.scrollTop = current.index[itemID] * rows.height;
+			renderRows();
+		}
+	}
 	if (itemID !== null) {
 		// ID supplied, get element by data-attribute
 		element = list.querySelector("[" + attribute + "='" + itemID + "']")
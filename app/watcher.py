@@ -0,0 +1,289 @@
+try:
+	from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+	import sqlite3
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.db import get_params
+from app.api import refresh_db
+
+# Event flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Files finished writing or moved in (youtube-dl renames .part files once
+# downloaded), and new folders
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+# struct inotify_event without its name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+def init_app(app):
+	"""
+	Watch disk_path in a background thread once the server handles its first
+	request if WATCH_LIBRARY is set, and allow running it from the CLI with
+	flask watch
+	"""
+	app.cli.add_command(watch_command)
+	if not app.config['WATCH_LIBRARY'] or app.config['SNAPSHOT_READER']:
+		return
+	
+	started = threading.Event()
+	
+	@app.before_first_request
+	def start_watcher():
+		if not started.is_set():
+			started.set()
+			threading.Thread(target = run_watcher, args = (app, ),
+							 daemon = True).start()
+
+@click.command('watch')
+@with_appcontext
+def watch_command():
+	"""
+	Add new videos as they're downloaded with flask watch, e.g. as a service
+	alongside web servers with WATCH_LIBRARY = False
+	"""
+	click.echo('Watching for new videos, press Ctrl+C to stop.')
+	run_watcher(current_app._get_current_object())
+
+class Inotify():
+	"""Minimal ctypes binding to Linux inotify, watching directories"""
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		try:
+			init = libc.inotify_init1
+			self._add_watch = libc.inotify_add_watch
+		except AttributeError as e:
+			raise OSError('inotify is not available on this system') from e
+		self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+									ctypes.c_uint32)
+		self.fd = init(IN_CLOEXEC)
+		if self.fd < 0:
+			raise self.error()
+		# Watch descriptor: directory
+		self.paths = {}
+	
+	def error(self):
+		code = ctypes.get_errno()
+		return OSError(code, os.strerror(code))
+	
+	def add_watch(self, path):
+		wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+		if wd < 0:
+			raise self.error()
+		self.paths[wd] = Path(path)
+	
+	def read(self, timeout):
+		"""
+		Wait up to timeout seconds for events
+		Returns a list of (directory, mask, name), with directory None for
+		IN_Q_OVERFLOW
+		"""
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return []
+		data = os.read(self.fd, 64 * 1024)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			if mask & IN_IGNORED:
+				# Directory removed
+				self.paths.pop(wd, None)
+			elif wd in self.paths or mask & IN_Q_OVERFLOW:
+				events.append((self.paths.get(wd), mask, name))
+		return events
+	
+	def close(self):
+		os.close(self.fd)
+
+def file_stem(name):
+	"""
+	Returns the stem a video, thumbnail or metadata file shares with its
+	video, or None for other files
+	"""
+	config = current_app.config
+	if name.endswith(config['METADATA_EXTENSION']):
+		return name.rsplit(config['METADATA_EXTENSION'], 1)[0]
+	path = Path(name)
+	if (path.suffix in config['VIDEO_EXTENSIONS'] or
+		path.suffix in config['THUMBNAIL_EXTENSIONS']):
+		return path.stem
+	return None
+
+class LibraryWatcher():
+	"""
+	Watches basepath and its subfolders, collecting the changed files in each
+	folder until it has been quiet for debounce seconds
+	"""
+	def __init__(self, basepath, debounce):
+		self.basepath = Path(basepath)
+		self.debounce = debounce
+		self.inotify = Inotify()
+		# Folder path relative to basepath: set of changed file stems
+		self.pending = {}
+		# Folder path relative to basepath: time.monotonic() of last change
+		self.last_change = {}
+		# Events were dropped, so only a full refresh will find everything
+		self.overflowed = False
+		self.watch_tree(self.basepath)
+	
+	def watch_tree(self, path):
+		"""Watch a folder and its subfolders, returning those watched"""
+		watched = []
+		for folder in [path] + [folder for folder in path.glob('**/')
+								if folder != path]:
+			try:
+				self.inotify.add_watch(folder)
+			except FileNotFoundError:
+				# Removed while listing
+				continue
+			except OSError as e:
+				if e.errno != errno.ENOSPC:
+					raise
+				current_app.logger.warning('Watch: Could not watch "' + str(folder) + '": raise fs.inotify.max_user_watches')
+				continue
+			watched.append(folder)
+		return watched
+	
+	def handle(self, events):
+		"""Record changes from Inotify.read()"""
+		now = time.monotonic()
+		for directory, mask, name in events:
+			if mask & IN_Q_OVERFLOW:
+				if not self.overflowed:
+					current_app.logger.warning('Watch: Too many changes to follow, refreshing all folders')
+				self.overflowed = True
+			elif mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					# New folders may already contain videos if moved in
+					for folder in self.watch_tree(directory.joinpath(name)):
+						self.change(folder, None, now)
+			elif not mask & IN_CREATE:
+				# New files are scanned once written
+				stem = file_stem(name)
+				if stem is not None:
+					self.change(directory, stem, now)
+	
+	def change(self, folder, stem, now):
+		relative = str(folder.relative_to(self.basepath))
+		stems = self.pending.setdefault(relative, set())
+		if stem is not None:
+			stems.add(stem)
+		self.last_change[relative] = now
+	
+	def quiet_folders(self):
+		"""Returns pending changes in folders quiet for the debounce window"""
+		now = time.monotonic()
+		return {folder: self.pending[folder] for folder, changed
+				in self.last_change.items() if now - changed >= self.debounce}
+	
+	def clear(self, folders):
+		for folder in folders:
+			self.pending.pop(folder, None)
+			self.last_change.pop(folder, None)
+	
+	def defer(self, folders):
+		"""Wait another debounce window before trying these folders again"""
+		now = time.monotonic()
+		for folder in folders:
+			self.last_change[folder] = now
+	
+	def close(self):
+		self.inotify.close()
+
+def scan_changes(watcher):
+	"""
+	Scan the folders whose changes have settled, or everything if events were
+	dropped, unless a task is already running
+	"""
+	if watcher.overflowed:
+		folders = dict(watcher.pending)
+	else:
+		folders = watcher.quiet_folders()
+		if not folders:
+			return
+	
+	try:
+		if watcher.overflowed:
+			refresh_db()
+		else:
+			current_app.logger.info('Watch: Scanning ' + str(len(folders)) + ' changed folders')
+			refresh_db(folders = folders)
+	except BlockingIOError:
+		# Try again once it's finished
+		watcher.defer(folders)
+	except (sqlite3.OperationalError, FileNotFoundError) as e:
+		current_app.logger.warning('Watch: Could not scan changes: ' + str(e))
+		watcher.defer(folders)
+	else:
+		watcher.overflowed = False
+		watcher.clear(folders)
+
+def run_watcher(app, stop = None):
+	"""
+	Watch disk_path until stop (an Event) is set, following changes to it in
+	settings, and scan folders WATCH_DEBOUNCE seconds after their last change
+	Waits for the first refresh from settings before watching
+	"""
+	stop = stop or threading.Event()
+	debounce = app.config['WATCH_DEBOUNCE']
+	watcher = None
+	last_error = None
+	try:
+		while not stop.is_set():
+			with app.app_context():
+				try:
+					params = get_params()
+					last_error = None
+				except sqlite3.OperationalError as e:
+					# Database may not be set up yet, so only warn once
+					if str(e) != last_error:
+						app.logger.warning(f'Watch: Could not get settings: {e}')
+						last_error = str(e)
+					stop.wait(app.config['SCHEDULER_POLL'])
+					continue
+				
+				basepath = Path(params['disk_path'])
+				if watcher is not None and watcher.basepath != basepath:
+					# Disk path changed
+					watcher.close()
+					watcher = None
+				if watcher is None:
+					if params['last_refreshed'] == 0 or not basepath.is_dir():
+						stop.wait(app.config['SCHEDULER_POLL'])
+						continue
+					try:
+						watcher = LibraryWatcher(basepath, debounce)
+					except OSError as e:
+						app.logger.error('Watch: Could not watch for new videos: ' + str(e))
+						return
+					app.logger.info('Watch: Watching "' + str(basepath) + '"')
+				
+				watcher.handle(watcher.inotify.read(max(debounce, 1)))
+				scan_changes(watcher)
+	finally:
+		if watcher is not None:
+			watcher.close()